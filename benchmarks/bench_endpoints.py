@@ -0,0 +1,407 @@
+"""Бенчмарк эндпоинтов плагинов atk_ct на локальном Postgres и поддельном MSSQL.
+
+Запускается скриптом, не тестами, в окружении с установленным Airflow и
+инициализированной метабазой (airflow db migrate):
+
+    python benchmarks/bench_endpoints.py \\
+        --dsn postgresql://postgres@localhost:5432/airflow \\
+        --scales 100,10000,100000 --projects 1000 --repeat 30 \\
+        --json bench.json [--baseline previous.json --tolerance 0.2]
+
+База Postgres должна называться airflow: плагин обращается к airflow.atk_ct.ct_projects.
+Схема atk_ct создается миграциями ct_schema, если ее нет; все данные бенчмарка пишутся в проекты
+с префиксом bench_ и удаляются в конце. MSSQL подменяется фабрикой
+соединений пула ct_pool, которая отвечает на запросы ct_metadata по
+сгенерированным метаданным (scale таблиц в базе bench_db_<scale>).
+
+Для каждого эндпоинта и масштаба выводятся p50/p99 времени ответа (мс,
+включая чтение всего тела), число запросов к базам на один вызов (по
+ct_timing) и пиковый прирост памяти Python (tracemalloc, отдельным
+прогоном). С --baseline скрипт завершается с кодом 1, если p50 вырос
+больше чем на tolerance или запросов стало больше.
+"""
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+PLUGINS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FAKE_MSSQL_CONN_ID = "bench_mssql"
+PROJECT_PREFIX = "bench_"
+BACKGROUND_TABLES = 100
+COLUMNS_PER_TABLE = 4
+LOAD_CHANGES = 100
+
+SEED_PROJECTS_SQL = """
+    INSERT INTO atk_ct.ct_projects (ct_project_id, source_connection_id, biview_project_type, ct_database,
+                                    transfer_source_data, target_type, update_dags_schedule)
+    SELECT %(prefix)s || 'p' || lpad(i::text, 5, '0'), %(conn_id)s, 1, %(database)s, false, 'ODS', '0 * * * *'
+    FROM generate_series(1, %(count)s) AS i;
+"""
+
+SEED_PROJECT_SQL = """
+    INSERT INTO atk_ct.ct_projects (ct_project_id, source_connection_id, biview_project_type, ct_database,
+                                    transfer_source_data, target_type, update_dags_schedule)
+    VALUES (%(project_id)s, %(conn_id)s, 1, %(database)s, false, 'ODS', '0 * * * *');
+"""
+
+SEED_TABLES_SQL = """
+    INSERT INTO atk_ct.ct_tables (project_id, table_name, load)
+    SELECT p.ct_project_id, 'T' || lpad(t::text, 6, '0'), true
+    FROM atk_ct.ct_projects p
+    CROSS JOIN generate_series(1, %(tables)s) AS t
+    WHERE p.ct_project_id LIKE %(pattern)s;
+"""
+
+CLEANUP_SQL = """
+    DELETE FROM atk_ct.ct_tables WHERE project_id LIKE %(pattern)s;
+    DELETE FROM atk_ct.ct_projects WHERE ct_project_id LIKE %(pattern)s;
+"""
+
+
+def _database_name(scale):
+    return f"bench_db_{scale}"
+
+
+def _table_name(i):
+    return f"T{i:06d}"
+
+
+class FakeMssqlServer:
+    """Метаданные баз MSSQL в памяти; отвечает только на запросы ct_metadata"""
+
+    def __init__(self):
+        #  SELECT 1 - проверка соединения пулом
+        self._handlers = {"SELECT 1": lambda params: [(1, )]}
+
+    def add_database(self, name, tables, columns=COLUMNS_PER_TABLE):
+        import ct_metadata
+
+        modify_date = datetime(2024, 1, 1)
+        objects = [(i, "dbo", _table_name(i), "U ", modify_date) for i in range(1, tables + 1)]
+        column_rows = [
+            (i, c, f"col_{c}", "int" if c == 1 else "nvarchar", 4 if c == 1 else 100, 10 if c == 1 else 0, 0, c != 1)
+            for i in range(1, tables + 1) for c in range(1, columns + 1)
+        ]
+        #  Первичный ключ каждой таблицы - первая колонка
+        primary_key_rows = [(i, "col_1") for i in range(1, tables + 1)]
+        summary = [(len(objects), sum(row[0] for row in objects) % 2147483647, modify_date)]
+        db = ct_metadata.quote_mssql_name(name)
+
+        def changed(rows):
+            #  У всех объектов одна modify_date: либо все строки, либо ни одной
+            return lambda params: rows if modify_date >= params[0] else []
+
+        self._handlers.update({
+            ct_metadata.SUMMARY_SQL.format(db=db): lambda params: summary,
+            ct_metadata.OBJECT_IDS_SQL.format(db=db): lambda params: [(row[0], ) for row in objects],
+            ct_metadata.CHANGED_OBJECTS_SQL.format(db=db): changed(objects),
+            ct_metadata.CHANGED_COLUMNS_SQL.format(db=db): changed(column_rows),
+            ct_metadata.CHANGED_PRIMARY_KEYS_SQL.format(db=db): changed(primary_key_rows),
+        })
+
+    def connect(self, conn_id, database=None):
+        return _FakeConnection(self._handlers)
+
+
+class _FakeCursor:
+    def __init__(self, handlers):
+        self._handlers = handlers
+        self._rows = []
+        self.description = None
+        self.rowcount = -1
+
+    def execute(self, sql, params=None):
+        handler = self._handlers.get(sql)
+        if handler is None:
+            raise NotImplementedError(f"Fake MSSQL does not know the query: {' '.join(sql.split())[:200]}")
+        self._rows = list(handler(params))
+        self.rowcount = len(self._rows)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchmany(self, size=1):
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def close(self):
+        self._rows = []
+
+
+class _FakeConnection:
+    closed = 0
+
+    def __init__(self, handlers):
+        self._handlers = handlers
+
+    def cursor(self):
+        return _FakeCursor(self._handlers)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+def _percentile(values, q):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+class Case:
+    """Один вызов эндпоинта; setup выполняется перед каждым вызовом вне замера"""
+
+    def __init__(self, endpoint, scale, method, url, body=None, setup=None):
+        self.endpoint = endpoint
+        self.scale = scale
+        self.method = method
+        self.url = url
+        self.body = body
+        self.setup = setup
+
+    def call(self, client):
+        """Вызов без setup: (код ответа, тело)"""
+        body = self.body() if callable(self.body) else self.body
+        response = client.open(self.url, method=self.method, json=body)
+        try:
+            return response.status_code, response.get_data()
+        finally:
+            response.close()
+
+    def check(self, status_code, data):
+        failed = status_code >= 400
+        if not failed and data.startswith(b"{") and len(data) < 65536:
+            failed = json.loads(data).get("status") == "error"
+        if failed:
+            raise RuntimeError(f"{self.endpoint} returned {status_code}: {data[:500]!r}")
+
+
+def run_case(client, case, repeat, warmup, memory_repeat, timers):
+    latencies, queries = [], []
+    size = 0
+    for i in range(warmup + repeat):
+        if case.setup is not None:
+            case.setup()
+        timers.clear()
+        started = time.perf_counter()
+        status_code, data = case.call(client)
+        elapsed = (time.perf_counter() - started) * 1000
+        case.check(status_code, data)
+        size = len(data)
+        if i >= warmup:
+            latencies.append(elapsed)
+            queries.append(sum(timer.queries for timer in timers))
+    del data
+
+    #  Память меряется отдельно: tracemalloc сильно замедляет выполнение
+    peak = 0
+    tracemalloc.start()
+    try:
+        for _ in range(memory_repeat):
+            if case.setup is not None:
+                case.setup()
+            tracemalloc.reset_peak()
+            baseline = tracemalloc.get_traced_memory()[0]
+            case.call(client)
+            peak = max(peak, tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    return {
+        "endpoint": case.endpoint,
+        "scale": case.scale,
+        "p50_ms": round(_percentile(latencies, 0.5), 2),
+        "p99_ms": round(_percentile(latencies, 0.99), 2),
+        "queries": _percentile(queries, 0.5),
+        "bytes": size,
+        "peak_kb": round(peak / 1024, 1),
+    }
+
+
+def _configure_environment(args, work_dir):
+    """Настройки Airflow и atk_ct до первого импорта airflow"""
+    os.environ["AIRFLOW__CORE__PLUGINS_FOLDER"] = PLUGINS_DIR
+    os.environ["AIRFLOW_CONN_AIRFLOW_POSTGRES"] = args.dsn
+    os.environ["AIRFLOW__ATK_CT__METADATA_CACHE_DIR"] = os.path.join(work_dir, "metadata")
+    os.environ["AIRFLOW__ATK_CT__CONFIG_SNAPSHOT_PATH"] = os.path.join(work_dir, "atk_ct_projects.json")
+    os.environ["AIRFLOW__ATK_CT__TIMING_ENABLED"] = "True"
+    #  Повторные вызовы update_and_fetch_data иначе упираются в лимиты ct_throttle (429)
+    os.environ["AIRFLOW__ATK_CT__THROTTLE_ENABLED"] = "False"
+    os.environ.setdefault("AIRFLOW__ATK_CT__SLOW_REQUEST_MS", "600000")
+    os.environ.setdefault("AIRFLOW__ATK_CT__SLOW_QUERY_MS", "600000")
+    if PLUGINS_DIR not in sys.path:
+        sys.path.insert(0, PLUGINS_DIR)
+
+
+def _seed(dsn, scales, projects):
+    import psycopg2
+
+    import ct_schema
+
+    ct_schema.upgrade()
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            pattern = PROJECT_PREFIX.replace("_", "\\_") + "%"
+            cursor.execute(CLEANUP_SQL, {"pattern": pattern})
+            cursor.execute(SEED_PROJECTS_SQL, {"prefix": PROJECT_PREFIX, "conn_id": FAKE_MSSQL_CONN_ID,
+                                               "database": _database_name(BACKGROUND_TABLES), "count": projects})
+            cursor.execute(SEED_TABLES_SQL, {"tables": BACKGROUND_TABLES, "pattern": PROJECT_PREFIX + "p%"})
+            for scale in scales:
+                project_id = f"{PROJECT_PREFIX}s{scale}"
+                cursor.execute(SEED_PROJECT_SQL, {"project_id": project_id, "conn_id": FAKE_MSSQL_CONN_ID,
+                                                  "database": _database_name(scale)})
+                cursor.execute(SEED_TABLES_SQL, {"tables": scale, "pattern": project_id})
+            cursor.execute("ANALYZE atk_ct.ct_tables; ANALYZE atk_ct.ct_projects;")
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def _cleanup(dsn):
+    import psycopg2
+
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute(CLEANUP_SQL, {"pattern": PROJECT_PREFIX.replace("_", "\\_") + "%"})
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def build_cases(scales):
+    from ct_metadata import metadata_cache
+
+    cases = [
+        Case("project_list", "-", "GET", "/projectsview/"),
+        Case("projects", "-", "GET", "/projectsview/projects?startRow=0&endRow=100"),
+    ]
+    for scale in scales:
+        project_id = f"{PROJECT_PREFIX}s{scale}"
+        database = _database_name(scale)
+        discovery = (f"/mybaseview/update_and_fetch_data?project_id={project_id}"
+                     f"&connection={FAKE_MSSQL_CONN_ID}&database={database}")
+        toggle = {"value": False}
+
+        def load_changes(project_id=project_id, scale=scale, toggle=toggle):
+            toggle["value"] = not toggle["value"]
+            rows = [{"table_name": _table_name(i), "changes": [{"field": "load", "newValue": toggle["value"]}]}
+                    for i in range(1, min(scale, LOAD_CHANGES) + 1)]
+            return {"project_id": project_id, "rows": rows}
+
+        cases += [
+            Case("fetch_data", scale, "GET", f"/mybaseview/fetch_data?project_id={project_id}"),
+            Case("fetch_data?stream=0", scale, "GET", f"/mybaseview/fetch_data?project_id={project_id}&stream=0"),
+            Case("update_and_fetch_data (warm)", scale, "GET", discovery),
+            Case("update_and_fetch_data (cold)", scale, "GET", discovery,
+                 setup=lambda database=database: metadata_cache.invalidate(FAKE_MSSQL_CONN_ID, database)),
+            Case("update_data_is_load", scale, "POST", "/mybaseview/update_data_is_load", body=load_changes),
+        ]
+    return cases
+
+
+def compare(results, baseline, tolerance):
+    """Регрессии относительно прошлого запуска: рост p50 больше tolerance или числа запросов"""
+    previous = {(r["endpoint"], str(r["scale"])): r for r in baseline}
+    regressions = []
+    for result in results:
+        before = previous.get((result["endpoint"], str(result["scale"])))
+        if before is None:
+            continue
+        if result["p50_ms"] > before["p50_ms"] * (1 + tolerance):
+            regressions.append(f"{result['endpoint']} [{result['scale']}]: p50 {before['p50_ms']} -> "
+                               f"{result['p50_ms']} ms")
+        if result["queries"] > before["queries"]:
+            regressions.append(f"{result['endpoint']} [{result['scale']}]: queries {before['queries']} -> "
+                               f"{result['queries']}")
+    return regressions
+
+
+def print_results(results):
+    header = ("endpoint", "scale", "p50_ms", "p99_ms", "queries", "bytes", "peak_kb")
+    rows = [header] + [tuple(str(r[key]) for key in header) for r in results]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(header))]
+    for row in rows:
+        print("  ".join(value.ljust(width) for value, width in zip(row, widths)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--dsn", default="postgresql://postgres@localhost:5432/airflow")
+    parser.add_argument("--scales", default="100,10000,100000",
+                        help="число таблиц в базе MSSQL проекта, через запятую")
+    parser.add_argument("--projects", type=int, default=1000, help="число фоновых проектов")
+    parser.add_argument("--repeat", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument("--memory-repeat", type=int, default=3)
+    parser.add_argument("--only", help="подстрока имени эндпоинта")
+    parser.add_argument("--json", help="записать результаты в файл")
+    parser.add_argument("--baseline", help="результаты прошлого запуска для сравнения")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--keep-data", action="store_true", help="не удалять данные bench_ в конце")
+    args = parser.parse_args(argv)
+    scales = [int(scale) for scale in args.scales.split(",") if scale.strip()]
+
+    work_dir = tempfile.mkdtemp(prefix="atk_ct_bench_")
+    _configure_environment(args, work_dir)
+
+    from airflow.www.app import create_app
+
+    import ct_pool
+    import ct_timing
+
+    server = FakeMssqlServer()
+    for scale in sorted(set(scales + [BACKGROUND_TABLES])):
+        server.add_database(_database_name(scale), scale)
+    ct_pool._FACTORIES["mssql"] = server.connect
+
+    print(f"Seeding {args.projects} projects and scales {scales}...", file=sys.stderr)
+    _seed(args.dsn, scales, args.projects)
+    timers = []
+    listener = timers.append
+    ct_timing.add_listener(listener)
+    try:
+        app = create_app(testing=True)
+        client = app.test_client()
+        results = []
+        for case in build_cases(scales):
+            if args.only and args.only not in case.endpoint:
+                continue
+            print(f"{case.endpoint} [{case.scale}]...", file=sys.stderr)
+            results.append(run_case(client, case, args.repeat, args.warmup, args.memory_repeat, timers))
+    finally:
+        ct_timing.remove_listener(listener)
+        if not args.keep_data:
+            _cleanup(args.dsn)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            print("Regressions:", *regressions, sep="\n  ", file=sys.stderr)
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
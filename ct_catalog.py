@@ -0,0 +1,201 @@
+"""Каталог колонок таблиц MSSQL (atk_ct.ct_column_catalog).
+
+Колонки и первичные ключи всех таблиц базы читаются при обнаружении таблиц
+несколькими запросами на базу (кэш ct_metadata). По снимку для каждой
+таблицы dbo заранее вычисляются типы Postgres и определения колонок для
+CREATE TABLE приемников ODS и HODS; в каталог записываются только таблицы,
+изменившиеся с прошлой синхронизации. Подготовка перекачки берет колонки
+и ключи всех таблиц проекта из каталога одним запросом.
+"""
+import logging
+
+from airflow.configuration import conf
+
+from ct_metadata import metadata_cache
+from ct_pool import pg_connection
+from ct_schema import ensure_schema
+from ct_store import get_catalog_dates, load_catalog, save_catalog
+from ct_transfer import HODS, HODS_COLUMNS, ODS, quote_pg_name, target_table_name
+
+log = logging.getLogger(__name__)
+
+#  [atk_ct] create_target_tables: создавать отсутствующие таблицы приемника перед перекачкой
+CREATE_TARGET_TABLES = conf.getboolean("atk_ct", "create_target_tables", fallback=True)
+
+#  Типы MSSQL, которым соответствует один тип Postgres независимо от длины и точности
+SIMPLE_TYPES = {
+    "bit": "boolean",
+    "tinyint": "smallint",
+    "smallint": "smallint",
+    "int": "integer",
+    "bigint": "bigint",
+    "real": "real",
+    "float": "double precision",
+    "money": "numeric(19,4)",
+    "smallmoney": "numeric(10,4)",
+    "date": "date",
+    "smalldatetime": "timestamp(0)",
+    "datetime": "timestamp(3)",
+    "uniqueidentifier": "uuid",
+    "xml": "xml",
+    "text": "text",
+    "ntext": "text",
+    "binary": "bytea",
+    "varbinary": "bytea",
+    "image": "bytea",
+    "timestamp": "bytea",
+    "rowversion": "bytea",
+}
+
+#  Типы с долями секунды: точность (до 7 знаков в MSSQL, до 6 в Postgres) лежит в scale
+FRACTIONAL_TYPES = {"datetime2": "timestamp", "datetimeoffset": "timestamptz", "time": "time"}
+
+#  Строковые типы: max_length в байтах (для n-типов по 2 байта на символ), -1 означает max
+STRING_TYPES = {"char": "character", "varchar": "varchar", "nchar": "character", "nvarchar": "varchar"}
+
+HODS_COLUMN_TYPES = dict(zip(HODS_COLUMNS, ("bigint", "char(1)")))
+
+EXISTING_TABLES_SQL = """
+    SELECT c.relname
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE n.nspname = %s AND c.relname = ANY(%s) AND c.relkind IN ('r', 'p');
+"""
+
+#  (connection_id, database) -> summary снимка, уже записанного в каталог этим процессом
+_synced = {}
+
+
+def pg_type(column):
+    """Тип Postgres для колонки из снимка ct_metadata; неизвестные типы переносятся как text"""
+    mssql_type = column["type"].lower()
+    if mssql_type in SIMPLE_TYPES:
+        return SIMPLE_TYPES[mssql_type]
+    if mssql_type in ("decimal", "numeric"):
+        return f"numeric({column['precision']},{column['scale']})"
+    if mssql_type in FRACTIONAL_TYPES:
+        return f"{FRACTIONAL_TYPES[mssql_type]}({min(column['scale'], 6)})"
+    if mssql_type in STRING_TYPES:
+        length = column["max_length"]
+        if length == -1:
+            return "text"
+        if mssql_type.startswith("n"):
+            length //= 2
+        return f"{STRING_TYPES[mssql_type]}({length})"
+    return "text"
+
+
+def _column_defs(columns, not_null=True):
+    return ", ".join(
+        f"{quote_pg_name(column['name'])} {column['pg_type']}"
+        + (" NOT NULL" if not_null and not column["nullable"] else "")
+        for column in columns
+    )
+
+
+def catalog_entry(obj):
+    """Запись каталога для таблицы из снимка: колонки с типами Postgres и DDL приемников"""
+    columns = [
+        {"name": column["name"], "type": column["type"], "pg_type": pg_type(column),
+         "nullable": column["nullable"]}
+        for column in obj["columns"]
+    ]
+    key_columns = list(obj["primary_key"])
+    ods_ddl = _column_defs(columns)
+    if key_columns:
+        ods_ddl += f", PRIMARY KEY ({', '.join(quote_pg_name(c) for c in key_columns)})"
+    #  В HODS строки удаления содержат только ключ, поэтому остальные колонки допускают NULL
+    hods_ddl = ", ".join(
+        [f"{quote_pg_name(name)} {pg_type_name} NOT NULL" for name, pg_type_name in HODS_COLUMN_TYPES.items()]
+        + [_column_defs(columns, not_null=False)]
+    )
+    return {
+        "table_name": obj["name"],
+        "columns": columns,
+        "key_columns": key_columns,
+        "ods_ddl": ods_ddl,
+        "hods_ddl": hods_ddl,
+        "modify_date": obj["modify_date"],
+    }
+
+
+def create_table_sql(project, entry):
+    """CREATE TABLE IF NOT EXISTS таблицы приемника проекта по записи каталога"""
+    target_type = (project.get("target_type") or ODS).strip().upper() or ODS
+    ddl = entry["hods_ddl"] if target_type == HODS else entry["ods_ddl"]
+    return f"CREATE TABLE IF NOT EXISTS {target_table_name(project, entry['table_name'])} ({ddl});"
+
+
+def sync_catalog(connection_id, database, snapshot):
+    """Записать в каталог таблицы dbo из снимка, изменившиеся с прошлой синхронизации.
+
+    Возвращает {"upserted", "removed"}; если снимок уже записан этим процессом, ничего не делает.
+    """
+    key = (connection_id, database)
+    if snapshot.summary is not None and _synced.get(key) == snapshot.summary:
+        return {"upserted": 0, "removed": 0}
+    ensure_schema()
+    tables = {
+        obj["name"]: obj for obj in snapshot.objects.values()
+        if obj["type"] == "U" and obj["schema"] == "dbo"
+    }
+    upserted = removed = 0
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            stored = get_catalog_dates(cursor, connection_id, database)
+            changed = [catalog_entry(obj) for name, obj in tables.items() if stored.get(name) != obj["modify_date"]]
+            if changed or any(name not in tables for name in stored):
+                upserted, removed = save_catalog(cursor, connection_id, database, changed, tables)
+        finally:
+            cursor.close()
+        conn.commit()
+    _synced[key] = snapshot.summary
+    if upserted or removed:
+        log.info("Column catalog of %s/%s: %s tables updated, %s removed", connection_id, database, upserted, removed)
+    return {"upserted": upserted, "removed": removed}
+
+
+def _load(connection_id, database, table_names):
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            return load_catalog(cursor, connection_id, database, table_names)
+        finally:
+            cursor.close()
+
+
+def project_catalog(project, table_names):
+    """Записи каталога для таблиц проекта: {table_name: entry}.
+
+    Если каких-то таблиц в каталоге нет (обнаружение еще не запускалось),
+    снимок метаданных обновляется и каталог дописывается.
+    """
+    connection_id, database = project["source_connection_id"], project["ct_database"]
+    ensure_schema()
+    catalog = _load(connection_id, database, table_names)
+    if len(catalog) < len(set(table_names)):
+        snapshot, _ = metadata_cache.refresh(connection_id, database)
+        _synced.pop((connection_id, database), None)
+        sync_catalog(connection_id, database, snapshot)
+        catalog = _load(connection_id, database, table_names)
+    return catalog
+
+
+def ensure_target_tables(project, catalog):
+    """Создать отсутствующие таблицы приемника по DDL из каталога; возвращает имена созданных"""
+    schema = (project.get("target_type") or ODS).strip().lower() or ODS.lower()
+    with pg_connection(project["target_connection_id"], database=project["target_database"]) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(EXISTING_TABLES_SQL, (schema, list(catalog)))
+            existing = {row[0] for row in cursor.fetchall()}
+            missing = [name for name in catalog if name not in existing]
+            if missing:
+                cursor.execute(
+                    f"CREATE SCHEMA IF NOT EXISTS {quote_pg_name(schema)};"
+                    + "".join(create_table_sql(project, catalog[name]) for name in missing)
+                )
+        conn.commit()
+    if missing:
+        log.info("Created %s target tables in %s.%s", len(missing), project["target_database"], schema)
+    return missing
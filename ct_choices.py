@@ -0,0 +1,82 @@
+"""Ленивые провайдеры вариантов выбора для форм плагинов (с TTL-кэшем)"""
+import logging
+import threading
+import time
+
+from airflow.configuration import conf
+
+log = logging.getLogger(__name__)
+
+#  Время жизни закэшированных вариантов (секунды), [atk_ct] choices_cache_ttl
+CHOICES_CACHE_TTL = conf.getint("atk_ct", "choices_cache_ttl", fallback=300)
+
+_providers = {}
+_providers_lock = threading.Lock()
+
+
+class ChoiceProvider:
+    """Вызываемый источник choices для SelectField.
+
+    WTForms вызывает его при создании экземпляра формы, поэтому запрос к
+    источнику выполняется при первом рендере, а не при импорте модуля.
+    Результат кэшируется в процессе и переиспользуется всеми полями,
+    которым передан один и тот же провайдер.
+    """
+
+    def __init__(self, name, loader, ttl=None, placeholder=(" ",)):
+        self.name = name
+        self.loader = loader
+        self.ttl = CHOICES_CACHE_TTL if ttl is None else ttl
+        self.placeholder = list(placeholder)
+        self._lock = threading.Lock()
+        self._value = None
+        self._loaded_at = 0.0
+        with _providers_lock:
+            _providers[name] = self
+
+    def __call__(self):
+        return self.get()
+
+    def _is_fresh(self):
+        return self._value is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def get(self):
+        """Вернуть варианты, загрузив их при отсутствии или устаревании кэша"""
+        if self._is_fresh():
+            return list(self._value)
+        with self._lock:
+            #  Пока ждали блокировку, другой поток мог уже загрузить данные
+            if self._is_fresh():
+                return list(self._value)
+            try:
+                value = list(self.loader())
+            except Exception:
+                log.exception("Failed to load choices '%s'", self.name)
+                #  Отдаем устаревшие данные, если они есть, и пробуем снова при следующем вызове
+                if self._value is not None:
+                    return list(self._value)
+                return list(self.placeholder)
+            self._value = value
+            self._loaded_at = time.monotonic()
+            return list(value)
+
+    def invalidate(self):
+        """Сбросить кэш, следующий вызов перечитает источник"""
+        with self._lock:
+            self._value = None
+            self._loaded_at = 0.0
+
+
+def get_provider(name):
+    return _providers.get(name)
+
+
+def invalidate_choices(name=None):
+    """Сбросить кэш одного провайдера или всех сразу"""
+    with _providers_lock:
+        if name is None:
+            providers = list(_providers.values())
+        else:
+            providers = [_providers[name]] if name in _providers else []
+    for provider in providers:
+        provider.invalidate()
@@ -0,0 +1,111 @@
+"""Индекс conn_id/conn_type подключений Airflow для выпадающих списков.
+
+Из таблицы connection читаются только две колонки (без паролей и extra).
+Индекс живет в процессе connections_cache_ttl секунд и сбрасывается после
+commit сессии, изменившей Connection в этом процессе; изменения из других
+процессов (CLI, другие воркеры вебсервера) становятся видны по TTL.
+"""
+import bisect
+import logging
+import threading
+import time
+
+from airflow.configuration import conf
+from airflow.models import Connection
+from airflow.utils.session import provide_session
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+
+log = logging.getLogger(__name__)
+
+#  [atk_ct] connections_cache_ttl, секунды
+CONNECTIONS_CACHE_TTL = conf.getint("atk_ct", "connections_cache_ttl", fallback=60)
+
+#  Ключ session.info: в сессии менялись подключения
+_CHANGED_KEY = "atk_ct_connections_changed"
+
+
+class ConnectionIndex:
+    """Отсортированный без учета регистра список (conn_id, conn_type) с поиском по префиксу"""
+
+    def __init__(self, ttl=None):
+        self.ttl = CONNECTIONS_CACHE_TTL if ttl is None else ttl
+        self._lock = threading.Lock()
+        self._entries = None
+        self._keys = None
+        self._loaded_at = 0.0
+
+    @staticmethod
+    @provide_session
+    def _load(session=None):
+        rows = session.query(Connection.conn_id, Connection.conn_type).all()
+        return sorted(((conn_id, conn_type) for conn_id, conn_type in rows), key=lambda row: row[0].lower())
+
+    def _is_fresh(self):
+        return self._entries is not None and time.monotonic() - self._loaded_at < self.ttl
+
+    def entries(self):
+        """Все пары (conn_id, conn_type), при устаревании кэша перечитываются из базы"""
+        if self._is_fresh():
+            return self._entries
+        with self._lock:
+            if self._is_fresh():
+                return self._entries
+            entries = self._load()
+            self._keys = [conn_id.lower() for conn_id, _ in entries]
+            self._entries = entries
+            self._loaded_at = time.monotonic()
+            log.debug("Loaded %d Airflow connection ids", len(entries))
+            return entries
+
+    def search(self, prefix="", conn_type=None, limit=None):
+        """Пары с conn_id, начинающимся с prefix (без учета регистра), и типом conn_type"""
+        entries = self.entries()
+        keys = self._keys
+        prefix = (prefix or "").lower()
+        found = []
+        for i in range(bisect.bisect_left(keys, prefix), len(keys)):
+            if not keys[i].startswith(prefix):
+                break
+            if conn_type and entries[i][1] != conn_type:
+                continue
+            found.append(entries[i])
+            if limit and len(found) >= limit:
+                break
+        return found
+
+    def conn_ids(self, prefix="", conn_type=None, limit=None):
+        return [conn_id for conn_id, _ in self.search(prefix, conn_type, limit)]
+
+    def invalidate(self):
+        with self._lock:
+            self._entries = None
+            self._keys = None
+            self._loaded_at = 0.0
+
+
+connection_index = ConnectionIndex()
+
+
+def _mark_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info[_CHANGED_KEY] = True
+
+
+def _after_commit(session):
+    #  Сброс после commit: иначе другой поток мог бы перечитать индекс до фиксации изменений
+    if session.info.pop(_CHANGED_KEY, False):
+        connection_index.invalidate()
+
+
+def _after_rollback(session):
+    session.info.pop(_CHANGED_KEY, None)
+
+
+for _event in ("after_insert", "after_update", "after_delete"):
+    if not event.contains(Connection, _event, _mark_changed):
+        event.listen(Connection, _event, _mark_changed)
+if not event.contains(Session, "after_commit", _after_commit):
+    event.listen(Session, "after_commit", _after_commit)
+    event.listen(Session, "after_rollback", _after_rollback)
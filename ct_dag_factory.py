@@ -0,0 +1,128 @@
+"""Фабрика DAG обновления и перекачки для проектов atk_ct.
+
+При разборе файла Postgres не опрашивается: настройки читаются из
+локального снимка ct_snapshot, который плагин обновляет при сохранении
+проекта и при загрузке. Только если снимка еще нет (первый запуск после
+установки), он строится из Postgres здесь же.
+"""
+import logging
+import re
+from datetime import datetime
+
+from airflow import DAG
+from airflow.configuration import conf
+from airflow.operators.python import PythonOperator
+from croniter import croniter
+
+from ct_snapshot import load_snapshot, refresh_snapshot
+
+log = logging.getLogger(__name__)
+
+DEFAULT_START_DATE = datetime(2024, 1, 1)
+#  [atk_ct] transfer_pool: пул Airflow задач перекачки, например ct_source_{source_connection_id}.
+#  transfer_per_source_limit действует внутри одной задачи, а пул ограничивает число задач,
+#  одновременно читающих один источник; пулы создаются в Airflow заранее
+TRANSFER_POOL = conf.get("atk_ct", "transfer_pool", fallback="")
+
+
+def _dag_id(prefix, project_id):
+    return f"{prefix}__" + re.sub(r"[^A-Za-z0-9_.-]", "_", str(project_id))
+
+
+def _start_date(raw):
+    if not raw:
+        return DEFAULT_START_DATE
+    try:
+        return datetime.fromisoformat(raw)
+    except ValueError:
+        return DEFAULT_START_DATE
+
+
+def _schedule(raw):
+    raw = (raw or "").strip()
+    if not raw:
+        return None
+    if not croniter.is_valid(raw):
+        raise ValueError(f"Invalid schedule '{raw}'")
+    return raw
+
+
+def _transfer_pool(project):
+    """Параметры пула для задачи перекачки проекта (пусто, если пул не настроен)"""
+    if not TRANSFER_POOL:
+        return {}
+    return {"pool": TRANSFER_POOL.format(**project)}
+
+
+def update_project_tables(project_id):
+    """Задача DAG: обновить список таблиц проекта в atk_ct.ct_tables"""
+    from ct_discovery import update_project_tables as update_tables
+
+    return update_tables(project_id)
+
+
+def transfer_project(project_id, tables=None):
+    """Задача DAG: выгрузить изменения таблиц проекта в приемник.
+
+    Без tables список таблиц с load = true читается из ct_tables в момент запуска.
+    """
+    from ct_parallel import run_parallel_transfer
+
+    result = run_parallel_transfer(project_id, tables=tables)
+    if result["errors"]:
+        raise RuntimeError(f"Transfer failed for tables: {', '.join(sorted(result['errors']))}")
+    return result
+
+
+def build_project_dags(project):
+    """DAG обновления (и перекачки, если transfer_source_data) для одного проекта"""
+    project_id = project["ct_project_id"]
+    tags = ["atk_ct", str(project_id)]
+    dags = []
+
+    with DAG(
+        dag_id=_dag_id("ct_update", project_id),
+        start_date=_start_date(project.get("update_dags_start_date")),
+        schedule=_schedule(project.get("update_dags_schedule")),
+        catchup=False,
+        max_active_runs=1,
+        tags=tags,
+    ) as update_dag:
+        PythonOperator(
+            task_id="update_tables",
+            python_callable=update_project_tables,
+            op_kwargs={"project_id": project_id},
+        )
+    dags.append(update_dag)
+
+    if project.get("transfer_source_data"):
+        with DAG(
+            dag_id=_dag_id("ct_transfer", project_id),
+            start_date=_start_date(project.get("transfer_dags_start_date")),
+            schedule=_schedule(project.get("transfer_dags_schedule")),
+            catchup=False,
+            max_active_runs=1,
+            tags=tags,
+        ) as transfer_dag:
+            PythonOperator(
+                task_id="transfer_tables",
+                python_callable=transfer_project,
+                op_kwargs={"project_id": project_id},
+                **_transfer_pool(project),
+            )
+        dags.append(transfer_dag)
+    return dags
+
+
+snapshot = load_snapshot()
+if snapshot is None:
+    snapshot = refresh_snapshot()
+if snapshot is None:
+    log.warning("atk_ct project config snapshot not found, no project DAGs generated")
+else:
+    for ct_project in snapshot["projects"]:
+        try:
+            for project_dag in build_project_dags(ct_project):
+                globals()[project_dag.dag_id] = project_dag
+        except Exception:
+            log.exception("Failed to build DAGs for project %s", ct_project.get("ct_project_id"))
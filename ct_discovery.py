@@ -0,0 +1,183 @@
+"""Получение списка таблиц проекта из MSSQL и его сохранение в atk_ct.ct_tables"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from airflow.configuration import conf
+
+from ct_catalog import sync_catalog
+from ct_metadata import metadata_cache
+from ct_pool import pg_connection
+from ct_store import get_project, list_projects, prune_table_tombstones, sync_tables, sync_tables_bulk
+
+log = logging.getLogger(__name__)
+
+DISCOVERY_JOB = "table_discovery"
+REFRESH_ALL_JOB = "refresh_all_projects"
+
+REFRESH_MAX_WORKERS = conf.getint("atk_ct", "refresh_max_workers", fallback=8)
+#  Не больше стольких одновременных запросов метаданных к одному подключению MSSQL
+REFRESH_PER_CONNECTION_LIMIT = conf.getint("atk_ct", "refresh_per_connection_limit", fallback=2)
+#  Сколько дней хранятся метки удаленных таблиц для /changes_since
+TOMBSTONE_RETENTION_DAYS = conf.getint("atk_ct", "tombstone_retention_days", fallback=7)
+
+
+def resolve_database(project_id, database=None):
+    """База, в которой ищутся таблицы: явно переданная или ct_database проекта"""
+    if database and database.strip():
+        return database.strip()
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            project = get_project(cursor, project_id)
+        finally:
+            cursor.close()
+    if project is None:
+        raise ValueError(f"Project '{project_id}' not found")
+    return project_database(project)
+
+
+def project_database(project):
+    """ct_database уже прочитанного проекта (ошибка, если не задана)"""
+    database = (project.get("ct_database") or "").strip()
+    if not database:
+        raise ValueError(f"Project '{project['ct_project_id']}' has no CT database")
+    return database
+
+
+def discover_tables(connection_id, database, with_diff=False):
+    """Имена базовых таблиц схемы dbo в базе MSSQL (через кэш метаданных).
+
+    Колонки и ключи изменившихся таблиц попадают в каталог колонок (ct_catalog).
+    С with_diff=True возвращает (table_names, diff) с изменениями с прошлого обновления.
+    """
+    snapshot, diff = metadata_cache.refresh(connection_id, database)
+    sync_catalog(connection_id, database, snapshot)
+    table_names = snapshot.tables(schema="dbo")
+    if with_diff:
+        return table_names, diff
+    return table_names
+
+
+def run_table_discovery(job, project_id, connection_id, database):
+    """Прочитать таблицы из MSSQL и синхронизировать ct_tables (job может быть None)"""
+    if job is not None:
+        job.update(progress=0.05, message=f"Reading table list from {database}")
+    table_names, diff = discover_tables(connection_id, database, with_diff=True)
+    if job is not None:
+        job.update(progress=0.7, message=f"Found {len(table_names)} tables, saving")
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            result = sync_tables(cursor, project_id, table_names)
+        finally:
+            cursor.close()
+        conn.commit()
+    result["tables"] = len(table_names)
+    result["database"] = database
+    result["metadata"] = {name: len(objects) for name, objects in diff.items()}
+    return result
+
+
+def update_project_tables(project_id):
+    """Обновить список таблиц проекта по его source_connection_id и ct_database"""
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            project = get_project(cursor, project_id)
+        finally:
+            cursor.close()
+    if project is None:
+        raise ValueError(f"Project '{project_id}' not found")
+    return run_table_discovery(None, project_id, project["source_connection_id"], project_database(project))
+
+
+def _discover_limited(semaphore, connection_id, database):
+    with semaphore:
+        return discover_tables(connection_id, database)
+
+
+def refresh_all_projects(job=None, max_workers=None, per_connection_limit=None):
+    """Обновить списки таблиц всех проектов.
+
+    Каждая пара (source_connection_id, ct_database) опрашивается один раз,
+    пары обрабатываются параллельно, но не больше per_connection_limit
+    одновременных запросов к одному подключению MSSQL. Результаты
+    записываются в ct_tables одним запросом.
+    """
+    max_workers = max_workers or REFRESH_MAX_WORKERS
+    per_connection_limit = per_connection_limit or REFRESH_PER_CONNECTION_LIMIT
+
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            projects = list_projects(cursor)
+        finally:
+            cursor.close()
+
+    targets = {}
+    skipped = []
+    for project in projects:
+        connection_id = (project["source_connection_id"] or "").strip()
+        database = (project["ct_database"] or "").strip()
+        if not connection_id or not database:
+            skipped.append(project["ct_project_id"])
+            continue
+        targets.setdefault((connection_id, database), []).append(project["ct_project_id"])
+
+    semaphores = {connection_id: threading.BoundedSemaphore(per_connection_limit)
+                  for connection_id, _ in targets}
+    #  Чередуем подключения, чтобы потоки не простаивали на семафоре одного сервера
+    by_connection = {}
+    for connection_id, database in targets:
+        by_connection.setdefault(connection_id, []).append(database)
+    order = [
+        (connection_id, databases[i])
+        for i in range(max((len(d) for d in by_connection.values()), default=0))
+        for connection_id, databases in by_connection.items()
+        if i < len(databases)
+    ]
+
+    tables_by_project = {}
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ct_refresh") as executor:
+        futures = {
+            executor.submit(_discover_limited, semaphores[connection_id], connection_id, database):
+                (connection_id, database)
+            for connection_id, database in order
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            connection_id, database = futures[future]
+            try:
+                table_names = future.result()
+            except Exception as e:
+                log.exception("Discovery failed for %s/%s", connection_id, database)
+                for project_id in targets[(connection_id, database)]:
+                    errors[project_id] = str(e)
+            else:
+                for project_id in targets[(connection_id, database)]:
+                    tables_by_project[project_id] = table_names
+            if job is not None:
+                job.update(progress=0.9 * done / len(futures),
+                           message=f"Discovered {done} of {len(futures)} databases")
+
+    if job is not None:
+        job.update(message=f"Saving tables of {len(tables_by_project)} projects")
+    results = {}
+    if tables_by_project:
+        with pg_connection() as conn:
+            cursor = conn.cursor()
+            try:
+                results = sync_tables_bulk(cursor, tables_by_project)
+                prune_table_tombstones(cursor, TOMBSTONE_RETENTION_DAYS)
+            finally:
+                cursor.close()
+            conn.commit()
+
+    return {
+        "projects": len(projects),
+        "databases": len(targets),
+        "synced": results,
+        "errors": errors,
+        "skipped": skipped,
+    }
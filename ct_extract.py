@@ -0,0 +1,274 @@
+"""Инкрементальная выгрузка изменений из MSSQL по Change Tracking.
+
+Для каждой таблицы проекта с load = true хранится последняя выгруженная
+версия (atk_ct.ct_sync_state). Следующий запуск читает только
+CHANGETABLE(CHANGES ...) после этой версии; если версия старше
+CHANGE_TRACKING_MIN_VALID_VERSION (изменения уже удалены по retention),
+таблица выгружается полностью.
+
+Данные передаются приемнику (sink) пачками строк, версия сохраняется
+только после того, как приемник успешно обработал все пачки.
+"""
+import logging
+import time
+
+from airflow.configuration import conf
+
+from ct_metadata import metadata_cache, quote_mssql_name
+from ct_pool import mssql_connection, pg_connection
+from ct_schema import ensure_schema
+from ct_store import get_project, list_load_tables
+
+log = logging.getLogger(__name__)
+
+EXTRACT_CHUNK_SIZE = conf.getint("atk_ct", "extract_chunk_size", fallback=10000)
+
+FULL = "full"
+INCREMENTAL = "incremental"
+UNCHANGED = "unchanged"
+
+#  Служебные колонки, которые идут перед колонками таблицы в инкрементальном режиме
+CHANGE_COLUMNS = ("_ct_version", "_ct_operation")
+
+VERSIONS_SQL = """
+    SELECT CHANGE_TRACKING_CURRENT_VERSION(),
+           CHANGE_TRACKING_MIN_VALID_VERSION(OBJECT_ID(%s));
+"""
+
+PRIMARY_KEY_SQL = """
+    SELECT c.name
+    FROM sys.indexes i
+    JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+    JOIN sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+    WHERE i.object_id = OBJECT_ID(%s) AND i.is_primary_key = 1
+    ORDER BY ic.key_ordinal;
+"""
+
+#  Минимальные допустимые версии сразу всех отслеживаемых таблиц dbo
+TRACKED_TABLES_SQL = """
+    SELECT t.name, ctt.min_valid_version
+    FROM sys.change_tracking_tables ctt
+    JOIN sys.tables t ON t.object_id = ctt.object_id
+    WHERE t.schema_id = SCHEMA_ID('dbo');
+"""
+
+GET_STATE_SQL = """
+    SELECT table_name, last_version
+    FROM atk_ct.ct_sync_state
+    WHERE project_id = %s;
+"""
+
+SAVE_STATE_SQL = """
+    INSERT INTO atk_ct.ct_sync_state (project_id, table_name, last_version, last_mode, rows_synced, synced_at)
+    VALUES (%s, %s, %s, %s, %s, now())
+    ON CONFLICT (project_id, table_name) DO UPDATE
+    SET last_version = EXCLUDED.last_version,
+        last_mode = EXCLUDED.last_mode,
+        rows_synced = EXCLUDED.rows_synced,
+        synced_at = EXCLUDED.synced_at;
+"""
+
+
+class ChangeTrackingError(Exception):
+    """Таблицу нельзя выгрузить через Change Tracking"""
+
+
+class ExtractSpec:
+    """Описание выгрузки одной таблицы, передается приемнику вместе с данными.
+
+    В режиме full строки содержат колонки columns, в режиме incremental
+    перед ними идут CHANGE_COLUMNS (версия и операция I/U/D; для D
+    заполнены только ключевые колонки).
+    """
+
+    def __init__(self, project, table_name, mode, columns, key_columns, from_version, to_version):
+        self.project = project
+        self.project_id = project["ct_project_id"]
+        self.table_name = table_name
+        self.mode = mode
+        self.columns = columns
+        self.key_columns = key_columns
+        self.from_version = from_version
+        self.to_version = to_version
+
+    @property
+    def row_columns(self):
+        return list(CHANGE_COLUMNS) + self.columns if self.mode == INCREMENTAL else list(self.columns)
+
+
+def _iter_chunks(cursor, chunk_size):
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def table_column_info(connection_id, database, table_name):
+    """Колонки таблицы из кэша метаданных: [{"name", "type", ...}]"""
+    snapshot = metadata_cache.get(connection_id, database)
+    _, obj = snapshot.find(table_name) if snapshot else (None, None)
+    if obj is None or not obj["columns"]:
+        snapshot, _ = metadata_cache.refresh(connection_id, database)
+        _, obj = snapshot.find(table_name)
+    if obj is None:
+        raise ChangeTrackingError(f"Table dbo.{table_name} not found in {database}")
+    return obj["columns"]
+
+
+def _table_columns(connection_id, database, table_name):
+    return [column["name"] for column in table_column_info(connection_id, database, table_name)]
+
+
+def _fetch_one(cursor, sql, params):
+    cursor.execute(sql, params)
+    return cursor.fetchone()
+
+
+def load_sync_state(project_id):
+    """Последние выгруженные версии таблиц проекта: {table_name: version}"""
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(GET_STATE_SQL, (project_id, ))
+            return dict(cursor.fetchall())
+        finally:
+            cursor.close()
+
+
+def save_sync_state(project_id, table_name, version, mode, rows):
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(SAVE_STATE_SQL, (project_id, table_name, version, mode, rows))
+        finally:
+            cursor.close()
+        conn.commit()
+
+
+def tracking_versions(project):
+    """Текущая версия Change Tracking базы проекта и {table_name: min_valid_version} одним соединением"""
+    with mssql_connection(project["source_connection_id"], database=project["ct_database"]) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT CHANGE_TRACKING_CURRENT_VERSION();")
+            current_version = cursor.fetchone()[0]
+            cursor.execute(TRACKED_TABLES_SQL)
+            return current_version, dict(cursor.fetchall())
+        finally:
+            cursor.close()
+
+
+def build_spec(project, table_name, last_version, current_version, min_valid_version, key_columns, columns):
+    """ExtractSpec по уже прочитанным версиям, ключу и колонкам (без запросов к MSSQL)"""
+    object_name = f"dbo.{quote_mssql_name(table_name)}"
+    if min_valid_version is None:
+        raise ChangeTrackingError(f"Change tracking is not enabled for {object_name} in {project['ct_database']}")
+
+    if last_version is not None and last_version == current_version:
+        mode = UNCHANGED
+    elif last_version is None or last_version < min_valid_version:
+        mode = FULL
+    else:
+        mode = INCREMENTAL
+
+    if mode == INCREMENTAL and not key_columns:
+        raise ChangeTrackingError(f"{object_name} has no primary key")
+    columns = list(columns) if mode != UNCHANGED else []
+    return ExtractSpec(project, table_name, mode, columns, key_columns, last_version, current_version)
+
+
+def _describe(cursor, project, table_name, last_version):
+    """Режим выгрузки, текущая версия и колонки таблицы (запросы на соединении с ct_database)"""
+    object_name = f"dbo.{quote_mssql_name(table_name)}"
+    current_version, min_valid_version = _fetch_one(cursor, VERSIONS_SQL, (object_name, ))
+    cursor.execute(PRIMARY_KEY_SQL, (object_name, ))
+    key_columns = [row[0] for row in cursor.fetchall()]
+    unchanged = last_version is not None and last_version == current_version
+    columns = [] if unchanged else _table_columns(project["source_connection_id"], project["ct_database"], table_name)
+    return build_spec(project, table_name, last_version, current_version, min_valid_version, key_columns, columns)
+
+
+def describe_table(project, table_name, last_version=None):
+    """ExtractSpec таблицы без чтения данных"""
+    with mssql_connection(project["source_connection_id"], database=project["ct_database"]) as conn:
+        cursor = conn.cursor()
+        try:
+            return _describe(cursor, project, table_name, last_version)
+        finally:
+            cursor.close()
+
+
+def extract_table(project, table_name, sink, last_version=None, chunk_size=None, spec=None):
+    """Выгрузить изменения одной таблицы в sink(spec, chunks) и сохранить новую версию.
+
+    sink получает ExtractSpec и итератор пачек строк и возвращает число обработанных строк.
+    spec, подготовленный заранее (build_spec), избавляет от запросов метаданных перед чтением.
+    """
+    chunk_size = chunk_size or EXTRACT_CHUNK_SIZE
+    object_name = f"dbo.{quote_mssql_name(table_name)}"
+    started = time.monotonic()
+
+    with mssql_connection(project["source_connection_id"], database=project["ct_database"]) as conn:
+        cursor = conn.cursor()
+        try:
+            #  Текущая версия фиксируется до чтения данных: изменения, сделанные во время
+            #  выгрузки, попадут в следующий запуск (приемник применяет их идемпотентно)
+            if spec is None:
+                spec = _describe(cursor, project, table_name, last_version)
+            if spec.mode == UNCHANGED:
+                return {"table": table_name, "mode": UNCHANGED, "rows": 0, "version": spec.to_version,
+                        "seconds": round(time.monotonic() - started, 3)}
+
+            if spec.mode == FULL:
+                select_list = ", ".join(f"T.{quote_mssql_name(c)}" for c in spec.columns)
+                cursor.execute(f"SELECT {select_list} FROM {object_name} AS T;")
+            else:
+                select_list = ", ".join(
+                    f"CT.{quote_mssql_name(c)}" if c in spec.key_columns else f"T.{quote_mssql_name(c)}"
+                    for c in spec.columns
+                )
+                join = " AND ".join(
+                    f"T.{quote_mssql_name(c)} = CT.{quote_mssql_name(c)}" for c in spec.key_columns
+                )
+                cursor.execute(
+                    f"SELECT CT.SYS_CHANGE_VERSION, CT.SYS_CHANGE_OPERATION, {select_list} "
+                    f"FROM CHANGETABLE(CHANGES {object_name}, %s) AS CT "
+                    f"LEFT JOIN {object_name} AS T ON {join} "
+                    f"ORDER BY CT.SYS_CHANGE_VERSION;",
+                    (last_version, )
+                )
+            rows = sink(spec, _iter_chunks(cursor, chunk_size))
+        finally:
+            cursor.close()
+
+    save_sync_state(spec.project_id, table_name, spec.to_version, spec.mode, rows)
+    seconds = time.monotonic() - started
+    log.info("Extracted %s rows of %s (%s, version %s -> %s) in %.2fs",
+             rows, table_name, spec.mode, last_version, spec.to_version, seconds)
+    return {"table": table_name, "mode": spec.mode, "rows": rows, "version": spec.to_version,
+            "seconds": round(seconds, 3)}
+
+
+def run_project_extraction(project_id, sink, tables=None, chunk_size=None):
+    """Выгрузить все отмеченные таблицы проекта; ошибка одной таблицы не останавливает остальные"""
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            project = get_project(cursor, project_id)
+            if project is None:
+                raise ValueError(f"Project '{project_id}' not found")
+            table_names = tables if tables is not None else list_load_tables(cursor, project_id)
+        finally:
+            cursor.close()
+
+    ensure_schema()
+    state = load_sync_state(project_id)
+    results, errors = [], {}
+    for table_name in table_names:
+        try:
+            results.append(extract_table(project, table_name, sink, state.get(table_name), chunk_size))
+        except Exception as e:
+            log.exception("Extraction of %s.%s failed", project_id, table_name)
+            errors[table_name] = str(e)
+    return {"project_id": project_id, "tables": results, "errors": errors}
@@ -0,0 +1,143 @@
+"""HTTP-кэширование плагинов atk_ct: статика с хэшем в URL и условные GET.
+
+Статика отдается по адресу с хэшем содержимого файла, поэтому ее можно
+кэшировать навсегда (immutable): после обновления файла меняется URL.
+Сжатые варианты (gzip и, если установлен пакет brotli, br) готовятся один
+раз на версию файла и лежат в static_cache_dir.
+
+Данные (fetch_data, список проектов) получают ETag из счетчика изменений
+atk_ct.ct_change_counters, который поддерживают триггеры на ct_tables и
+ct_projects; если данные не менялись, браузер получает 304 без запроса к
+таблицам.
+"""
+import gzip
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+
+from airflow.configuration import conf
+from flask import Response, abort, redirect, request, send_file, url_for
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+STATIC_CACHE_DIR = conf.get(
+    "atk_ct", "static_cache_dir", fallback=os.path.join(tempfile.gettempdir(), "atk_ct_static")
+)
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+#  Данные можно хранить в кэше браузера, но перед использованием он обязан спросить сервер
+REVALIDATE_CACHE_CONTROL = "private, no-cache"
+#  Файлы меньше этого размера не сжимаются
+MIN_COMPRESS_SIZE = 1024
+
+_ENCODINGS = [("br", ".br"), ("gzip", ".gz")] if brotli is not None else [("gzip", ".gz")]
+
+
+class StaticAssets:
+    """Статика одного каталога с URL вида <prefix>/<digest>/<filename>"""
+
+    def __init__(self, folder, cache_dir=None):
+        self.folder = os.path.abspath(folder)
+        self.cache_dir = cache_dir or STATIC_CACHE_DIR
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def path(self, filename):
+        path = os.path.abspath(os.path.join(self.folder, filename))
+        if not path.startswith(self.folder + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    def digest(self, filename):
+        """Хэш содержимого файла (пересчитывается только при изменении mtime/размера)"""
+        path = self.path(filename)
+        if path is None:
+            return None
+        stat = os.stat(path)
+        key = (stat.st_mtime_ns, stat.st_size)
+        cached = self._digests.get(filename)
+        if cached and cached[0] == key:
+            return cached[1]
+        with open(path, "rb") as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:16]
+        self._digests[filename] = (key, digest)
+        return digest
+
+    def _compressed(self, filename, digest, encoding, suffix):
+        """Путь к сжатому варианту файла (None для маленьких); создается при первом запросе"""
+        #  Размер берется из stat: маленькие файлы не читаются и не сжимаются на каждый запрос
+        if os.path.getsize(self.path(filename)) < MIN_COMPRESS_SIZE:
+            return None
+        target = os.path.join(self.cache_dir, digest + "-" + os.path.basename(filename) + suffix)
+        if os.path.exists(target):
+            return target
+        with self._lock:
+            if os.path.exists(target):
+                return target
+            with open(self.path(filename), "rb") as f:
+                data = f.read()
+            data = brotli.compress(data) if encoding == "br" else gzip.compress(data, compresslevel=9)
+            os.makedirs(self.cache_dir, exist_ok=True)
+            tmp_path = f"{target}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, target)
+            return target
+
+    def precompress(self):
+        """Подготовить сжатые варианты всех файлов каталога (например, при старте)"""
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                filename = os.path.relpath(os.path.join(root, name), self.folder)
+                digest = self.digest(filename)
+                for encoding, suffix in _ENCODINGS:
+                    self._compressed(filename, digest, encoding, suffix)
+
+    def serve(self, digest, filename, endpoint):
+        """Ответ для <digest>/<filename>; устаревший хэш перенаправляется на актуальный URL"""
+        current = self.digest(filename)
+        if current is None:
+            abort(404)
+        if digest != current:
+            return redirect(url_for(endpoint, digest=current, filename=filename))
+
+        path, encoding = self.path(filename), None
+        accepted = request.accept_encodings
+        for candidate, suffix in _ENCODINGS:
+            if accepted[candidate]:
+                compressed = self._compressed(filename, digest, candidate, suffix)
+                if compressed is not None:
+                    path, encoding = compressed, candidate
+                break
+
+        response = send_file(path, download_name=os.path.basename(filename), conditional=True, etag=False)
+        if encoding:
+            response.headers["Content-Encoding"] = encoding
+        response.headers["Vary"] = "Accept-Encoding"
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        response.set_etag(f"{digest}-{encoding or 'identity'}")
+        return response.make_conditional(request)
+
+
+def etag_value(*parts):
+    return hashlib.sha1("\0".join(str(part) for part in parts).encode("utf-8")).hexdigest()[:20]
+
+
+def not_modified(etag):
+    """Ответ 304, если у клиента актуальная версия с этим ETag, иначе None"""
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        return with_etag(response, etag)
+    return None
+
+
+def with_etag(response, etag):
+    response.set_etag(etag, weak=True)
+    response.headers["Cache-Control"] = REVALIDATE_CACHE_CONTROL
+    return response
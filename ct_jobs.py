@@ -0,0 +1,217 @@
+"""Фоновые задачи вебсервера (пул потоков) с опросом статуса.
+
+Задачи выполняются в воркере, который их запустил. Повторный запуск
+с тем же ключом, пока задача не завершилась, возвращает уже существующую задачу.
+Состояние задачи пишется в atk_ct.ct_jobs (ход выполнения - не чаще раза
+в JOBS_SAVE_INTERVAL секунд), поэтому опрос статуса, попавший на другой
+воркер вебсервера, читает его из базы.
+"""
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from airflow.configuration import conf
+
+from ct_pool import pg_connection
+from ct_schema import ensure_schema
+from ct_store import load_job, prune_jobs, save_job
+
+log = logging.getLogger(__name__)
+
+JOBS_MAX_WORKERS = conf.getint("atk_ct", "jobs_max_workers", fallback=4)
+#  Сколько секунд хранить завершенные задачи для опроса статуса
+JOBS_RETENTION = conf.getint("atk_ct", "jobs_retention", fallback=900)
+#  Не чаще раза в столько секунд ход выполнения записывается в базу
+JOBS_SAVE_INTERVAL = conf.getfloat("atk_ct", "jobs_save_interval", fallback=1.0)
+#  Незавершенная задача, которая столько секунд не обновлялась, считается потерянной (воркер перезапущен)
+JOBS_STALE_AFTER = conf.getint("atk_ct", "jobs_stale_after", fallback=1800)
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCESS = "success"
+FAILED = "failed"
+
+
+class Job:
+    """Состояние одной фоновой задачи"""
+
+    def __init__(self, kind, key):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.key = key
+        self.state = QUEUED
+        self.progress = 0.0
+        self.message = ""
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._saved_at = 0.0
+
+    @classmethod
+    def from_dict(cls, data):
+        """Задача, прочитанная из atk_ct.ct_jobs (запущена другим воркером)"""
+        job = cls(data["kind"], None)
+        job.id = data["job_id"]
+        job.state = data["state"]
+        job.progress = data["progress"]
+        job.message = data["message"] or ""
+        job.result = data["result"]
+        job.error = data["error"]
+        job.created_at = data["created_at"]
+        job.finished_at = data["finished_at"]
+        return job
+
+    def update(self, progress=None, message=None):
+        """Сообщить о ходе выполнения (progress от 0 до 1)"""
+        with self._lock:
+            if progress is not None:
+                self.progress = max(0.0, min(1.0, float(progress)))
+            if message is not None:
+                self.message = message
+        self.save()
+
+    def save(self, force=False):
+        """Записать состояние в базу; без force - не чаще раза в JOBS_SAVE_INTERVAL секунд.
+
+        Ошибка записи только логируется: задача продолжает выполняться.
+        """
+        now = time.monotonic()
+        if not force and now - self._saved_at < JOBS_SAVE_INTERVAL:
+            return
+        self._saved_at = now
+        try:
+            if not ensure_schema(wait=False):
+                return
+            with pg_connection() as conn:
+                with conn.cursor() as cursor:
+                    save_job(cursor, self.to_dict(), repr(self.key))
+                conn.commit()
+        except Exception:
+            log.warning("Failed to save state of job %s %s", self.kind, self.id, exc_info=True)
+
+    @property
+    def done(self):
+        return self.state in (SUCCESS, FAILED)
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "job_id": self.id,
+                "kind": self.kind,
+                "state": self.state,
+                "progress": round(self.progress, 3),
+                "message": self.message,
+                "result": self.result,
+                "error": self.error,
+                "created_at": self.created_at,
+                "finished_at": self.finished_at,
+            }
+
+
+class JobManager:
+    """Запуск задач в пуле потоков с объединением дубликатов по ключу"""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or JOBS_MAX_WORKERS
+        self._executor = None
+        self._jobs = {}
+        self._active = {}
+        self._lock = threading.Lock()
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="ct_job")
+        return self._executor
+
+    def _purge(self):
+        deadline = time.time() - JOBS_RETENTION
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.done and (job.finished_at or 0) < deadline]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+    def submit(self, kind, key, func, *args, **kwargs):
+        """Запустить func(job, *args, **kwargs) или вернуть активную задачу с тем же ключом.
+
+        Возвращает (job, created).
+        """
+        active_key = (kind, key)
+        with self._lock:
+            self._purge()
+            job = self._active.get(active_key)
+            if job is not None and not job.done:
+                return job, False
+            job = Job(kind, key)
+            self._jobs[job.id] = job
+            self._active[active_key] = job
+        #  Запись в базу до ответа клиенту: первый опрос может попасть на другой воркер
+        job.save(force=True)
+        with self._lock:
+            executor = self._get_executor()
+        executor.submit(self._run, job, func, args, kwargs)
+        return job, True
+
+    def _run(self, job, func, args, kwargs):
+        job.state = RUNNING
+        job.save(force=True)
+        try:
+            result = func(job, *args, **kwargs)
+        except Exception as e:
+            log.exception("Background job %s %s failed", job.kind, job.key)
+            with job._lock:
+                job.error = str(e)
+                job.finished_at = time.time()
+                job.state = FAILED
+        else:
+            with job._lock:
+                job.result = result
+                job.progress = 1.0
+                job.finished_at = time.time()
+                job.state = SUCCESS
+        finally:
+            job.save(force=True)
+            with self._lock:
+                if self._active.get((job.kind, job.key)) is job:
+                    del self._active[(job.kind, job.key)]
+            self._prune_saved()
+
+    def _prune_saved(self):
+        try:
+            with pg_connection() as conn:
+                with conn.cursor() as cursor:
+                    prune_jobs(cursor, JOBS_RETENTION)
+                conn.commit()
+        except Exception:
+            log.warning("Failed to prune saved jobs", exc_info=True)
+
+    def get(self, job_id):
+        """Задача этого воркера или, если ее здесь нет, прочитанная из базы; None, если задачи нет"""
+        if not job_id:
+            return None
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is not None:
+            return job
+        if not ensure_schema(wait=False):
+            return None
+        with pg_connection() as conn:
+            with conn.cursor() as cursor:
+                data, idle = load_job(cursor, job_id)
+        if data is None:
+            return None
+        job = Job.from_dict(data)
+        if not job.done and idle > JOBS_STALE_AFTER:
+            job.state = FAILED
+            job.error = f"Job was not updated for {int(idle)}s, the webserver worker running it was probably restarted"
+        return job
+
+    def find_active(self, kind, key):
+        with self._lock:
+            return self._active.get((kind, key))
+
+
+job_manager = JobManager()
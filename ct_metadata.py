@@ -0,0 +1,272 @@
+"""Инкрементальный кэш метаданных MSSQL (таблицы, представления, колонки, первичные ключи).
+
+Снимок хранится по ключу (conn_id, database) в памяти процесса и в JSON-файле,
+чтобы им пользовались и вебсервер, и задачи DAG. При обновлении из MSSQL
+читаются только объекты, измененные после прошлого снимка.
+"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+from airflow.configuration import conf
+
+from ct_pool import mssql_connection
+
+log = logging.getLogger(__name__)
+
+METADATA_CACHE_DIR = conf.get(
+    "atk_ct", "metadata_cache_dir", fallback=os.path.join(tempfile.gettempdir(), "atk_ct_metadata")
+)
+
+#  Одна строка: хватает, чтобы понять, что в базе ничего не менялось
+SUMMARY_SQL = """
+    SELECT COUNT(*), CHECKSUM_AGG(o.object_id), MAX(o.modify_date)
+    FROM {db}.sys.objects o
+    WHERE o.type IN ('U', 'V') AND o.is_ms_shipped = 0;
+"""
+
+OBJECT_IDS_SQL = """
+    SELECT o.object_id
+    FROM {db}.sys.objects o
+    WHERE o.type IN ('U', 'V') AND o.is_ms_shipped = 0;
+"""
+
+CHANGED_OBJECTS_SQL = """
+    SELECT o.object_id, s.name, o.name, o.type, o.modify_date
+    FROM {db}.sys.objects o
+    JOIN {db}.sys.schemas s ON s.schema_id = o.schema_id
+    WHERE o.type IN ('U', 'V') AND o.is_ms_shipped = 0
+      AND o.modify_date >= %s;
+"""
+
+CHANGED_COLUMNS_SQL = """
+    SELECT c.object_id, c.column_id, c.name, t.name, c.max_length, c.precision, c.scale, c.is_nullable
+    FROM {db}.sys.columns c
+    JOIN {db}.sys.objects o ON o.object_id = c.object_id
+    JOIN {db}.sys.types t ON t.user_type_id = c.user_type_id
+    WHERE o.type IN ('U', 'V') AND o.is_ms_shipped = 0
+      AND o.modify_date >= %s
+    ORDER BY c.object_id, c.column_id;
+"""
+
+CHANGED_PRIMARY_KEYS_SQL = """
+    SELECT ic.object_id, c.name
+    FROM {db}.sys.indexes i
+    JOIN {db}.sys.objects o ON o.object_id = i.object_id
+    JOIN {db}.sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+    JOIN {db}.sys.columns c ON c.object_id = ic.object_id AND c.column_id = ic.column_id
+    WHERE i.is_primary_key = 1 AND o.type = 'U' AND o.is_ms_shipped = 0
+      AND o.modify_date >= %s
+    ORDER BY ic.object_id, ic.key_ordinal;
+"""
+
+_EPOCH = datetime(1900, 1, 1)
+
+
+def quote_mssql_name(name):
+    """Экранирование идентификатора MSSQL: [name]"""
+    return "[" + str(name).replace("]", "]]") + "]"
+
+
+class MetadataSnapshot:
+    """Снимок метаданных одной базы"""
+
+    def __init__(self, conn_id, database, objects=None, summary=None, refreshed_at=None):
+        self.conn_id = conn_id
+        self.database = database
+        #  object_id -> {"schema", "name", "type", "modify_date", "columns", "primary_key"}
+        self.objects = objects or {}
+        self.summary = summary
+        self.refreshed_at = refreshed_at
+
+    @property
+    def max_modify_date(self):
+        dates = [obj["modify_date"] for obj in self.objects.values()]
+        return max(dates) if dates else None
+
+    def tables(self, schema="dbo", types=("U",)):
+        """Имена объектов схемы указанных типов (по умолчанию пользовательские таблицы)"""
+        return sorted(
+            obj["name"] for obj in self.objects.values()
+            if obj["type"] in types and (schema is None or obj["schema"] == schema)
+        )
+
+    def find(self, name, schema="dbo"):
+        for object_id, obj in self.objects.items():
+            if obj["name"] == name and obj["schema"] == schema:
+                return object_id, obj
+        return None, None
+
+    def to_json(self):
+        return json.dumps({
+            "conn_id": self.conn_id,
+            "database": self.database,
+            "summary": self.summary,
+            "refreshed_at": self.refreshed_at,
+            "objects": [
+                dict(obj, object_id=object_id, modify_date=obj["modify_date"].isoformat())
+                for object_id, obj in self.objects.items()
+            ],
+        })
+
+    @classmethod
+    def from_json(cls, raw):
+        data = json.loads(raw)
+        objects = {}
+        for obj in data["objects"]:
+            object_id = obj.pop("object_id")
+            #  Снимки без первичных ключей (старый формат) перечитываются целиком
+            if "primary_key" not in obj:
+                raise KeyError("primary_key")
+            obj["modify_date"] = datetime.fromisoformat(obj["modify_date"])
+            objects[object_id] = obj
+        return cls(data["conn_id"], data["database"], objects, data.get("summary"), data.get("refreshed_at"))
+
+
+def _empty_diff():
+    return {"added": [], "dropped": [], "altered": []}
+
+
+def _execute(cursor, sql, params=None):
+    if params is None:
+        cursor.execute(sql)
+    else:
+        cursor.execute(sql, params)
+    return cursor.fetchall()
+
+
+class MetadataCache:
+    """Кэш снимков по ключу (conn_id, database)"""
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or METADATA_CACHE_DIR
+        self._snapshots = {}
+        self._locks = {}
+        self._locks_lock = threading.Lock()
+
+    def _lock(self, key):
+        with self._locks_lock:
+            return self._locks.setdefault(key, threading.Lock())
+
+    def _path(self, conn_id, database):
+        digest = hashlib.sha1(f"{conn_id}\0{database}".encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest}.json")
+
+    def _load(self, conn_id, database):
+        path = self._path(conn_id, database)
+        try:
+            with open(path, encoding="utf-8") as f:
+                return MetadataSnapshot.from_json(f.read())
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError):
+            log.warning("Ignoring broken metadata snapshot %s", path)
+            return None
+
+    def _save(self, snapshot):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._path(snapshot.conn_id, snapshot.database)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(snapshot.to_json())
+        os.replace(tmp_path, path)
+
+    def get(self, conn_id, database):
+        """Снимок без обращения к MSSQL (None, если его еще нет)"""
+        key = (conn_id, database)
+        snapshot = self._snapshots.get(key)
+        if snapshot is None:
+            snapshot = self._load(conn_id, database)
+            if snapshot is not None:
+                self._snapshots[key] = snapshot
+        return snapshot
+
+    def invalidate(self, conn_id, database):
+        key = (conn_id, database)
+        with self._lock(key):
+            self._snapshots.pop(key, None)
+            try:
+                os.remove(self._path(conn_id, database))
+            except FileNotFoundError:
+                pass
+
+    def refresh(self, conn_id, database):
+        """Обновить снимок; возвращает (snapshot, diff) с added/dropped/altered"""
+        key = (conn_id, database)
+        with self._lock(key):
+            current = self.get(conn_id, database) or MetadataSnapshot(conn_id, database)
+            #  Изменения собираются в копии: читатели продолжают работать со старым снимком
+            snapshot = MetadataSnapshot(conn_id, database, dict(current.objects), current.summary,
+                                        current.refreshed_at)
+            db = quote_mssql_name(database)
+            diff = _empty_diff()
+            with mssql_connection(conn_id) as conn:
+                cursor = conn.cursor()
+                try:
+                    count, checksum, max_modify = _execute(cursor, SUMMARY_SQL.format(db=db))[0]
+                    summary = [count, checksum, max_modify.isoformat() if max_modify else None]
+                    if current.summary == summary and current.refreshed_at:
+                        return current, diff
+                    self._apply_changes(cursor, db, snapshot, count, diff)
+                finally:
+                    cursor.close()
+
+            snapshot.summary = summary
+            snapshot.refreshed_at = time.time()
+            self._snapshots[key] = snapshot
+            self._save(snapshot)
+            return snapshot, diff
+
+    def _apply_changes(self, cursor, db, snapshot, count, diff):
+        since = snapshot.max_modify_date or _EPOCH
+        changed = {}
+        for object_id, schema, name, obj_type, modify_date in _execute(
+                cursor, CHANGED_OBJECTS_SQL.format(db=db), (since,)):
+            changed[object_id] = {
+                "schema": schema,
+                "name": name,
+                "type": obj_type.strip(),
+                "modify_date": modify_date,
+                "columns": [],
+                "primary_key": [],
+            }
+        if changed:
+            for object_id, column_id, name, type_name, max_length, precision, scale, is_nullable in _execute(
+                    cursor, CHANGED_COLUMNS_SQL.format(db=db), (since,)):
+                if object_id in changed:
+                    changed[object_id]["columns"].append({
+                        "column_id": column_id,
+                        "name": name,
+                        "type": type_name,
+                        "max_length": max_length,
+                        "precision": precision,
+                        "scale": scale,
+                        "nullable": bool(is_nullable),
+                    })
+            #  Добавление и удаление ограничения PRIMARY KEY меняет modify_date таблицы
+            for object_id, name in _execute(cursor, CHANGED_PRIMARY_KEYS_SQL.format(db=db), (since,)):
+                if object_id in changed:
+                    changed[object_id]["primary_key"].append(name)
+
+        for object_id, obj in changed.items():
+            previous = snapshot.objects.get(object_id)
+            if previous is None:
+                diff["added"].append(obj["name"])
+            elif previous["modify_date"] != obj["modify_date"] or previous["columns"] != obj["columns"] \
+                    or previous["primary_key"] != obj["primary_key"]:
+                diff["altered"].append(obj["name"])
+            snapshot.objects[object_id] = obj
+
+        #  Удаленные объекты не видны по modify_date: сверяем список id, только если число объектов не сходится
+        if len(snapshot.objects) != count:
+            existing = {row[0] for row in _execute(cursor, OBJECT_IDS_SQL.format(db=db))}
+            for object_id in [object_id for object_id in snapshot.objects if object_id not in existing]:
+                diff["dropped"].append(snapshot.objects.pop(object_id)["name"])
+
+
+metadata_cache = MetadataCache()
@@ -0,0 +1,359 @@
+"""Параллельная перекачка таблиц проекта с учетом их размера.
+
+Перед запуском из MSSQL (sys.dm_db_partition_stats) читаются число строк
+и занятый объем таблиц, они сохраняются в ct_tables. Работы ставятся в
+очередь от больших к меньшим, большие таблицы при полной выгрузке режутся
+на диапазоны по первому столбцу первичного ключа и копируются параллельно.
+Куски таблицы ODS пишутся во временную таблицу, которая после успешной
+выгрузки всех кусков одной транзакцией заменяет содержимое приемника;
+при ошибке приемник не меняется.
+
+Одновременно к одному источнику идет не больше transfer_per_source_limit
+запросов из одного процесса, то есть из одной задачи Airflow. Общий лимит
+на источник для всех задач задается пулом Airflow ([atk_ct] transfer_pool,
+см. ct_dag_factory).
+
+Колонки и ключи таблиц берутся из каталога колонок (ct_catalog), версии
+Change Tracking всех таблиц читаются одним запросом, поэтому подготовка
+не делает запросов метаданных по каждой таблице.
+"""
+import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from airflow.configuration import conf
+
+from ct_catalog import CREATE_TARGET_TABLES, ensure_target_tables, project_catalog
+from ct_extract import (
+    FULL, UNCHANGED, ChangeTrackingError, build_spec, extract_table, load_sync_state, save_sync_state,
+    tracking_versions,
+)
+from ct_metadata import quote_mssql_name
+from ct_pool import POOL_MAX_SIZE, mssql_connection, pg_connection
+from ct_schema import ensure_schema
+from ct_store import get_project, list_load_tables, save_table_stats
+from ct_transfer import HODS, HODS_COLUMNS, ODS, PostgresTransferSink, copy_query, target_table_name
+
+log = logging.getLogger(__name__)
+
+TRANSFER_MAX_WORKERS = conf.getint("atk_ct", "transfer_max_workers", fallback=8)
+TRANSFER_PER_SOURCE_LIMIT = conf.getint("atk_ct", "transfer_per_source_limit", fallback=4)
+#  Таблицы с числом строк от split_min_rows при полной выгрузке режутся на куски по split_chunk_rows
+SPLIT_MIN_ROWS = conf.getint("atk_ct", "split_min_rows", fallback=5000000)
+SPLIT_CHUNK_ROWS = conf.getint("atk_ct", "split_chunk_rows", fallback=2000000)
+SPLIT_MAX_CHUNKS = conf.getint("atk_ct", "split_max_chunks", fallback=16)
+
+PARTITION_STATS_SQL = """
+    SELECT o.name,
+           SUM(CASE WHEN ps.index_id IN (0, 1) THEN ps.row_count ELSE 0 END),
+           SUM(ps.reserved_page_count) * 8
+    FROM sys.dm_db_partition_stats ps
+    JOIN sys.objects o ON o.object_id = ps.object_id
+    WHERE o.type = 'U' AND SCHEMA_NAME(o.schema_id) = 'dbo'
+    GROUP BY o.name;
+"""
+
+KEY_RANGES_SQL = """
+    SELECT MAX(k)
+    FROM (
+        SELECT {key} AS k, NTILE(%s) OVER (ORDER BY {key}) AS bucket
+        FROM dbo.{table}
+    ) x
+    GROUP BY bucket
+    ORDER BY bucket;
+"""
+
+_source_limits = {}
+_source_limits_lock = threading.Lock()
+
+
+def source_semaphore(connection_id, limit):
+    """Семафор подключения-источника, общий для потоков процесса (лимит берется при первом вызове).
+
+    Другие процессы (задачи Airflow, воркеры вебсервера) его не видят.
+    """
+    with _source_limits_lock:
+        semaphore = _source_limits.get(connection_id)
+        if semaphore is None:
+            semaphore = _source_limits[connection_id] = threading.BoundedSemaphore(limit)
+        return semaphore
+
+
+def collect_table_stats(project, tables):
+    """Число строк и занятый объем (KB) таблиц проекта; результат сохраняется в ct_tables"""
+    with mssql_connection(project["source_connection_id"], database=project["ct_database"]) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(PARTITION_STATS_SQL)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+    wanted = set(tables)
+    stats = {name: (int(row_count or 0), int(reserved_kb or 0))
+             for name, row_count, reserved_kb in rows if name in wanted}
+
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            save_table_stats(cursor, project["ct_project_id"], stats)
+        finally:
+            cursor.close()
+        conn.commit()
+    return stats
+
+
+def key_ranges(project, table_name, key_column, chunks):
+    """Условия WHERE, делящие таблицу на chunks диапазонов по key_column: [(where, params)]"""
+    key = quote_mssql_name(key_column)
+    with mssql_connection(project["source_connection_id"], database=project["ct_database"]) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(KEY_RANGES_SQL.format(key=key, table=quote_mssql_name(table_name)), (chunks, ))
+            bounds = [row[0] for row in cursor.fetchall()]
+        finally:
+            cursor.close()
+    #  Последний диапазон открыт справа, чтобы захватить строки, вставленные после расчета границ
+    bounds = bounds[:-1]
+    if not bounds:
+        return [(None, None)]
+    ranges = [(f"{key} <= %s", (bounds[0], ))]
+    for low, high in zip(bounds, bounds[1:]):
+        ranges.append((f"{key} > %s AND {key} <= %s", (low, high)))
+    ranges.append((f"{key} > %s", (bounds[-1], )))
+    return ranges
+
+
+class _ChunkedTable:
+    """Учет кусков одной таблицы: версия сохраняется, когда все куски скопированы"""
+
+    def __init__(self, spec, chunks, target_table, staged):
+        self.spec = spec
+        self.chunks = chunks
+        self.remaining = chunks
+        self.rows = 0
+        self.failed = False
+        #  Куда пишутся куски; staged - временная таблица, которую нужно подставить в приемник
+        self.target_table = target_table
+        self.staged = staged
+        self.lock = threading.Lock()
+
+    def done(self, rows=0, failed=False):
+        """Учесть скопированный кусок; возвращает True для последнего куска таблицы"""
+        with self.lock:
+            self.remaining -= 1
+            self.rows += rows
+            self.failed = self.failed or failed
+            return self.remaining == 0
+
+
+def _table_spec(project, table_name, last_version, versions, catalog):
+    """ExtractSpec таблицы по каталогу колонок и заранее прочитанным версиям"""
+    entry = catalog.get(table_name)
+    if entry is None:
+        raise ChangeTrackingError(f"Table dbo.{table_name} not found in {project['ct_database']}")
+    current_version, min_valid_versions = versions
+    return build_spec(project, table_name, last_version, current_version, min_valid_versions.get(table_name),
+                      entry["key_columns"], [column["name"] for column in entry["columns"]])
+
+
+def _chunk_count(spec, row_count, max_workers):
+    """Число диапазонов для больших полных выгрузок (None - таблица копируется целиком)"""
+    if spec.mode != FULL or row_count < SPLIT_MIN_ROWS or not spec.key_columns:
+        return None
+    return min(SPLIT_MAX_CHUNKS, max(2, math.ceil(row_count / SPLIT_CHUNK_ROWS)), max_workers * 2)
+
+
+def staging_table_name(project, table_name):
+    """Временная таблица для кусков полной выгрузки ODS (в той же схеме, что приемник)"""
+    return target_table_name(project, f"{table_name}__ct_staging")
+
+
+def _create_staging(project, table_name):
+    staging = staging_table_name(project, table_name)
+    with pg_connection(project["target_connection_id"], database=project["target_database"]) as conn:
+        with conn.cursor() as cursor:
+            #  Без индексов и ключа: их проверит вставка в приемник при замене
+            cursor.execute(
+                f"DROP TABLE IF EXISTS {staging};"
+                f"CREATE UNLOGGED TABLE {staging} (LIKE {target_table_name(project, table_name)} INCLUDING DEFAULTS);"
+            )
+        conn.commit()
+
+
+def _swap_staging(project, table_name):
+    """Заменить содержимое приемника временной таблицей одной транзакцией"""
+    target, staging = target_table_name(project, table_name), staging_table_name(project, table_name)
+    with pg_connection(project["target_connection_id"], database=project["target_database"]) as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(f"TRUNCATE {target}; INSERT INTO {target} SELECT * FROM {staging}; DROP TABLE {staging};")
+        conn.commit()
+
+
+def _drop_staging(project, table_name):
+    try:
+        with pg_connection(project["target_connection_id"], database=project["target_database"]) as conn:
+            with conn.cursor() as cursor:
+                cursor.execute(f"DROP TABLE IF EXISTS {staging_table_name(project, table_name)};")
+            conn.commit()
+    except Exception:
+        log.exception("Failed to drop staging table of %s", table_name)
+
+
+def _copy_chunk(project, spec, where, params, target_table):
+    target_type = (project.get("target_type") or ODS).strip().upper() or ODS
+    prefix, prefix_columns = (), ()
+    if target_type == HODS:
+        prefix, prefix_columns = (spec.to_version, "L"), HODS_COLUMNS
+    select_list = ", ".join(quote_mssql_name(c) for c in spec.columns)
+    sql = f"SELECT {select_list} FROM dbo.{quote_mssql_name(spec.table_name)}"
+    if where:
+        sql += f" WHERE {where}"
+    stats = copy_query(
+        project["source_connection_id"], project["ct_database"], sql, params,
+        project["target_connection_id"], project["target_database"],
+        target_table, spec.columns,
+        prefix=prefix, prefix_columns=prefix_columns,
+    )
+    return stats
+
+
+def run_parallel_transfer(project_id, tables=None, max_workers=None, per_source_limit=None):
+    """Перекачать таблицы проекта параллельно, начиная с самых больших"""
+    max_workers = max_workers or TRANSFER_MAX_WORKERS
+    #  Каждая работа держит по соединению из пулов источника и приемника
+    per_source_limit = min(per_source_limit or TRANSFER_PER_SOURCE_LIMIT, POOL_MAX_SIZE)
+    started = time.monotonic()
+
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            project = get_project(cursor, project_id)
+            if project is None:
+                raise ValueError(f"Project '{project_id}' not found")
+            table_names = tables if tables is not None else list_load_tables(cursor, project_id)
+        finally:
+            cursor.close()
+
+    ensure_schema()
+    state = load_sync_state(project_id)
+    sizes = collect_table_stats(project, table_names)
+    catalog = project_catalog(project, table_names)
+    if CREATE_TARGET_TABLES:
+        ensure_target_tables(project, catalog)
+    versions = tracking_versions(project)
+    source = source_semaphore(project["source_connection_id"], per_source_limit)
+    sink = PostgresTransferSink()
+    results, errors = [], {}
+
+    def limited(func, *args):
+        with source:
+            return func(*args)
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ct_transfer") as executor:
+        #  1. Версии и режим каждой таблицы, диапазоны для больших полных выгрузок
+        planned = {}
+        futures = {}
+        for name in table_names:
+            try:
+                spec = _table_spec(project, name, state.get(name), versions, catalog)
+            except ChangeTrackingError as e:
+                log.error("Planning of %s.%s failed: %s", project_id, name, e)
+                errors[name] = str(e)
+                continue
+            chunks = _chunk_count(spec, sizes.get(name, (0, 0))[0], max_workers)
+            if chunks is None:
+                planned[name] = (spec, None)
+            else:
+                future = executor.submit(limited, key_ranges, project, name, spec.key_columns[0], chunks)
+                futures[future] = (name, spec)
+        for future in as_completed(futures):
+            name, spec = futures[future]
+            try:
+                planned[name] = (spec, future.result())
+            except Exception as e:
+                log.exception("Planning of %s.%s failed", project_id, name)
+                errors[name] = str(e)
+
+        #  2. Работы от самых больших к меньшим (LPT): пул берет их в порядке постановки
+        units = []
+        for name, (spec, ranges) in planned.items():
+            row_count, reserved_kb = sizes.get(name, (0, 0))
+            weight = reserved_kb or row_count
+            if spec.mode == UNCHANGED:
+                results.append({"table": name, "mode": UNCHANGED, "rows": 0, "version": spec.to_version})
+            elif ranges is None:
+                units.append((weight, name, None))
+            else:
+                #  ODS заменяется целиком, поэтому куски копятся во временной таблице; в HODS строки дописываются
+                staged = (project.get("target_type") or ODS).strip().upper() != HODS
+                if staged:
+                    try:
+                        _create_staging(project, name)
+                    except Exception as e:
+                        log.exception("Staging table of %s.%s was not created", project_id, name)
+                        errors[name] = str(e)
+                        continue
+                target = staging_table_name(project, name) if staged else target_table_name(project, name)
+                table = _ChunkedTable(spec, len(ranges), target, staged)
+                for where, params in ranges:
+                    units.append((weight / len(ranges), name, (table, where, params)))
+        units.sort(key=lambda unit: unit[0], reverse=True)
+
+        futures = {}
+        for weight, name, chunk in units:
+            if chunk is None:
+                future = executor.submit(limited, extract_table, project, name, sink, state.get(name), None,
+                                         planned[name][0])
+            else:
+                table, where, params = chunk
+                future = executor.submit(limited, _copy_chunk, project, table.spec, where, params,
+                                         table.target_table)
+            futures[future] = (name, chunk)
+
+        for future in as_completed(futures):
+            name, chunk = futures[future]
+            if chunk is None:
+                try:
+                    results.append(future.result())
+                except Exception as e:
+                    log.exception("Transfer of %s.%s failed", project_id, name)
+                    errors[name] = str(e)
+                continue
+
+            table = chunk[0]
+            try:
+                stats = future.result()
+                sink.stats.append(stats.to_dict())
+                complete = table.done(rows=stats.rows)
+            except Exception as e:
+                log.exception("Transfer of a chunk of %s.%s failed", project_id, name)
+                errors[name] = str(e)
+                complete = table.done(failed=True)
+            if not complete:
+                continue
+            if table.failed:
+                if table.staged:
+                    _drop_staging(project, name)
+                continue
+            if table.staged:
+                try:
+                    _swap_staging(project, name)
+                except Exception as e:
+                    log.exception("Replacing %s.%s with its staging table failed", project_id, name)
+                    errors[name] = str(e)
+                    _drop_staging(project, name)
+                    continue
+            spec = table.spec
+            save_sync_state(project_id, name, spec.to_version, spec.mode, table.rows)
+            results.append({"table": name, "mode": spec.mode, "rows": table.rows,
+                            "version": spec.to_version, "chunks": table.chunks})
+
+    return {
+        "project_id": project_id,
+        "tables": results,
+        "errors": errors,
+        "throughput": sink.stats,
+        "seconds": round(time.monotonic() - started, 3),
+    }
@@ -0,0 +1,218 @@
+"""Пул соединений Postgres/MSSQL, общий для плагинов atk_ct.
+
+Пулы живут в процессе воркера вебсервера (один пул на conn_id и базу)
+и переиспользуют соединения между запросами вместо get_conn() на каждый вызов.
+"""
+import logging
+import os
+import queue
+import threading
+import time
+from contextlib import contextmanager
+
+from airflow.configuration import conf
+from airflow.providers.microsoft.mssql.hooks.mssql import MsSqlHook
+from airflow.providers.postgres.hooks.postgres import PostgresHook
+
+from ct_timing import timed_connection
+
+log = logging.getLogger(__name__)
+
+POOL_MAX_SIZE = conf.getint("atk_ct", "pool_max_size", fallback=5)
+POOL_TIMEOUT = conf.getfloat("atk_ct", "pool_timeout", fallback=30.0)
+#  Соединение старше pool_recycle секунд закрывается при возврате/выдаче
+POOL_RECYCLE = conf.getint("atk_ct", "pool_recycle", fallback=1800)
+#  Простаивающее дольше pool_ping_interval секунд соединение проверяется SELECT 1
+POOL_PING_INTERVAL = conf.getint("atk_ct", "pool_ping_interval", fallback=30)
+
+DEFAULT_POSTGRES_CONN_ID = "airflow_postgres"
+
+
+def _postgres_factory(conn_id, database):
+    if database:
+        return PostgresHook(postgres_conn_id=conn_id, database=database).get_conn()
+    return PostgresHook(postgres_conn_id=conn_id).get_conn()
+
+
+def _mssql_factory(conn_id, database):
+    if database:
+        return MsSqlHook(mssql_conn_id=conn_id, schema=database).get_conn()
+    return MsSqlHook(mssql_conn_id=conn_id).get_conn()
+
+
+_FACTORIES = {
+    "postgres": _postgres_factory,
+    "mssql": _mssql_factory,
+}
+
+
+class PoolTimeout(Exception):
+    """Свободное соединение не появилось за pool_timeout секунд"""
+
+
+class _PoolEntry:
+    __slots__ = ("conn", "created_at", "last_used_at")
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.created_at = self.last_used_at = time.monotonic()
+
+
+class ConnectionPool:
+    """Ограниченный пул соединений одного conn_id"""
+
+    def __init__(self, kind, conn_id, database=None, max_size=None, timeout=None, recycle=None,
+                 ping_interval=None):
+        self.kind = kind
+        self.conn_id = conn_id
+        self.database = database
+        self.max_size = max_size or POOL_MAX_SIZE
+        self.timeout = POOL_TIMEOUT if timeout is None else timeout
+        self.recycle = POOL_RECYCLE if recycle is None else recycle
+        self.ping_interval = POOL_PING_INTERVAL if ping_interval is None else ping_interval
+        self._factory = _FACTORIES[kind]
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.max_size)
+        self._stats_lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "discarded": 0, "timeouts": 0, "errors": 0}
+
+    def _count(self, key):
+        with self._stats_lock:
+            self.stats[key] += 1
+
+    def _close(self, entry):
+        self._count("discarded")
+        try:
+            entry.conn.close()
+        except Exception:
+            log.debug("Error while closing pooled %s connection %s", self.kind, self.conn_id, exc_info=True)
+
+    def _ping(self, conn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT 1")
+            cursor.fetchall()
+        finally:
+            cursor.close()
+        conn.rollback()
+
+    def _is_usable(self, entry):
+        now = time.monotonic()
+        if self.recycle and now - entry.created_at > self.recycle:
+            return False
+        if getattr(entry.conn, "closed", 0):
+            return False
+        if now - entry.last_used_at > self.ping_interval:
+            try:
+                self._ping(entry.conn)
+            except Exception:
+                return False
+        return True
+
+    def acquire(self):
+        """Взять соединение из пула, при необходимости открыв новое"""
+        if not self._slots.acquire(timeout=self.timeout):
+            self._count("timeouts")
+            raise PoolTimeout(f"No free {self.kind} connection for '{self.conn_id}' in {self.timeout}s")
+        try:
+            while True:
+                try:
+                    entry = self._idle.get_nowait()
+                except queue.Empty:
+                    break
+                if self._is_usable(entry):
+                    self._count("hits")
+                    return entry
+                self._close(entry)
+            self._count("misses")
+            return _PoolEntry(self._factory(self.conn_id, self.database))
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, entry, failed=False):
+        """Вернуть соединение в пул; после ошибки оно проверяется и при необходимости закрывается"""
+        try:
+            try:
+                #  Незавершенная транзакция не должна достаться следующему запросу
+                entry.conn.rollback()
+                if failed:
+                    self._ping(entry.conn)
+            except Exception:
+                self._close(entry)
+                return
+            entry.last_used_at = time.monotonic()
+            if self.recycle and entry.last_used_at - entry.created_at > self.recycle:
+                self._close(entry)
+                return
+            self._idle.put(entry)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        entry = self.acquire()
+        failed = False
+        try:
+            yield timed_connection(entry.conn, self.kind, self.conn_id)
+        except BaseException:
+            failed = True
+            self._count("errors")
+            raise
+        finally:
+            self.release(entry, failed=failed)
+
+    def close_idle(self):
+        while True:
+            try:
+                entry = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(entry)
+
+    def snapshot(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats.update(idle=self._idle.qsize(), max_size=self.max_size)
+        return stats
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
+def get_pool(conn_id, kind="postgres", database=None):
+    """Пул для пары (conn_id, база), создается при первом обращении"""
+    global _pools_pid
+    key = (kind, conn_id, database or None)
+    with _pools_lock:
+        #  После fork унаследованные сокеты не используем: у каждого воркера свои пулы
+        if _pools_pid != os.getpid():
+            _pools.clear()
+            _pools_pid = os.getpid()
+        pool = _pools.get(key)
+        if pool is None:
+            pool = _pools[key] = ConnectionPool(kind, conn_id, database)
+        return pool
+
+
+def pg_connection(conn_id=DEFAULT_POSTGRES_CONN_ID, database=None):
+    """Контекстный менеджер с соединением Postgres из пула"""
+    return get_pool(conn_id, "postgres", database).connection()
+
+
+def mssql_connection(conn_id, database=None):
+    """Контекстный менеджер с соединением MSSQL из пула"""
+    return get_pool(conn_id, "mssql", database).connection()
+
+
+def pool_stats():
+    """Счетчики всех пулов текущего процесса"""
+    with _pools_lock:
+        pools = list(_pools.values())
+    result = {}
+    for pool in pools:
+        name = f"{pool.kind}:{pool.conn_id}" + (f"/{pool.database}" if pool.database else "")
+        result[name] = pool.snapshot()
+    return result
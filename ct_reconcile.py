@@ -0,0 +1,655 @@
+"""Сверка данных источника (MSSQL) и приемника (Postgres) по диапазонам ключа.
+
+Таблица делится на диапазоны по первому столбцу первичного ключа (NTILE
+на источнике). Для каждого диапазона обе стороны параллельно дают число
+строк и агрегатный хэш; совпавшие диапазоны больше не читаются,
+несовпавшие делятся дальше, пока в диапазоне не останется не больше
+reconcile_leaf_rows строк. Тогда сравниваются хэши отдельных строк и
+сохраняются ключи пропавших, лишних и измененных строк.
+
+Число строк и агрегатный хэш диапазона считаются самими базами: каждая
+колонка приводится к одинаковому на обеих сторонах тексту (по типу колонки
+источника), строка хэшируется MD5 от UTF-8 (HASHBYTES с коллацией _UTF8 в
+MSSQL, md5 в Postgres), агрегат - сумма первых 8 байт хэшей строк, поэтому
+порядок строк не важен. Строки по сети передаются только для несовпавших
+листовых диапазонов, и то лишь ключ и хэш. MSSQL до 2019 не умеет UTF-8,
+для него строки читаются и хэшируются в Python, как раньше. В режиме count
+сравнивается только COUNT(*).
+
+Результаты сохраняются в atk_ct.ct_reconcile_results по (проект, таблица).
+"""
+import datetime
+import decimal
+import hashlib
+import json
+import logging
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from airflow.configuration import conf
+
+from ct_extract import PRIMARY_KEY_SQL, table_column_info
+from ct_metadata import quote_mssql_name
+from ct_parallel import source_semaphore
+from ct_pool import POOL_MAX_SIZE, mssql_connection, pg_connection
+from ct_schema import ensure_schema
+from ct_store import get_project, list_load_tables
+from ct_transfer import HODS, ODS, quote_pg_name, target_table_name
+
+log = logging.getLogger(__name__)
+
+RECONCILE_JOB = "reconciliation"
+
+RECONCILE_MAX_WORKERS = conf.getint("atk_ct", "reconcile_max_workers", fallback=8)
+RECONCILE_PER_SOURCE_LIMIT = conf.getint("atk_ct", "reconcile_per_source_limit", fallback=4)
+#  На сколько диапазонов делится таблица в начале и несовпавший диапазон при спуске
+RECONCILE_RANGES = conf.getint("atk_ct", "reconcile_ranges", fallback=16)
+RECONCILE_DRILL_PARTS = conf.getint("atk_ct", "reconcile_drill_parts", fallback=8)
+#  Диапазон не больше стольких строк сравнивается построчно
+RECONCILE_LEAF_ROWS = conf.getint("atk_ct", "reconcile_leaf_rows", fallback=10000)
+#  Глубже диапазон не делится и сравнивается построчно, сколько бы строк в нем ни было
+RECONCILE_MAX_DEPTH = conf.getint("atk_ct", "reconcile_max_depth", fallback=8)
+#  Сколько ключей каждого вида расхождений сохранять на диапазон
+RECONCILE_SAMPLE_KEYS = conf.getint("atk_ct", "reconcile_sample_keys", fallback=50)
+RECONCILE_FETCH_SIZE = conf.getint("atk_ct", "reconcile_fetch_size", fallback=10000)
+
+HASH = "hash"
+COUNT = "count"
+
+OK = "ok"
+MISMATCH = "mismatch"
+SKIPPED = "skipped"
+ERROR = "error"
+
+#  Типы ключа, которые сортируются одинаково в MSSQL и Postgres, поэтому по ним можно резать
+#  диапазоны. У строк разные collation, у uniqueidentifier особый порядок байт, datetime
+#  в MSSQL хранится с шагом 1/300 секунды и при передаче границы округляется
+SPLITTABLE_KEY_TYPES = {
+    "tinyint", "smallint", "int", "bigint", "decimal", "numeric", "money", "smallmoney",
+    "binary", "varbinary", "date",
+}
+
+_HASH_MODULUS = 1 << 128
+
+#  Коллации _UTF8 (HASHBYTES от тех же байт, что md5 в Postgres) есть начиная с SQL Server 2019
+SQL_HASH_MIN_VERSION = 15
+SERVER_VERSION_SQL = "SELECT CAST(SERVERPROPERTY('ProductMajorVersion') AS int);"
+
+#  Разделитель колонок в тексте строки; NULL кодируется как 'n', значение - как 'v' + текст
+_SEPARATOR = 31
+_INTEGER_TYPES = {"tinyint", "smallint", "int", "bigint", "decimal", "numeric"}
+_BINARY_TYPES = {"binary", "varbinary", "image", "timestamp", "rowversion"}
+
+BOUNDS_SQL = """
+    SELECT MAX(k)
+    FROM (
+        SELECT {key} AS k, NTILE(%s) OVER (ORDER BY {key}) AS bucket
+        FROM {table}
+        {where}
+    ) x
+    GROUP BY bucket
+    ORDER BY bucket;
+"""
+
+SAVE_RESULT_SQL = """
+    INSERT INTO atk_ct.ct_reconcile_results (
+        project_id, table_name, status, mode, source_rows, target_rows,
+        ranges_checked, mismatched_ranges, details, seconds, checked_at
+    )
+    VALUES (%(project_id)s, %(table)s, %(status)s, %(mode)s, %(source_rows)s, %(target_rows)s,
+            %(ranges_checked)s, %(mismatched_ranges)s, %(details)s, %(seconds)s, now())
+    ON CONFLICT (project_id, table_name) DO UPDATE
+    SET status = EXCLUDED.status,
+        mode = EXCLUDED.mode,
+        source_rows = EXCLUDED.source_rows,
+        target_rows = EXCLUDED.target_rows,
+        ranges_checked = EXCLUDED.ranges_checked,
+        mismatched_ranges = EXCLUDED.mismatched_ranges,
+        details = EXCLUDED.details,
+        seconds = EXCLUDED.seconds,
+        checked_at = EXCLUDED.checked_at;
+"""
+
+RESULT_COLUMNS = (
+    "table_name", "status", "mode", "source_rows", "target_rows",
+    "ranges_checked", "mismatched_ranges", "details", "seconds", "checked_at",
+)
+
+
+def canonical(value):
+    """Текстовое представление значения, одинаковое для pymssql и psycopg2"""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    if isinstance(value, decimal.Decimal):
+        #  numeric(15, 2) и bigint приемника дают одно представление: 12.5, 100
+        return format(value.normalize(), "f")
+    if isinstance(value, float):
+        return repr(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    if isinstance(value, datetime.datetime) and value.tzinfo is not None:
+        value = value.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return str(value)
+
+
+def _mssql_text(column, type_name):
+    """Текст колонки MSSQL в каноническом виде (см. _pg_text)"""
+    c = quote_mssql_name(column)
+    t = type_name.lower()
+    if t == "bit" or t in _INTEGER_TYPES:
+        return f"CONVERT(nvarchar(60), {c})"
+    if t in ("money", "smallmoney"):
+        return f"CONVERT(nvarchar(60), {c}, 2)"
+    if t == "float":
+        return f"CONVERT(nvarchar(16), CAST({c} AS binary(8)), 2)"
+    if t == "real":
+        return f"CONVERT(nvarchar(8), CAST({c} AS binary(4)), 2)"
+    if t == "date":
+        return f"CONVERT(nvarchar(10), {c}, 23)"
+    if t == "datetime":
+        return (f"CONVERT(nvarchar(19), {c}, 120) + N'.' "
+                f"+ RIGHT(N'00' + CONVERT(nvarchar(3), DATEPART(millisecond, {c})), 3)")
+    if t == "smalldatetime":
+        return f"CONVERT(nvarchar(19), {c}, 120)"
+    if t == "datetime2":
+        return f"CONVERT(nvarchar(26), CAST({c} AS datetime2(6)), 121)"
+    if t == "datetimeoffset":
+        return f"CONVERT(nvarchar(26), CAST(SWITCHOFFSET({c}, '+00:00') AS datetime2(6)), 121)"
+    if t == "time":
+        return f"CONVERT(nvarchar(15), CAST({c} AS time(6)))"
+    if t in ("char", "nchar"):
+        return f"RTRIM(CAST({c} AS nvarchar(max)))"
+    if t == "uniqueidentifier":
+        return f"LOWER(CONVERT(nvarchar(36), {c}))"
+    if t in _BINARY_TYPES:
+        return f"CONVERT(nvarchar(max), CAST({c} AS varbinary(max)), 2)"
+    return f"CAST({c} AS nvarchar(max))"
+
+
+def _pg_text(column, type_name):
+    """Текст колонки приемника (типы по ct_catalog.pg_type) в том же виде, что _mssql_text"""
+    c = quote_pg_name(column)
+    t = type_name.lower()
+    if t == "bit":
+        return f"CASE WHEN {c} THEN '1' ELSE '0' END"
+    if t in _INTEGER_TYPES:
+        return f"{c}::text"
+    if t in ("money", "smallmoney"):
+        return f"round({c}::numeric, 4)::text"
+    if t == "float":
+        return f"upper(encode(float8send({c}::float8), 'hex'))"
+    if t == "real":
+        return f"upper(encode(float4send({c}::float4), 'hex'))"
+    if t == "date":
+        return f"to_char({c}, 'YYYY-MM-DD')"
+    if t == "datetime":
+        return f"to_char({c}, 'YYYY-MM-DD HH24:MI:SS.MS')"
+    if t == "smalldatetime":
+        return f"to_char({c}, 'YYYY-MM-DD HH24:MI:SS')"
+    if t == "datetime2":
+        return f"to_char({c}, 'YYYY-MM-DD HH24:MI:SS.US')"
+    if t == "datetimeoffset":
+        return f"to_char({c} AT TIME ZONE 'UTC', 'YYYY-MM-DD HH24:MI:SS.US')"
+    if t == "time":
+        return f"to_char(date '2000-01-01' + {c}, 'HH24:MI:SS.US')"
+    if t in ("char", "nchar"):
+        return f"rtrim({c}::text)"
+    if t == "uniqueidentifier":
+        return f"lower({c}::text)"
+    if t in _BINARY_TYPES:
+        return f"upper(encode({c}, 'hex'))"
+    return f"{c}::text"
+
+
+def _mssql_row_hash(columns, types):
+    text = f" + NCHAR({_SEPARATOR}) + ".join(
+        f"COALESCE(N'v' + {_mssql_text(c, types[c])}, N'n')" for c in columns
+    )
+    return (f"HASHBYTES('MD5', CONVERT(varchar(max), "
+            f"(CAST(N'' AS nvarchar(max)) + {text}) COLLATE Latin1_General_100_BIN2_UTF8))")
+
+
+def _pg_row_hash(columns, types):
+    text = f" || chr({_SEPARATOR}) || ".join(f"COALESCE('v' || {_pg_text(c, types[c])}, 'n')" for c in columns)
+    return f"md5({text})"
+
+
+def row_hash(row):
+    text = "\x1f".join("\x00" if value is None else canonical(value) for value in row)
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest(), "big")
+
+
+class KeyRange:
+    """Полуинтервал (low, high] первого столбца ключа; None - без границы"""
+
+    def __init__(self, low=None, high=None, depth=0):
+        self.low = low
+        self.high = high
+        self.depth = depth
+        #  Число строк на источнике и приемнике после сравнения
+        self.counts = None
+
+    def where(self, key):
+        parts, params = [], []
+        if self.low is not None:
+            parts.append(f"{key} > %s")
+            params.append(self.low)
+        if self.high is not None:
+            parts.append(f"{key} <= %s")
+            params.append(self.high)
+        return " AND ".join(parts), tuple(params)
+
+    def split(self, bounds):
+        """Поддиапазоны по верхним границам NTILE (последняя граница - верх самого диапазона).
+
+        Повторяющиеся границы и границы вне (low, high) отбрасываются, поэтому каждый
+        поддиапазон уже родителя; один поддиапазон означает, что делить нечего.
+        """
+        inner = []
+        for bound in bounds[:-1]:
+            if bound is None or (self.low is not None and bound <= self.low) \
+                    or (self.high is not None and bound >= self.high) or (inner and bound <= inner[-1]):
+                continue
+            inner.append(bound)
+        lows = [self.low] + inner
+        highs = inner + [self.high]
+        return [KeyRange(low, high, self.depth + 1) for low, high in zip(lows, highs)]
+
+    def to_dict(self):
+        return {"low": canonical(self.low), "high": canonical(self.high), "depth": self.depth}
+
+
+class _TableCheck:
+    """Сверка одной таблицы: запросы к обеим сторонам и накопленный результат"""
+
+    def __init__(self, project, table_name, mode, columns, key_columns, split_key, types=None, sql_hash=False):
+        self.project = project
+        self.table_name = table_name
+        self.mode = mode
+        self.columns = columns
+        #  Типы колонок источника; с sql_hash хэши считают сами базы
+        self.types = types or {}
+        self.sql_hash = sql_hash
+        self.key_columns = key_columns
+        self.split_key = split_key
+        self.key_positions = [columns.index(k) for k in key_columns]
+        self.started = time.monotonic()
+        self.pending = 0
+        self.source_rows = 0
+        self.target_rows = 0
+        self.ranges_checked = 0
+        self.mismatches = []
+        self.errors = []
+
+    def _select(self, side, select_list, rng):
+        quote = quote_mssql_name if side == "source" else quote_pg_name
+        table = (f"dbo.{quote_mssql_name(self.table_name)}" if side == "source"
+                 else target_table_name(self.project, self.table_name))
+        sql = f"SELECT {select_list} FROM {table}"
+        where, params = rng.where(quote(self.key_columns[0])) if self.key_columns else ("", ())
+        if where:
+            sql += f" WHERE {where}"
+        return sql, params or None
+
+    def count_query(self, side, rng):
+        return self._select(side, "COUNT_BIG(*)" if side == "source" else "count(*)", rng)
+
+    def rows_query(self, side, rng):
+        quote = quote_mssql_name if side == "source" else quote_pg_name
+        return self._select(side, ", ".join(quote(c) for c in self.columns), rng)
+
+    def measure_query(self, side, rng):
+        """Число строк и сумма первых 8 байт MD5 строк (numeric, без переполнения)"""
+        if side == "source":
+            digest = _mssql_row_hash(self.columns, self.types)
+            return self._select(side, f"COUNT_BIG(*), SUM(CAST(CAST(SUBSTRING({digest}, 1, 8) AS bigint) "
+                                      f"AS decimal(38, 0)))", rng)
+        digest = _pg_row_hash(self.columns, self.types)
+        return self._select(side, f"count(*), sum(('x' || substr({digest}, 1, 16))::bit(64)::bigint)", rng)
+
+    def row_hashes_query(self, side, rng):
+        """Ключевые колонки и MD5 строки (hex в верхнем регистре)"""
+        if side == "source":
+            keys = ", ".join(quote_mssql_name(c) for c in self.key_columns)
+            return self._select(side, f"{keys}, CONVERT(char(32), {_mssql_row_hash(self.columns, self.types)}, 2)",
+                                rng)
+        keys = ", ".join(quote_pg_name(c) for c in self.key_columns)
+        return self._select(side, f"{keys}, upper({_pg_row_hash(self.columns, self.types)})", rng)
+
+    def key_of(self, row):
+        return tuple(canonical(row[i]) for i in self.key_positions)
+
+    def result(self):
+        if self.errors:
+            status = ERROR
+        elif self.mismatches or self.source_rows != self.target_rows:
+            status = MISMATCH
+        else:
+            status = OK
+        details = {"mismatches": self.mismatches}
+        if self.errors:
+            details["errors"] = self.errors
+        if not self.split_key:
+            details["note"] = "Key is not range-splittable, the table is checked as one range"
+        return {
+            "table": self.table_name,
+            "status": status,
+            "mode": self.mode,
+            "source_rows": self.source_rows,
+            "target_rows": self.target_rows,
+            "ranges_checked": self.ranges_checked,
+            "mismatched_ranges": len(self.mismatches),
+            "details": details,
+            "seconds": round(time.monotonic() - self.started, 3),
+        }
+
+
+def _iter_rows(cursor, fetch_size):
+    while True:
+        rows = cursor.fetchmany(fetch_size)
+        if not rows:
+            return
+        yield from rows
+
+
+def _run_measure(cursor, check, side, rng):
+    """(число строк, агрегатный хэш) диапазона на одной стороне"""
+    if check.mode == COUNT:
+        cursor.execute(*check.count_query(side, rng))
+        return cursor.fetchone()[0], None
+    if check.sql_hash:
+        cursor.execute(*check.measure_query(side, rng))
+        count, total = cursor.fetchone()
+        return count, None if total is None else int(total)
+    cursor.execute(*check.rows_query(side, rng))
+    count, total = 0, 0
+    for row in _iter_rows(cursor, RECONCILE_FETCH_SIZE):
+        count += 1
+        total = (total + row_hash(row)) % _HASH_MODULUS
+    return count, total
+
+
+def _run_row_hashes(cursor, check, side, rng):
+    """{ключ: хэш строки} диапазона на одной стороне"""
+    if check.sql_hash:
+        cursor.execute(*check.row_hashes_query(side, rng))
+        size = len(check.key_columns)
+        return {tuple(canonical(value) for value in row[:size]): row[size]
+                for row in _iter_rows(cursor, RECONCILE_FETCH_SIZE)}
+    cursor.execute(*check.rows_query(side, rng))
+    return {check.key_of(row): row_hash(row) for row in _iter_rows(cursor, RECONCILE_FETCH_SIZE)}
+
+
+def _on_source(check, source, func, *args):
+    project = check.project
+    with source:
+        with mssql_connection(project["source_connection_id"], database=project["ct_database"]) as conn:
+            cursor = conn.cursor()
+            try:
+                return func(cursor, check, "source", *args)
+            finally:
+                cursor.close()
+
+
+def _on_target(check, func, *args):
+    project = check.project
+    with pg_connection(project["target_connection_id"], database=project["target_database"]) as conn:
+        #  Серверный курсор: строки диапазона не загружаются в память целиком
+        cursor = conn.cursor(name=f"ct_reconcile_{uuid.uuid4().hex}")
+        cursor.itersize = RECONCILE_FETCH_SIZE
+        try:
+            return func(cursor, check, "target", *args)
+        finally:
+            cursor.close()
+
+
+def _both_sides(check, source, target_executor, func, *args):
+    """func на источнике и приемнике одновременно: (результат источника, результат приемника)"""
+    target = target_executor.submit(_on_target, check, func, *args)
+    try:
+        source_result = _on_source(check, source, func, *args)
+    except BaseException:
+        target.cancel()
+        raise
+    return source_result, target.result()
+
+
+def _bounds(check, source, rng, parts):
+    key = quote_mssql_name(check.key_columns[0])
+    where, params = rng.where(key)
+    sql = BOUNDS_SQL.format(key=key, table=f"dbo.{quote_mssql_name(check.table_name)}",
+                            where=f"WHERE {where}" if where else "")
+
+    def run(cursor, check, side):
+        cursor.execute(sql, (parts, ) + params)
+        return [row[0] for row in cursor.fetchall()]
+
+    return _on_source(check, source, run)
+
+
+def _prepare(project, table_name, mode, source, sql_hash):
+    """Колонки, ключ и начальные диапазоны таблицы"""
+    columns_info = table_column_info(project["source_connection_id"], project["ct_database"], table_name)
+    columns = [column["name"] for column in columns_info]
+
+    def primary_key(cursor, check, side):
+        cursor.execute(PRIMARY_KEY_SQL, (f"dbo.{quote_mssql_name(table_name)}", ))
+        return [row[0] for row in cursor.fetchall()]
+
+    types = {column["name"]: column["type"] for column in columns_info}
+    check = _TableCheck(project, table_name, mode, columns, [], False, types, sql_hash and mode == HASH)
+    check.key_columns = _on_source(check, source, primary_key)
+    check.key_positions = [columns.index(k) for k in check.key_columns]
+    check.split_key = bool(check.key_columns) and types.get(check.key_columns[0]) in SPLITTABLE_KEY_TYPES
+    if not check.split_key:
+        return check, [KeyRange()]
+    bounds = _bounds(check, source, KeyRange(), RECONCILE_RANGES)
+    return check, [KeyRange(rng.low, rng.high) for rng in KeyRange().split(bounds or [None])]
+
+
+def _sql_hash_supported(project, source):
+    """Может ли источник считать хэши строк сам (коллации _UTF8, SQL Server 2019+)"""
+    with source:
+        with mssql_connection(project["source_connection_id"], database=project["ct_database"]) as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.execute(SERVER_VERSION_SQL)
+                version = cursor.fetchone()[0]
+            finally:
+                cursor.close()
+    if version is None or version < SQL_HASH_MIN_VERSION:
+        log.warning("SQL Server %s of %s has no UTF-8 collations, rows are hashed in Python",
+                    version, project["source_connection_id"])
+        return False
+    return True
+
+
+def _diff(check, source, target_executor, rng):
+    """Построчное сравнение диапазона: ключи пропавших, лишних и измененных строк"""
+    source_rows, target_rows = _both_sides(check, source, target_executor, _run_row_hashes, rng)
+    missing = [key for key in source_rows if key not in target_rows]
+    extra = [key for key in target_rows if key not in source_rows]
+    changed = [key for key, value in source_rows.items()
+               if key in target_rows and target_rows[key] != value]
+    return {
+        **rng.to_dict(),
+        "source_rows": len(source_rows),
+        "target_rows": len(target_rows),
+        "missing": len(missing),
+        "extra": len(extra),
+        "changed": len(changed),
+        "missing_keys": [list(key) for key in missing[:RECONCILE_SAMPLE_KEYS]],
+        "extra_keys": [list(key) for key in extra[:RECONCILE_SAMPLE_KEYS]],
+        "changed_keys": [list(key) for key in changed[:RECONCILE_SAMPLE_KEYS]],
+    }
+
+
+def save_result(project_id, result):
+    with pg_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(SAVE_RESULT_SQL, {"project_id": project_id, **result,
+                                             "details": json.dumps(result["details"], ensure_ascii=False)})
+        conn.commit()
+
+
+def load_results(project_id):
+    """Последние результаты сверки таблиц проекта"""
+    with pg_connection() as conn:
+        with conn.cursor() as cursor:
+            cursor.execute(
+                f"SELECT {', '.join(RESULT_COLUMNS)} FROM atk_ct.ct_reconcile_results "
+                f"WHERE project_id = %s ORDER BY table_name;",
+                (project_id, )
+            )
+            return [dict(zip(RESULT_COLUMNS, row)) for row in cursor.fetchall()]
+
+
+def reconcile_tables(project, table_names, mode=HASH, max_workers=None, per_source_limit=None, job=None):
+    """Сверить таблицы проекта; возвращает {table_name: результат}.
+
+    Подготовка таблиц, сравнение диапазонов, деление несовпавших и
+    построчное сравнение идут задачами одного пула, поэтому спуск в одну
+    таблицу не ждет, пока досчитаются остальные.
+    """
+    max_workers = max_workers or RECONCILE_MAX_WORKERS
+    per_source_limit = min(per_source_limit or RECONCILE_PER_SOURCE_LIMIT, POOL_MAX_SIZE)
+    source = source_semaphore(project["source_connection_id"], per_source_limit)
+    sql_hash = mode == HASH and _sql_hash_supported(project, source)
+    #  Каждый поток приемника держит соединение из пула: больше POOL_MAX_SIZE потоков ждали бы
+    #  свободного соединения до POOL_TIMEOUT и падали с ошибкой
+    target_workers = min(max_workers, POOL_MAX_SIZE)
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ct_reconcile") as executor, \
+            ThreadPoolExecutor(max_workers=target_workers, thread_name_prefix="ct_reconcile_target") \
+            as target_executor:
+        futures = {}
+
+        def submit(kind, check, rng, func, *args):
+            if check is not None:
+                check.pending += 1
+            futures[executor.submit(func, *args)] = (kind, check, rng)
+
+        def leaf(check, rng):
+            source_count, target_count = rng.counts
+            if max(source_count, target_count) <= RECONCILE_LEAF_ROWS:
+                submit("diff", check, rng, _diff, check, source, target_executor, rng)
+            else:
+                #  Диапазон нельзя поделить дальше, а построчно он слишком велик
+                check.mismatches.append({**rng.to_dict(), "source_rows": source_count,
+                                         "target_rows": target_count, "too_large": True})
+
+        for name in table_names:
+            submit("prepare", None, name, _prepare, project, name, mode, source, sql_hash)
+
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                kind, check, rng = futures.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if check is None:
+                        log.exception("Reconciliation of %s failed", rng)
+                        results[rng] = {"table": rng, "status": ERROR, "mode": mode, "source_rows": None,
+                                        "target_rows": None, "ranges_checked": 0, "mismatched_ranges": 0,
+                                        "details": {"errors": [str(e)]}, "seconds": None}
+                        continue
+                    log.exception("Reconciliation step %s of %s failed", kind, check.table_name)
+                    check.errors.append(f"{kind} {rng.to_dict()}: {e}")
+                    result = None
+
+                if kind == "prepare":
+                    check, ranges = result
+                    for top in ranges:
+                        submit("compare", check, top, _both_sides, check, source, target_executor,
+                               _run_measure, top)
+                    continue
+
+                check.pending -= 1
+                if kind == "compare" and result is not None:
+                    (source_count, source_hash), (target_count, target_hash) = result
+                    check.ranges_checked += 1
+                    rng.counts = (source_count, target_count)
+                    if rng.depth == 0:
+                        check.source_rows += source_count
+                        check.target_rows += target_count
+                    if (source_count, source_hash) != (target_count, target_hash):
+                        if check.split_key and max(source_count, target_count) > RECONCILE_LEAF_ROWS \
+                                and rng.depth < RECONCILE_MAX_DEPTH:
+                            submit("split", check, rng, _bounds, check, source, rng, RECONCILE_DRILL_PARTS)
+                        else:
+                            leaf(check, rng)
+                elif kind == "split" and result is not None:
+                    children = rng.split(result or [None])
+                    if len(children) > 1:
+                        for child in children:
+                            submit("compare", check, child, _both_sides, check, source, target_executor,
+                                   _run_measure, child)
+                    else:
+                        #  Диапазон пуст на источнике или в нем одно значение первого столбца ключа
+                        #  (составной ключ): деление не продвигается, сравниваем построчно
+                        leaf(check, rng)
+                elif kind == "diff" and result is not None:
+                    #  Строки могли измениться между сравнением агрегатов и построчным сравнением
+                    #  (идет перекачка): если построчно расхождений нет, диапазон не учитывается.
+                    #  Без ключа строки построчно не различить, такой диапазон учитывается всегда
+                    if not check.key_columns or result["missing"] or result["extra"] or result["changed"]:
+                        check.mismatches.append(result)
+
+                if check.pending == 0:
+                    table_result = results[check.table_name] = check.result()
+                    save_result(project["ct_project_id"], table_result)
+                    log.info("Reconciled %s.%s: %s", project["ct_project_id"], check.table_name,
+                             {k: v for k, v in table_result.items() if k != "details"})
+                    if job is not None:
+                        job.update(progress=len(results) / max(len(table_names), 1),
+                                   message=f"Reconciled {len(results)} of {len(table_names)} tables")
+    return results
+
+
+def run_reconciliation(job, project_id, tables=None, mode=HASH, max_workers=None):
+    """Сверить таблицы проекта с load = true (или tables) и сохранить результаты (job может быть None)"""
+    if mode not in (HASH, COUNT):
+        raise ValueError(f"Unknown reconciliation mode '{mode}'")
+    started = time.monotonic()
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            project = get_project(cursor, project_id)
+            if project is None:
+                raise ValueError(f"Project '{project_id}' not found")
+            table_names = tables if tables is not None else list_load_tables(cursor, project_id)
+        finally:
+            cursor.close()
+
+    ensure_schema()
+    target_type = (project.get("target_type") or ODS).strip().upper() or ODS
+    if target_type == HODS:
+        #  В HODS хранится история изменений, а не копия источника
+        results = {}
+        for name in table_names:
+            results[name] = {"table": name, "status": SKIPPED, "mode": mode, "source_rows": None,
+                             "target_rows": None, "ranges_checked": 0, "mismatched_ranges": 0,
+                             "details": {"note": "HODS targets keep change history"}, "seconds": 0}
+            save_result(project_id, results[name])
+    else:
+        results = reconcile_tables(project, table_names, mode=mode, max_workers=max_workers, job=job)
+
+    summary = {}
+    for result in results.values():
+        summary[result["status"]] = summary.get(result["status"], 0) + 1
+    return {
+        "project_id": project_id,
+        "mode": mode,
+        "summary": summary,
+        "tables": [results[name] for name in table_names if name in results],
+        "seconds": round(time.monotonic() - started, 3),
+    }
@@ -0,0 +1,337 @@
+"""Планировщик расписаний проектов: разнесение запусков по времени.
+
+По cron-выражениям update_dags_schedule и transfer_dags_schedule строятся
+моменты запуска всех проектов на горизонт планирования, запуски
+группируются по source_connection_id (один сервер MSSQL) и считается,
+сколько заданий одновременно работает с каждым сервером. Для заданий,
+из-за которых пик превышает schedule_max_concurrent_per_source,
+предлагается сдвиг минуты запуска. Сдвигаются и поля минут вида '*/15',
+'0,30', '10-20' и '5-50/15': все минуты поля смещаются на одно и то же
+число в пределах часа.
+
+Время считается в минутах от начала горизонта; моменты запуска считаются
+один раз на каждое уникальное cron-выражение, поэтому сотни проектов с
+одинаковым '0 * * * *' стоят один вызов croniter. Нагрузка источника -
+гистограмма по минутам горизонта; для каждого задания один раз строится
+максимум нагрузки под всеми его запусками при каждом возможном сдвиге.
+"""
+import logging
+import re
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from airflow.configuration import conf
+from croniter import croniter
+
+log = logging.getLogger(__name__)
+
+PLANNER_HORIZON_HOURS = conf.getint("atk_ct", "schedule_planner_horizon_hours", fallback=24)
+PLANNER_MAX_HORIZON_HOURS = 24 * 7
+MAX_CONCURRENT_PER_SOURCE = conf.getint("atk_ct", "schedule_max_concurrent_per_source", fallback=2)
+#  Оценка длительности заданий в минутах: пока задание работает, оно занимает сервер источника
+UPDATE_JOB_MINUTES = conf.getint("atk_ct", "schedule_update_job_minutes", fallback=5)
+TRANSFER_JOB_MINUTES = conf.getint("atk_ct", "schedule_transfer_job_minutes", fallback=15)
+
+UPDATE = "update"
+TRANSFER = "transfer"
+
+#  Сокращения croniter, которые раскрываются в пять полей, чтобы можно было сдвигать минуту
+CRON_ALIASES = {
+    "@hourly": "0 * * * *",
+    "@daily": "0 0 * * *",
+    "@midnight": "0 0 * * *",
+    "@weekly": "0 0 * * 0",
+    "@monthly": "0 0 1 * *",
+    "@yearly": "0 0 1 1 *",
+    "@annually": "0 0 1 1 *",
+}
+
+#  Элемент поля минут: '*', 'a', 'a-b' с необязательным шагом '/k'
+MINUTE_ITEM_RE = re.compile(r"^(\*|\d+)(?:-(\d+))?(?:/(\d+))?$")
+
+
+def _minute_items(field):
+    """Элементы поля минут как (первая, последняя, шаг) или None, если поле не сдвигается.
+
+    Последняя минута - фактически последняя с учетом шага: '*/15' дает (0, 45, 15).
+    """
+    items = []
+    for item in field.split(","):
+        match = MINUTE_ITEM_RE.match(item)
+        if match is None:
+            return None
+        low, high, step = match.groups()
+        step = int(step) if step else 1
+        if low == "*":
+            if high is not None or step == 1:
+                #  '*' - каждая минута, сдвигать нечего
+                return None
+            low, high = 0, 59
+        else:
+            low = int(low)
+            high = int(high) if high is not None else (59 if match.group(3) else low)
+        if step < 1 or high < low or high > 59:
+            return None
+        items.append((low, low + (high - low) // step * step, step))
+    return items
+
+
+def _format_minute_item(low, high, step):
+    if low == high:
+        return str(low)
+    return f"{low}-{high}" + (f"/{step}" if step > 1 else "")
+
+
+class PlannedJob:
+    """Одно задание проекта (обновление или перекачка) и его запуски на горизонте"""
+
+    def __init__(self, project_id, kind, source, schedule, duration, fires, next_runs):
+        self.project_id = project_id
+        self.kind = kind
+        self.source = source
+        self.schedule = schedule
+        self.duration = duration
+        self.fires = fires
+        self.next_runs = next_runs
+        self.shift = 0
+
+    @property
+    def minute_items(self):
+        """Элементы поля минут (см. _minute_items); None - задание не сдвигается"""
+        return _minute_items(self.schedule.split()[0])
+
+    @property
+    def shift_range(self):
+        """Допустимые сдвиги (от, до включительно): все минуты остаются в пределах часа; None - без сдвига"""
+        items = self.minute_items
+        if items is None:
+            return None
+        return -min(low for low, _, _ in items), 59 - max(high for _, high, _ in items)
+
+    @property
+    def suggested_schedule(self):
+        if not self.shift:
+            return self.schedule
+        fields = self.schedule.split()
+        fields[0] = ",".join(
+            _format_minute_item(low + self.shift, high + self.shift, step) for low, high, step in self.minute_items
+        )
+        return " ".join(fields)
+
+    def to_dict(self):
+        return {
+            "project_id": self.project_id,
+            "kind": self.kind,
+            "source": self.source,
+            "schedule": self.schedule,
+            "suggested_schedule": self.suggested_schedule,
+            "shift_minutes": self.shift,
+            "duration_minutes": self.duration,
+            "runs_in_horizon": len(self.fires),
+            "next_runs": self.next_runs,
+        }
+
+
+def normalize_schedule(raw):
+    """Cron-выражение из пяти полей или None, если расписание пустое или неверное"""
+    raw = (raw or "").strip()
+    raw = CRON_ALIASES.get(raw.lower(), raw)
+    if not raw or len(raw.split()) != 5 or not croniter.is_valid(raw):
+        return None
+    return " ".join(raw.split())
+
+
+def _fire_minutes(schedule, start, horizon):
+    """Моменты запуска cron-выражения в минутах от start в пределах horizon минут"""
+    itr = croniter(schedule, start - timedelta(seconds=1))
+    fires = []
+    while True:
+        offset = int((itr.get_next(datetime) - start).total_seconds() // 60)
+        if offset >= horizon:
+            return fires
+        fires.append(offset)
+
+
+def _start_offset(raw, start):
+    """Минута горизонта, до которой задание не запускается (start_date проекта в будущем)"""
+    if not raw:
+        return 0
+    if isinstance(raw, str):
+        try:
+            raw = datetime.fromisoformat(raw)
+        except ValueError:
+            return 0
+    if raw.tzinfo is None:
+        raw = raw.replace(tzinfo=timezone.utc)
+    return max(0, int((raw - start).total_seconds() // 60))
+
+
+def build_jobs(projects, start, horizon, next_count=5):
+    """Задания всех проектов с моментами запуска; неверные расписания возвращаются отдельно"""
+    fires_cache = {}
+    jobs, invalid = [], []
+    for project in projects:
+        kinds = [(UPDATE, "update_dags_schedule", "update_dags_start_date", UPDATE_JOB_MINUTES)]
+        if project.get("transfer_source_data"):
+            kinds.append((TRANSFER, "transfer_dags_schedule", "transfer_dags_start_date", TRANSFER_JOB_MINUTES))
+        for kind, schedule_key, start_key, duration in kinds:
+            raw = project.get(schedule_key)
+            if not (raw or "").strip():
+                continue
+            schedule = normalize_schedule(raw)
+            if schedule is None:
+                invalid.append({"project_id": project["ct_project_id"], "kind": kind, "schedule": raw})
+                continue
+            if schedule not in fires_cache:
+                fires_cache[schedule] = _fire_minutes(schedule, start, horizon)
+            not_before = _start_offset(project.get(start_key), start)
+            fires = [f for f in fires_cache[schedule] if f >= not_before]
+            next_runs = [(start + timedelta(minutes=f)).isoformat() for f in fires[:next_count]]
+            source = (project.get("source_connection_id") or "").strip() or "-"
+            jobs.append(PlannedJob(project["ct_project_id"], kind, source, schedule, duration, fires, next_runs))
+    return jobs, invalid
+
+
+class _SourceLoad:
+    """Гистограмма числа одновременно работающих заданий источника по минутам горизонта"""
+
+    #  Запас слева: запуск в начале горизонта со сдвигом назад (до -59 минут) уходит до его начала.
+    #  Минута горизонта m хранится в load[m + PAD]
+    PAD = 60
+
+    def __init__(self, horizon):
+        #  Запас справа: задание, запущенное в конце горизонта, со сдвигом до 59 минут
+        self.load = [0] * (self.PAD + horizon + 60 + max(UPDATE_JOB_MINUTES, TRANSFER_JOB_MINUTES))
+
+    def add(self, job, shift=0):
+        load, duration = self.load, job.duration
+        for fire in job.fires:
+            begin = fire + shift + self.PAD
+            load[begin:begin + duration] = [busy + 1 for busy in load[begin:begin + duration]]
+
+    def add_all(self, jobs):
+        """Добавить задания без сдвига разом: разностный массив вместо прохода по каждой минуте"""
+        delta = [0] * (len(self.load) + 1)
+        for job in jobs:
+            for fire in job.fires:
+                delta[fire + self.PAD] += 1
+                delta[fire + self.PAD + job.duration] -= 1
+        busy = 0
+        for minute in range(len(self.load)):
+            busy += delta[minute]
+            self.load[minute] += busy
+
+    def peaks(self, job, low, high):
+        """Пик нагрузки под запусками job для каждого сдвига от low до high (с учетом самого job).
+
+        Максимум по всем запускам для каждой минуты окна считается один раз (map по срезам),
+        после чего пик сдвига - максимум окна длиной duration.
+        """
+        load, duration = self.load, job.duration
+        width = high - low + duration
+        begins = [fire + low + self.PAD for fire in job.fires]
+        under = list(map(max, *[load[begin:begin + width] for begin in begins])) \
+            if len(begins) > 1 else load[begins[0]:begins[0] + width]
+        return {shift: max(under[shift - low:shift - low + duration]) + 1 for shift in range(low, high + 1)}
+
+    def peak(self):
+        return max(self.load) if self.load else 0
+
+
+def _place(source_load, job, limit):
+    """Выбрать сдвиг минуты запуска: без сдвига, если пик не превышает limit, иначе минимальный пик"""
+    shift_range = job.shift_range
+    if shift_range is None or not job.fires:
+        return 0
+    peaks = source_load.peaks(job, *shift_range)
+    if peaks[0] <= limit:
+        return 0
+    #  Сдвиги перебираются от ближних к дальним: первый, укладывающийся в limit, и есть ответ
+    best_peak, best_shift = None, 0
+    for shift in sorted(peaks, key=abs):
+        peak = peaks[shift]
+        if peak <= limit:
+            return shift
+        if best_peak is None or peak < best_peak:
+            best_peak, best_shift = peak, shift
+    return best_shift
+
+
+def _collisions(jobs, start, limit, top=50):
+    """Минуты, в которые одновременно стартует больше одного задания источника"""
+    by_minute = defaultdict(list)
+    for job in jobs:
+        for fire in job.fires:
+            by_minute[fire].append(f"{job.project_id}:{job.kind}")
+    collisions = [
+        {"at": (start + timedelta(minutes=minute)).isoformat(), "jobs": sorted(names),
+         "count": len(names), "over_limit": len(names) > limit}
+        for minute, names in by_minute.items() if len(names) > 1
+    ]
+    collisions.sort(key=lambda c: (-c["count"], c["at"]))
+    return len(collisions), collisions[:top]
+
+
+def plan_schedules(projects, start=None, horizon_hours=None, limit=None, next_count=5):
+    """Нагрузка на источники, совпадения запусков и предложения по сдвигу расписаний"""
+    started = time.monotonic()
+    horizon_hours = min(horizon_hours or PLANNER_HORIZON_HOURS, PLANNER_MAX_HORIZON_HOURS)
+    limit = limit or MAX_CONCURRENT_PER_SOURCE
+    start = (start or datetime.now(timezone.utc)).replace(second=0, microsecond=0)
+    horizon = horizon_hours * 60
+
+    jobs, invalid = build_jobs(projects, start, horizon, next_count)
+    by_source = defaultdict(list)
+    for job in jobs:
+        by_source[job.source].append(job)
+
+    sources, suggestions = [], []
+    for source, source_jobs in sorted(by_source.items()):
+        current = _SourceLoad(horizon)
+        current.add_all(source_jobs)
+
+        #  Сначала задания, которые нельзя сдвинуть, затем самые частые: их труднее разместить
+        planned = _SourceLoad(horizon)
+        order = sorted(source_jobs, key=lambda j: (j.shift_range is not None, -len(j.fires), j.project_id, j.kind))
+        for job in order:
+            job.shift = _place(planned, job, limit)
+            planned.add(job, job.shift)
+            if job.shift:
+                suggestions.append(job.to_dict())
+
+        collision_count, collisions = _collisions(source_jobs, start, limit)
+        sources.append({
+            "source": source,
+            "jobs": len(source_jobs),
+            "peak": current.peak(),
+            "suggested_peak": planned.peak(),
+            "over_limit": current.peak() > limit,
+            "collision_count": collision_count,
+            "collisions": collisions,
+        })
+
+    return {
+        "start": start.isoformat(),
+        "horizon_hours": horizon_hours,
+        "limit": limit,
+        "sources": sources,
+        "suggestions": suggestions,
+        "jobs": [job.to_dict() for job in jobs],
+        "invalid": invalid,
+        "seconds": round(time.monotonic() - started, 3),
+    }
+
+
+def plan_all_projects(**kwargs):
+    """plan_schedules по всем проектам из atk_ct.ct_projects"""
+    from ct_pool import pg_connection
+    from ct_store import list_projects
+
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            projects = list_projects(cursor)
+        finally:
+            cursor.close()
+    return plan_schedules(projects, **kwargs)
@@ -0,0 +1,432 @@
+"""Версионированные миграции схемы atk_ct в Postgres.
+
+Каждая миграция выполняется в своей транзакции под advisory lock и
+записывается в atk_ct.ct_schema_version, поэтому повторный запуск, в том
+числе из нескольких воркеров одновременно, ничего не меняет. Миграции
+написаны так, чтобы их можно было применить и к уже существующим
+таблицам, созданным вручную.
+
+Применяются в фоновом потоке при загрузке плагина (start_schema_upgrade),
+перед выгрузками в задачах DAG или вручную:
+
+    python ct_schema.py upgrade
+    python ct_schema.py version
+"""
+import argparse
+import logging
+import threading
+import time
+
+from airflow.configuration import conf
+
+from ct_pool import DEFAULT_POSTGRES_CONN_ID, pg_connection
+
+log = logging.getLogger(__name__)
+
+SCHEMA_AUTO_UPGRADE = conf.getboolean("atk_ct", "schema_auto_upgrade", fallback=True)
+#  Пауза перед повторной попыткой после неудачной миграции, секунды
+SCHEMA_RETRY_INTERVAL = 60
+
+#  Ключ pg_advisory_xact_lock: одна миграция atk_ct в один момент времени
+MIGRATION_LOCK_KEY = 0x61746B5F6374
+#  Ключ блокировки записи в ct_tables из миграции 5 (заменена миграцией 8)
+TABLES_VERSION_LOCK_KEY = 0x61746B5F7476
+#  Старшие 16 бит первого ключа pg_advisory_xact_lock_shared(int, int), которую берет запись в ct_tables;
+#  остальные 48 бит двух ключей - значение ct_tables_version_seq до первой версии транзакции
+TABLES_WRITER_LOCK_TAG = 0x6374
+
+VERSION_TABLE_DDL = """
+    CREATE SCHEMA IF NOT EXISTS atk_ct;
+    CREATE TABLE IF NOT EXISTS atk_ct.ct_schema_version (
+        version integer PRIMARY KEY,
+        description text NOT NULL,
+        applied_at timestamptz NOT NULL DEFAULT now()
+    );
+"""
+
+MIGRATIONS = [
+    (1, "ct_projects and ct_tables with unique keys", """
+        CREATE TABLE IF NOT EXISTS atk_ct.ct_projects (
+            ct_project_id text PRIMARY KEY,
+            source_connection_id text,
+            one_c_database text,
+            biview_database text,
+            biview_project_type integer,
+            ct_database text,
+            transfer_source_data boolean NOT NULL DEFAULT false,
+            target_connection_id text,
+            target_database text,
+            target_type text,
+            update_dags_start_date timestamp,
+            update_dags_schedule text,
+            transfer_dags_start_date timestamp,
+            transfer_dags_schedule text
+        );
+        CREATE UNIQUE INDEX IF NOT EXISTS ct_projects_ct_project_id_key
+            ON atk_ct.ct_projects (ct_project_id);
+
+        CREATE TABLE IF NOT EXISTS atk_ct.ct_tables (
+            project_id text NOT NULL,
+            table_name text NOT NULL,
+            load boolean NOT NULL DEFAULT true
+        );
+        --  В таблицах, созданных вручную, могли накопиться дубли: оставляем одну строку
+        DELETE FROM atk_ct.ct_tables a
+        USING atk_ct.ct_tables b
+        WHERE a.project_id = b.project_id
+          AND a.table_name = b.table_name
+          AND a.ctid > b.ctid;
+        CREATE UNIQUE INDEX IF NOT EXISTS ct_tables_project_id_table_name_key
+            ON atk_ct.ct_tables (project_id, table_name);
+    """),
+    (2, "indexes for grid filters and project grouping", """
+        CREATE INDEX IF NOT EXISTS ct_tables_project_id_load_idx
+            ON atk_ct.ct_tables (project_id, load, table_name);
+        CREATE INDEX IF NOT EXISTS ct_projects_source_connection_id_idx
+            ON atk_ct.ct_projects (source_connection_id, ct_database);
+        --  Фильтры грида contains/endsWith (ILIKE '%...%') используют триграммы, если pg_trgm доступен
+        DO $$
+        BEGIN
+            CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        EXCEPTION WHEN OTHERS THEN
+            RAISE NOTICE 'pg_trgm is not available (%), ct_tables.table_name trigram index skipped', SQLERRM;
+        END
+        $$;
+        DO $$
+        BEGIN
+            IF EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') THEN
+                CREATE INDEX IF NOT EXISTS ct_tables_table_name_trgm_idx
+                    ON atk_ct.ct_tables USING gin (table_name gin_trgm_ops);
+            END IF;
+        END
+        $$;
+    """),
+    (3, "transfer state: table stats and change tracking versions", """
+        ALTER TABLE atk_ct.ct_tables
+            ADD COLUMN IF NOT EXISTS row_count bigint,
+            ADD COLUMN IF NOT EXISTS reserved_kb bigint,
+            ADD COLUMN IF NOT EXISTS stats_updated_at timestamptz;
+        CREATE TABLE IF NOT EXISTS atk_ct.ct_sync_state (
+            project_id text NOT NULL,
+            table_name text NOT NULL,
+            last_version bigint,
+            last_mode text,
+            rows_synced bigint,
+            synced_at timestamptz,
+            PRIMARY KEY (project_id, table_name)
+        );
+    """),
+    (4, "change counters for HTTP ETags", """
+        --  Версия - значение общей последовательности, поэтому она не повторяется и после удаления ключа
+        CREATE SEQUENCE IF NOT EXISTS atk_ct.ct_change_seq;
+        CREATE TABLE IF NOT EXISTS atk_ct.ct_change_counters (
+            key text PRIMARY KEY,
+            version bigint NOT NULL,
+            updated_at timestamptz NOT NULL DEFAULT now()
+        );
+
+        CREATE OR REPLACE FUNCTION atk_ct.ct_bump_versions(keys text[]) RETURNS void
+        LANGUAGE sql AS $$
+            INSERT INTO atk_ct.ct_change_counters AS c (key, version, updated_at)
+            SELECT k, nextval('atk_ct.ct_change_seq'), now()
+            FROM (SELECT DISTINCT unnest(keys) AS k) s
+            WHERE k IS NOT NULL
+            ORDER BY k
+            ON CONFLICT (key) DO UPDATE
+            SET version = EXCLUDED.version, updated_at = EXCLUDED.updated_at;
+        $$;
+
+        --  Операторные триггеры: один вызов на INSERT/UPDATE/DELETE, сколько бы строк он ни затронул
+        CREATE OR REPLACE FUNCTION atk_ct.ct_tables_changed() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM atk_ct.ct_bump_versions(ARRAY(SELECT project_id FROM new_rows));
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM atk_ct.ct_bump_versions(ARRAY(SELECT project_id FROM old_rows));
+            ELSE
+                PERFORM atk_ct.ct_bump_versions(ARRAY(
+                    SELECT project_id FROM new_rows UNION SELECT project_id FROM old_rows
+                ));
+            END IF;
+            RETURN NULL;
+        END
+        $$;
+
+        CREATE OR REPLACE FUNCTION atk_ct.ct_projects_changed() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                PERFORM atk_ct.ct_bump_versions(ARRAY(SELECT ct_project_id FROM new_rows) || '*'::text);
+            ELSIF TG_OP = 'DELETE' THEN
+                PERFORM atk_ct.ct_bump_versions(ARRAY(SELECT ct_project_id FROM old_rows) || '*'::text);
+            ELSE
+                PERFORM atk_ct.ct_bump_versions(ARRAY(
+                    SELECT ct_project_id FROM new_rows UNION SELECT ct_project_id FROM old_rows
+                ) || '*'::text);
+            END IF;
+            RETURN NULL;
+        END
+        $$;
+
+        DROP TRIGGER IF EXISTS ct_tables_changed_insert ON atk_ct.ct_tables;
+        DROP TRIGGER IF EXISTS ct_tables_changed_update ON atk_ct.ct_tables;
+        DROP TRIGGER IF EXISTS ct_tables_changed_delete ON atk_ct.ct_tables;
+        CREATE TRIGGER ct_tables_changed_insert AFTER INSERT ON atk_ct.ct_tables
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE atk_ct.ct_tables_changed();
+        CREATE TRIGGER ct_tables_changed_update AFTER UPDATE ON atk_ct.ct_tables
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE atk_ct.ct_tables_changed();
+        CREATE TRIGGER ct_tables_changed_delete AFTER DELETE ON atk_ct.ct_tables
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE atk_ct.ct_tables_changed();
+
+        DROP TRIGGER IF EXISTS ct_projects_changed_insert ON atk_ct.ct_projects;
+        DROP TRIGGER IF EXISTS ct_projects_changed_update ON atk_ct.ct_projects;
+        DROP TRIGGER IF EXISTS ct_projects_changed_delete ON atk_ct.ct_projects;
+        CREATE TRIGGER ct_projects_changed_insert AFTER INSERT ON atk_ct.ct_projects
+            REFERENCING NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE atk_ct.ct_projects_changed();
+        CREATE TRIGGER ct_projects_changed_update AFTER UPDATE ON atk_ct.ct_projects
+            REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE atk_ct.ct_projects_changed();
+        CREATE TRIGGER ct_projects_changed_delete AFTER DELETE ON atk_ct.ct_projects
+            REFERENCING OLD TABLE AS old_rows
+            FOR EACH STATEMENT EXECUTE PROCEDURE atk_ct.ct_projects_changed();
+    """),
+    (5, "ct_tables row versions and tombstones for delta sync", f"""
+        CREATE SEQUENCE IF NOT EXISTS atk_ct.ct_tables_version_seq;
+        ALTER TABLE atk_ct.ct_tables
+            ADD COLUMN IF NOT EXISTS row_version bigint,
+            ADD COLUMN IF NOT EXISTS updated_at timestamptz;
+        UPDATE atk_ct.ct_tables
+        SET row_version = nextval('atk_ct.ct_tables_version_seq'), updated_at = now()
+        WHERE row_version IS NULL;
+        CREATE INDEX IF NOT EXISTS ct_tables_project_id_row_version_idx
+            ON atk_ct.ct_tables (project_id, row_version);
+
+        CREATE TABLE IF NOT EXISTS atk_ct.ct_tables_deleted (
+            project_id text NOT NULL,
+            table_name text NOT NULL,
+            row_version bigint NOT NULL,
+            deleted_at timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY (project_id, table_name)
+        );
+        CREATE INDEX IF NOT EXISTS ct_tables_deleted_project_id_row_version_idx
+            ON atk_ct.ct_tables_deleted (project_id, row_version);
+
+        --  Пока транзакция пишет в ct_tables, граница версий (ct_store.tables_watermark) не читается:
+        --  все версии не больше границы уже зафиксированы
+        CREATE OR REPLACE FUNCTION atk_ct.ct_tables_write_lock() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            PERFORM pg_advisory_xact_lock_shared({TABLES_VERSION_LOCK_KEY});
+            RETURN NULL;
+        END
+        $$;
+
+        CREATE OR REPLACE FUNCTION atk_ct.ct_tables_stamp() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            IF TG_OP = 'UPDATE' AND NEW IS NOT DISTINCT FROM OLD THEN
+                RETURN NEW;
+            END IF;
+            NEW.row_version := nextval('atk_ct.ct_tables_version_seq');
+            NEW.updated_at := now();
+            RETURN NEW;
+        END
+        $$;
+
+        CREATE OR REPLACE FUNCTION atk_ct.ct_tables_tombstone() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        BEGIN
+            INSERT INTO atk_ct.ct_tables_deleted (project_id, table_name, row_version, deleted_at)
+            VALUES (OLD.project_id, OLD.table_name, nextval('atk_ct.ct_tables_version_seq'), now())
+            ON CONFLICT (project_id, table_name) DO UPDATE
+            SET row_version = EXCLUDED.row_version, deleted_at = EXCLUDED.deleted_at;
+            RETURN NULL;
+        END
+        $$;
+
+        DROP TRIGGER IF EXISTS ct_tables_write_lock ON atk_ct.ct_tables;
+        DROP TRIGGER IF EXISTS ct_tables_stamp ON atk_ct.ct_tables;
+        DROP TRIGGER IF EXISTS ct_tables_tombstone ON atk_ct.ct_tables;
+        CREATE TRIGGER ct_tables_write_lock BEFORE INSERT OR UPDATE OR DELETE ON atk_ct.ct_tables
+            FOR EACH STATEMENT EXECUTE PROCEDURE atk_ct.ct_tables_write_lock();
+        CREATE TRIGGER ct_tables_stamp BEFORE INSERT OR UPDATE ON atk_ct.ct_tables
+            FOR EACH ROW EXECUTE PROCEDURE atk_ct.ct_tables_stamp();
+        CREATE TRIGGER ct_tables_tombstone AFTER DELETE ON atk_ct.ct_tables
+            FOR EACH ROW EXECUTE PROCEDURE atk_ct.ct_tables_tombstone();
+    """),
+    (6, "source/target reconciliation results", """
+        CREATE TABLE IF NOT EXISTS atk_ct.ct_reconcile_results (
+            project_id text NOT NULL,
+            table_name text NOT NULL,
+            status text NOT NULL,
+            mode text NOT NULL,
+            source_rows bigint,
+            target_rows bigint,
+            ranges_checked integer NOT NULL DEFAULT 0,
+            mismatched_ranges integer NOT NULL DEFAULT 0,
+            details jsonb,
+            seconds double precision,
+            checked_at timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY (project_id, table_name)
+        );
+    """),
+    (7, "column catalog of source tables with target types and DDL", """
+        CREATE TABLE IF NOT EXISTS atk_ct.ct_column_catalog (
+            connection_id text NOT NULL,
+            database_name text NOT NULL,
+            table_name text NOT NULL,
+            columns jsonb NOT NULL,
+            key_columns text[] NOT NULL DEFAULT '{}',
+            ods_ddl text NOT NULL,
+            hods_ddl text NOT NULL,
+            modify_date timestamp,
+            updated_at timestamptz NOT NULL DEFAULT now(),
+            PRIMARY KEY (connection_id, database_name, table_name)
+        );
+    """),
+    (8, "non-blocking ct_tables version watermark", f"""
+        --  Запись не ждет читателей и наоборот: транзакция, пишущая в ct_tables, до выдачи версий
+        --  объявляет в pg_locks нижнюю границу своих версий, а ct_store.tables_watermark
+        --  берет границу ниже всех объявленных, ничего не блокируя
+        CREATE OR REPLACE FUNCTION atk_ct.ct_tables_write_lock() RETURNS trigger
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            floor_version bigint;
+        BEGIN
+            SELECT last_value INTO floor_version FROM atk_ct.ct_tables_version_seq;
+            PERFORM pg_advisory_xact_lock_shared(
+                (({TABLES_WRITER_LOCK_TAG}::bigint << 16) | (floor_version >> 32))::integer,
+                floor_version::bit(32)::integer
+            );
+            RETURN NULL;
+        END
+        $$;
+    """),
+    (9, "background job states shared by webserver workers", """
+        CREATE TABLE IF NOT EXISTS atk_ct.ct_jobs (
+            job_id      text PRIMARY KEY,
+            kind        text NOT NULL,
+            job_key     text,
+            state       text NOT NULL,
+            progress    double precision NOT NULL DEFAULT 0,
+            message     text,
+            result      jsonb,
+            error       text,
+            created_at  timestamptz NOT NULL,
+            finished_at timestamptz,
+            updated_at  timestamptz NOT NULL DEFAULT now()
+        );
+        CREATE INDEX IF NOT EXISTS ct_jobs_finished_at_idx ON atk_ct.ct_jobs (finished_at);
+    """),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def _applied_versions(cursor):
+    cursor.execute("SELECT version FROM atk_ct.ct_schema_version;")
+    return {row[0] for row in cursor.fetchall()}
+
+
+def current_version(conn_id=DEFAULT_POSTGRES_CONN_ID):
+    """Последняя примененная миграция (0, если схема еще не создавалась)"""
+    with pg_connection(conn_id) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT to_regclass('atk_ct.ct_schema_version') IS NOT NULL;")
+            if not cursor.fetchone()[0]:
+                return 0
+            return max(_applied_versions(cursor), default=0)
+        finally:
+            cursor.close()
+
+
+def upgrade(conn_id=DEFAULT_POSTGRES_CONN_ID):
+    """Применить недостающие миграции; возвращает номера примененных"""
+    applied = []
+    with pg_connection(conn_id) as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_KEY, ))
+            cursor.execute(VERSION_TABLE_DDL)
+            conn.commit()
+            for version, description, sql in MIGRATIONS:
+                #  Блокировка и проверка версии в одной транзакции с миграцией
+                cursor.execute("SELECT pg_advisory_xact_lock(%s);", (MIGRATION_LOCK_KEY, ))
+                if version in _applied_versions(cursor):
+                    conn.rollback()
+                    continue
+                log.info("Applying atk_ct schema migration %s: %s", version, description)
+                cursor.execute(sql)
+                cursor.execute(
+                    "INSERT INTO atk_ct.ct_schema_version (version, description) VALUES (%s, %s);",
+                    (version, description)
+                )
+                conn.commit()
+                applied.append(version)
+        finally:
+            cursor.close()
+    return applied
+
+
+_ensure_lock = threading.Lock()
+_ensure_state = {"ready": False, "retry_at": 0.0}
+
+
+def ensure_schema(wait=True):
+    """Применить миграции один раз за процесс; ошибка логируется, попытка повторится позже.
+
+    Без wait не ждет поток, который уже применяет миграции (и его соединения с базой),
+    а сразу возвращает False - для обработчиков запросов вебсервера.
+    """
+    if _ensure_state["ready"] or not SCHEMA_AUTO_UPGRADE:
+        return True
+    if time.monotonic() < _ensure_state["retry_at"]:
+        return False
+    if not _ensure_lock.acquire(blocking=wait):
+        return False
+    try:
+        if _ensure_state["ready"]:
+            return True
+        if time.monotonic() < _ensure_state["retry_at"]:
+            return False
+        try:
+            applied = upgrade()
+        except Exception:
+            log.exception("atk_ct schema migration failed, retrying in %ss", SCHEMA_RETRY_INTERVAL)
+            _ensure_state["retry_at"] = time.monotonic() + SCHEMA_RETRY_INTERVAL
+            return False
+        if applied:
+            log.info("atk_ct schema upgraded to version %s", LATEST_VERSION)
+        _ensure_state["ready"] = True
+        return True
+    finally:
+        _ensure_lock.release()
+
+
+def start_schema_upgrade():
+    """Применить миграции в фоновом потоке, чтобы недоступный Postgres не задерживал запуск процесса"""
+    if _ensure_state["ready"] or not SCHEMA_AUTO_UPGRADE:
+        return
+    threading.Thread(target=ensure_schema, name="ct_schema_upgrade", daemon=True).start()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="atk_ct schema migrations")
+    parser.add_argument("command", choices=["upgrade", "version"])
+    parser.add_argument("--conn-id", default=DEFAULT_POSTGRES_CONN_ID)
+    args = parser.parse_args(argv)
+    if args.command == "upgrade":
+        applied = upgrade(args.conn_id)
+        print(f"Applied migrations: {applied}" if applied else "Schema is up to date")
+    print(f"Schema version: {current_version(args.conn_id)} (latest {LATEST_VERSION})")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    main()
@@ -0,0 +1,108 @@
+"""Локальный снимок настроек проектов для фабрики DAG.
+
+Плагин перезаписывает снимок после каждого сохранения проекта и в фоне
+при загрузке (проекты, созданные до установки, тоже получают DAG), а
+ct_dag_factory читает его при разборе DAG-файлов, не обращаясь к Postgres.
+Вручную снимок перестраивается командой:
+
+    python ct_snapshot.py
+Списки таблиц в снимок не входят: задача перекачки читает их из
+atk_ct.ct_tables во время запуска, поэтому изменения таблиц снимок не трогают.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+
+from airflow.configuration import conf
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_PATH = conf.get(
+    "atk_ct", "config_snapshot_path",
+    fallback=os.path.join(conf.get("core", "dags_folder"), "atk_ct_projects.json"),
+)
+
+_cache = {"mtime": None, "snapshot": None}
+
+
+def _json_default(value):
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def build_snapshot():
+    """Прочитать настройки проектов из Postgres"""
+    from ct_pool import pg_connection
+    from ct_store import list_projects
+
+    with pg_connection() as conn:
+        cursor = conn.cursor()
+        try:
+            projects = list_projects(cursor)
+        finally:
+            cursor.close()
+
+    body = json.dumps(projects, default=_json_default, sort_keys=True)
+    return {
+        "version": hashlib.sha1(body.encode("utf-8")).hexdigest(),
+        "generated_at": datetime.now(timezone.utc).isoformat(),
+        "projects": json.loads(body),
+    }
+
+
+def write_snapshot(path=None):
+    """Перезаписать снимок атомарно; файл не трогается, если версия не изменилась"""
+    path = path or SNAPSHOT_PATH
+    snapshot = build_snapshot()
+    current = load_snapshot(path)
+    if current and current.get("version") == snapshot["version"]:
+        return current
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    return snapshot
+
+
+def refresh_snapshot():
+    """Обновить снимок после изменения настроек; ошибка только логируется"""
+    try:
+        return write_snapshot()
+    except Exception:
+        log.exception("Failed to refresh project config snapshot %s", SNAPSHOT_PATH)
+        return None
+
+
+def start_snapshot_refresh():
+    """refresh_snapshot в фоновом потоке, чтобы недоступный Postgres не задерживал запуск процесса"""
+    threading.Thread(target=refresh_snapshot, name="ct_snapshot_refresh", daemon=True).start()
+
+
+def load_snapshot(path=None):
+    """Снимок из файла (перечитывается только при изменении mtime); None, если файла нет"""
+    path = path or SNAPSHOT_PATH
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+    if path == SNAPSHOT_PATH and _cache["mtime"] == mtime:
+        return _cache["snapshot"]
+    try:
+        with open(path, encoding="utf-8") as f:
+            snapshot = json.load(f)
+    except ValueError:
+        log.warning("Ignoring broken project config snapshot %s", path)
+        return None
+    if path == SNAPSHOT_PATH:
+        _cache.update(mtime=mtime, snapshot=snapshot)
+    return snapshot
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    written = write_snapshot()
+    print(f"Snapshot {SNAPSHOT_PATH}: {len(written['projects'])} projects, version {written['version']}")
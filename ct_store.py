@@ -0,0 +1,700 @@
+"""Запросы к таблицам схемы atk_ct в Postgres"""
+import json
+import logging
+
+from ct_schema import TABLES_WRITER_LOCK_TAG
+
+log = logging.getLogger(__name__)
+
+#  Один запрос: вставка новых таблиц, удаление исчезнувших из источника и подсчет результата
+SYNC_TABLES_SQL = """
+    WITH src AS (
+        SELECT DISTINCT unnest(%(table_names)s::text[]) AS table_name
+    ),
+    inserted AS (
+        INSERT INTO atk_ct.ct_tables (project_id, table_name, load)
+        SELECT %(project_id)s, src.table_name, %(load)s
+        FROM src
+        ON CONFLICT (project_id, table_name) DO NOTHING
+        RETURNING 1
+    ),
+    removed AS (
+        DELETE FROM atk_ct.ct_tables t
+        WHERE t.project_id = %(project_id)s
+          AND %(prune)s
+          AND NOT EXISTS (SELECT 1 FROM src WHERE src.table_name = t.table_name)
+        RETURNING 1
+    )
+    SELECT
+        (SELECT count(*) FROM src),
+        (SELECT count(*) FROM inserted),
+        (SELECT count(*) FROM removed);
+"""
+
+
+def sync_tables(cursor, project_id, table_names, load=True, prune=True, prune_empty=False):
+    """Синхронизировать список таблиц проекта в atk_ct.ct_tables за один round-trip.
+
+    Пустой список таблиц (пустая или неверно настроенная база, сбой обнаружения)
+    не удаляет таблицы проекта вместе с флагами load, если не передан prune_empty.
+    Возвращает словарь со счетчиками inserted/unchanged/removed.
+    Транзакцию фиксирует вызывающий код.
+    """
+    table_names = list(table_names)
+    if prune and not table_names and not prune_empty:
+        log.warning("No tables discovered for project %s, keeping its table list", project_id)
+        prune = False
+    cursor.execute(SYNC_TABLES_SQL, {
+        "project_id": project_id,
+        "table_names": table_names,
+        "load": load,
+        "prune": prune,
+    })
+    total, inserted, removed = cursor.fetchone()
+    return {"inserted": inserted, "unchanged": total - inserted, "removed": removed}
+
+
+#  То же для нескольких проектов сразу: пары (project_id, table_name) передаются двумя массивами
+SYNC_TABLES_BULK_SQL = """
+    WITH src AS (
+        SELECT DISTINCT p.project_id, p.table_name
+        FROM unnest(%(project_ids)s::text[], %(table_names)s::text[]) AS p(project_id, table_name)
+    ),
+    projects AS (
+        SELECT DISTINCT unnest(%(synced_projects)s::text[]) AS project_id
+    ),
+    inserted AS (
+        INSERT INTO atk_ct.ct_tables (project_id, table_name, load)
+        SELECT src.project_id, src.table_name, %(load)s
+        FROM src
+        ON CONFLICT (project_id, table_name) DO NOTHING
+        RETURNING project_id
+    ),
+    removed AS (
+        DELETE FROM atk_ct.ct_tables t
+        USING unnest(%(pruned_projects)s::text[]) AS p(project_id)
+        WHERE t.project_id = p.project_id
+          AND NOT EXISTS (
+              SELECT 1 FROM src WHERE src.project_id = t.project_id AND src.table_name = t.table_name
+          )
+        RETURNING t.project_id
+    )
+    SELECT p.project_id, coalesce(s.n, 0), coalesce(i.n, 0), coalesce(r.n, 0)
+    FROM projects p
+    LEFT JOIN (SELECT project_id, count(*) AS n FROM src GROUP BY project_id) s USING (project_id)
+    LEFT JOIN (SELECT project_id, count(*) AS n FROM inserted GROUP BY project_id) i USING (project_id)
+    LEFT JOIN (SELECT project_id, count(*) AS n FROM removed GROUP BY project_id) r USING (project_id);
+"""
+
+
+def sync_tables_bulk(cursor, tables_by_project, load=True, prune=True, prune_empty=False):
+    """Синхронизировать списки таблиц нескольких проектов одним запросом.
+
+    tables_by_project: {project_id: [table_name, ...]}. Как в sync_tables, проекты
+    с пустым списком не очищаются без prune_empty.
+    Возвращает {project_id: {"inserted", "unchanged", "removed"}}.
+    """
+    project_ids, table_names, pruned_projects = [], [], []
+    for project_id, names in tables_by_project.items():
+        names = list(names)
+        for name in names:
+            project_ids.append(project_id)
+            table_names.append(name)
+        if prune and (names or prune_empty):
+            pruned_projects.append(project_id)
+        elif prune:
+            log.warning("No tables discovered for project %s, keeping its table list", project_id)
+    cursor.execute(SYNC_TABLES_BULK_SQL, {
+        "project_ids": project_ids,
+        "table_names": table_names,
+        "synced_projects": list(tables_by_project),
+        "pruned_projects": pruned_projects,
+        "load": load,
+    })
+    return {
+        project_id: {"inserted": inserted, "unchanged": total - inserted, "removed": removed}
+        for project_id, total, inserted, removed in cursor.fetchall()
+    }
+
+
+PROJECT_TABLES_SQL = "SELECT * FROM atk_ct.ct_tables WHERE project_id=%s;"
+
+#  Ключ счетчика изменений списка проектов; у таблиц проекта ключ - его project_id
+PROJECTS_CHANGE_KEY = "*"
+
+CHANGE_VERSIONS_SQL = """
+    SELECT key, version
+    FROM atk_ct.ct_change_counters
+    WHERE key = ANY(%s);
+"""
+
+
+def get_change_versions(cursor, keys):
+    """Версии данных по ключам счетчиков изменений; ключ без изменений имеет версию 0"""
+    cursor.execute(CHANGE_VERSIONS_SQL, (list(keys), ))
+    versions = dict(cursor.fetchall())
+    return {key: versions.get(key, 0) for key in keys}
+
+
+def fetch_project_tables(cursor, project_id):
+    """Все строки atk_ct.ct_tables проекта: (columns, rows)"""
+    cursor.execute(PROJECT_TABLES_SQL, (project_id, ))
+    rows = cursor.fetchall()
+    columns = [desc[0] for desc in cursor.description]
+    return columns, rows
+
+
+#  Ключ ct_change_counters с наибольшей версией удаленных меток (tombstones) ct_tables_deleted
+TOMBSTONE_HORIZON_KEY = "ct_tables_deleted"
+
+#  Последняя выданная версия ct_tables
+TABLES_VERSION_SQL = """
+    SELECT CASE WHEN is_called THEN last_value ELSE last_value - 1 END
+    FROM atk_ct.ct_tables_version_seq;
+"""
+
+#  Наименьшая нижняя граница версий среди незавершенных транзакций, пишущих в ct_tables
+#  (их блокировки ct_tables_write_lock видны в pg_locks сразу, без ожидания)
+TABLES_WRITERS_FLOOR_SQL = f"""
+    SELECT min(((l.classid::bigint & 65535) << 32) | l.objid::bigint)
+    FROM pg_locks l
+    WHERE l.locktype = 'advisory' AND l.objsubid = 2 AND l.granted
+      AND l.classid::bigint >> 16 = {TABLES_WRITER_LOCK_TAG};
+"""
+
+CHANGED_TABLES_SQL = """
+    SELECT *
+    FROM atk_ct.ct_tables
+    WHERE project_id = %s AND row_version > %s
+    ORDER BY row_version;
+"""
+
+DELETED_TABLES_SQL = """
+    SELECT d.table_name
+    FROM atk_ct.ct_tables_deleted d
+    WHERE d.project_id = %s AND d.row_version > %s
+      AND NOT EXISTS (
+          SELECT 1 FROM atk_ct.ct_tables t
+          WHERE t.project_id = d.project_id AND t.table_name = d.table_name
+      );
+"""
+
+PRUNE_TOMBSTONES_SQL = """
+    WITH pruned AS (
+        DELETE FROM atk_ct.ct_tables_deleted
+        WHERE deleted_at < now() - %(days)s * interval '1 day'
+        RETURNING row_version
+    )
+    INSERT INTO atk_ct.ct_change_counters AS c (key, version)
+    SELECT %(key)s, max(row_version) FROM pruned
+    HAVING max(row_version) IS NOT NULL
+    ON CONFLICT (key) DO UPDATE
+    SET version = GREATEST(c.version, EXCLUDED.version), updated_at = now();
+"""
+
+
+def tables_watermark(cursor):
+    """Версия, до которой включительно все изменения ct_tables уже зафиксированы.
+
+    Ничего не блокирует. Последняя версия последовательности читается до
+    pg_locks: транзакция, объявившая границу позже, получит версии больше
+    прочитанной. Данные читаются после этого вызова, новой транзакцией.
+    """
+    cursor.execute(TABLES_VERSION_SQL)
+    watermark = cursor.fetchone()[0]
+    cursor.execute(TABLES_WRITERS_FLOOR_SQL)
+    writers_floor = cursor.fetchone()[0]
+    if writers_floor is not None:
+        #  Граница писателя - last_value до его первой версии, сами версии могут начинаться с нее
+        watermark = min(watermark, writers_floor - 1)
+    return watermark
+
+
+def fetch_table_changes(cursor, project_id, since):
+    """Изменения таблиц проекта после версии since.
+
+    Возвращает (columns, rows, deleted, reset): измененные и новые строки,
+    имена удаленных таблиц и признак reset, если метки удаления за since
+    уже вычищены и клиенту нужна полная перезагрузка.
+    """
+    horizon = get_change_versions(cursor, [TOMBSTONE_HORIZON_KEY])[TOMBSTONE_HORIZON_KEY]
+    if since < horizon:
+        return None, [], [], True
+    cursor.execute(CHANGED_TABLES_SQL, (project_id, since))
+    rows = cursor.fetchall()
+    columns = [desc[0] for desc in cursor.description]
+    cursor.execute(DELETED_TABLES_SQL, (project_id, since))
+    deleted = [row[0] for row in cursor.fetchall()]
+    return columns, rows, deleted, False
+
+
+def prune_table_tombstones(cursor, days):
+    """Удалить метки удаления старше days дней и сдвинуть горизонт fetch_table_changes"""
+    cursor.execute(PRUNE_TOMBSTONES_SQL, {"days": days, "key": TOMBSTONE_HORIZON_KEY})
+    return cursor.rowcount
+
+
+#  Колонки ct_tables, которые можно менять из грида, и их типы в Postgres
+EDITABLE_TABLE_COLUMNS = {
+    "load": "boolean",
+}
+
+APPLY_CHANGES_SQL = """
+    UPDATE atk_ct.ct_tables AS t
+    SET {field} = v.value
+    FROM unnest(%(table_names)s::text[], %(values)s::{pg_type}[]) AS v(table_name, value)
+    WHERE t.project_id = %(project_id)s
+      AND t.table_name = v.table_name
+      AND t.{field} IS DISTINCT FROM v.value;
+"""
+
+
+def group_changes_by_field(entries):
+    """Сгруппировать правки грида [{table_name, changes: [{field, newValue}]}] по полю.
+
+    Для повторной правки одной ячейки берется последнее значение.
+    """
+    grouped = {}
+    for entry in entries:
+        table_name = entry["table_name"]
+        for change in entry.get("changes", []):
+            field = change["field"]
+            if field not in EDITABLE_TABLE_COLUMNS:
+                raise ValueError(f"Field '{field}' can not be changed")
+            grouped.setdefault(field, {})[table_name] = change["newValue"]
+    return grouped
+
+
+def apply_table_changes(cursor, project_id, entries):
+    """Применить правки грида: один UPDATE на поле в рамках проекта.
+
+    Возвращает список пачек с числом переданных и измененных строк.
+    Транзакцию фиксирует вызывающий код.
+    """
+    batches = []
+    for field, values in group_changes_by_field(entries).items():
+        query = APPLY_CHANGES_SQL.format(field=field, pg_type=EDITABLE_TABLE_COLUMNS[field])
+        cursor.execute(query, {
+            "project_id": project_id,
+            "table_names": list(values.keys()),
+            "values": list(values.values()),
+        })
+        batches.append({"field": field, "rows": len(values), "affected": cursor.rowcount})
+    return batches
+
+
+_table_columns = None
+
+#  Операции фильтров ag-Grid -> SQL (значение подставляется параметром)
+_TEXT_FILTERS = {
+    "contains": ("{col}::text ILIKE %s", "%{}%"),
+    "notContains": ("{col}::text NOT ILIKE %s", "%{}%"),
+    "equals": ("{col}::text = %s", "{}"),
+    "notEqual": ("{col}::text <> %s", "{}"),
+    "startsWith": ("{col}::text ILIKE %s", "{}%"),
+    "endsWith": ("{col}::text ILIKE %s", "%{}"),
+}
+_NUMBER_FILTERS = {
+    "equals": "{col} = %s",
+    "notEqual": "{col} <> %s",
+    "lessThan": "{col} < %s",
+    "lessThanOrEqual": "{col} <= %s",
+    "greaterThan": "{col} > %s",
+    "greaterThanOrEqual": "{col} >= %s",
+}
+
+
+def get_table_columns(cursor):
+    """Колонки atk_ct.ct_tables (читаются один раз за процесс)"""
+    global _table_columns
+    if _table_columns is None:
+        cursor.execute("SELECT * FROM atk_ct.ct_tables LIMIT 0;")
+        _table_columns = [desc[0] for desc in cursor.description]
+    return _table_columns
+
+
+def _like_escape(value):
+    return str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+def _filter_condition(col, model):
+    """SQL-условие и параметры для одной модели фильтра колонки"""
+    if "conditions" in model or "condition1" in model:
+        conditions = model.get("conditions") or [model["condition1"], model["condition2"]]
+        parts = [_filter_condition(col, condition) for condition in conditions]
+        operator = " OR " if model.get("operator", "AND").upper() == "OR" else " AND "
+        return "(" + operator.join(part for part, _ in parts) + ")", [p for _, params in parts for p in params]
+
+    filter_type = model.get("type")
+    if filter_type == "blank":
+        return f"({col} IS NULL OR {col}::text = '')", []
+    if filter_type == "notBlank":
+        return f"({col} IS NOT NULL AND {col}::text <> '')", []
+
+    #  Встроенные варианты фильтра для колонок с cellDataType boolean
+    if filter_type in ("true", "false"):
+        return f"{col} IS {filter_type.upper()}", []
+    if filter_type == "empty":
+        return "TRUE", []
+
+    if model.get("filterType") == "date":
+        if filter_type == "inRange":
+            return f"{col} BETWEEN %s AND %s", [model["dateFrom"], model["dateTo"]]
+        if filter_type in _NUMBER_FILTERS:
+            return _NUMBER_FILTERS[filter_type].format(col=col), [model["dateFrom"]]
+    elif model.get("filterType") == "number":
+        if filter_type == "inRange":
+            return f"{col} BETWEEN %s AND %s", [model["filter"], model["filterTo"]]
+        if filter_type in _NUMBER_FILTERS:
+            return _NUMBER_FILTERS[filter_type].format(col=col), [model["filter"]]
+    elif filter_type in _TEXT_FILTERS:
+        template, pattern = _TEXT_FILTERS[filter_type]
+        value = model["filter"]
+        if "ILIKE" in template:
+            value = pattern.format(_like_escape(value))
+        return template.format(col=col), [value]
+    raise ValueError(f"Unsupported filter '{filter_type}'")
+
+
+def build_page_query(table, columns, where, params, key, offset, limit, sort_model=None, filter_model=None):
+    """Запросы страницы таблицы и общего числа строк с фильтрами и сортировкой ag-Grid.
+
+    where и params - обязательные условия, key - уникальная колонка для хвоста сортировки.
+    """
+    where, params = list(where), list(params)
+    for col, model in (filter_model or {}).items():
+        if col not in columns:
+            raise ValueError(f"Unknown column '{col}'")
+        condition, condition_params = _filter_condition(f'"{col}"', model)
+        where.append(condition)
+        params.extend(condition_params)
+
+    order_by = []
+    for sort in sort_model or []:
+        col = sort.get("colId")
+        if col not in columns:
+            raise ValueError(f"Unknown column '{col}'")
+        direction = "DESC" if sort.get("sort") == "desc" else "ASC"
+        order_by.append(f'"{col}" {direction}')
+    #  Уникальный хвост сортировки, чтобы страницы не пересекались
+    order_by.append(f"{key} ASC")
+
+    where_sql = " AND ".join(where) or "TRUE"
+    select_sql = ", ".join(f'"{col}"' for col in columns)
+    page_sql = (f"SELECT {select_sql} FROM {table} WHERE {where_sql} "
+                f"ORDER BY {', '.join(order_by)} LIMIT %s OFFSET %s;")
+    count_sql = f"SELECT count(*) FROM {table} WHERE {where_sql};"
+    return page_sql, params + [limit, offset], count_sql, params
+
+
+def build_tables_page_query(columns, project_id, offset, limit, sort_model=None, filter_model=None):
+    """Запросы страницы ct_tables проекта и общего числа строк"""
+    return build_page_query("atk_ct.ct_tables", columns, ["project_id = %s"], [project_id], "table_name",
+                            offset, limit, sort_model, filter_model)
+
+
+def _fetch_page(cursor, queries, offset, limit, with_total):
+    page_sql, page_params, count_sql, count_params = queries
+    cursor.execute(page_sql, page_params)
+    rows = cursor.fetchall()
+    columns = [desc[0] for desc in cursor.description]
+    total = None
+    if with_total:
+        if offset == 0 and len(rows) < limit:
+            total = len(rows)
+        else:
+            cursor.execute(count_sql, count_params)
+            total = cursor.fetchone()[0]
+    return columns, rows, total
+
+
+def fetch_tables_page(cursor, project_id, offset, limit, sort_model=None, filter_model=None, with_total=True):
+    """Страница строк ct_tables проекта.
+
+    Возвращает (columns, rows, total); total считается только при with_total.
+    """
+    queries = build_tables_page_query(get_table_columns(cursor), project_id, offset, limit, sort_model, filter_model)
+    return _fetch_page(cursor, queries, offset, limit, with_total)
+
+
+PROJECT_COLUMNS = (
+    "ct_project_id",
+    "source_connection_id",
+    "one_c_database",
+    "biview_database",
+    "biview_project_type",
+    "ct_database",
+    "transfer_source_data",
+    "target_connection_id",
+    "target_database",
+    "target_type",
+    "update_dags_start_date",
+    "update_dags_schedule",
+    "transfer_dags_start_date",
+    "transfer_dags_schedule",
+)
+
+
+def get_project(cursor, project_id):
+    """Настройки проекта из atk_ct.ct_projects или None"""
+    cursor.execute(
+        f"SELECT {', '.join(PROJECT_COLUMNS)} FROM atk_ct.ct_projects WHERE ct_project_id = %s;",
+        (project_id, )
+    )
+    row = cursor.fetchone()
+    return dict(zip(PROJECT_COLUMNS, row)) if row else None
+
+
+#  Колонки списка проектов (страница ProjectsView.project_list)
+PROJECT_LIST_COLUMNS = PROJECT_COLUMNS[:10]
+
+
+def fetch_projects_page(cursor, offset, limit, sort_model=None, filter_model=None, with_total=True):
+    """Страница проектов для грида списка: (columns, rows, total)"""
+    queries = build_page_query("atk_ct.ct_projects", PROJECT_LIST_COLUMNS, [], [], "ct_project_id",
+                               offset, limit, sort_model, filter_model)
+    return _fetch_page(cursor, queries, offset, limit, with_total)
+
+
+#  Типы колонок ct_projects для массивов unnest; остальные колонки text
+PROJECT_COLUMN_TYPES = {
+    "biview_project_type": "integer",
+    "transfer_source_data": "boolean",
+    "update_dags_start_date": "timestamp",
+    "transfer_dags_start_date": "timestamp",
+}
+
+_PROJECTS_UNNEST = "unnest({arrays}) AS v({columns})".format(
+    arrays=", ".join(f"%({c})s::{PROJECT_COLUMN_TYPES.get(c, 'text')}[]" for c in PROJECT_COLUMNS),
+    columns=", ".join(PROJECT_COLUMNS),
+)
+
+INSERT_PROJECTS_SQL = f"""
+    INSERT INTO atk_ct.ct_projects ({', '.join(PROJECT_COLUMNS)})
+    SELECT {', '.join(PROJECT_COLUMNS)} FROM {_PROJECTS_UNNEST}
+    ON CONFLICT (ct_project_id) DO NOTHING
+    RETURNING ct_project_id;
+"""
+
+UPDATE_PROJECTS_SQL = f"""
+    UPDATE atk_ct.ct_projects AS p
+    SET {', '.join(f"{c} = v.{c}" for c in PROJECT_COLUMNS[1:])}
+    FROM {_PROJECTS_UNNEST}
+    WHERE p.ct_project_id = v.ct_project_id
+    RETURNING p.ct_project_id;
+"""
+
+COPY_PROJECT_TABLES_SQL = """
+    INSERT INTO atk_ct.ct_tables (project_id, table_name, load)
+    SELECT n.project_id, t.table_name, t.load
+    FROM atk_ct.ct_tables t
+    CROSS JOIN unnest(%(project_ids)s::text[]) AS n(project_id)
+    WHERE t.project_id = %(source)s
+    ON CONFLICT (project_id, table_name) DO NOTHING;
+"""
+
+
+def _project_arrays(projects):
+    return {column: [project.get(column) for project in projects] for column in PROJECT_COLUMNS}
+
+
+def get_projects(cursor, project_ids):
+    """Настройки нескольких проектов одним запросом: {ct_project_id: project}"""
+    cursor.execute(
+        f"SELECT {', '.join(PROJECT_COLUMNS)} FROM atk_ct.ct_projects WHERE ct_project_id = ANY(%s);",
+        (list(project_ids), )
+    )
+    return {row[0]: dict(zip(PROJECT_COLUMNS, row)) for row in cursor.fetchall()}
+
+
+def insert_projects(cursor, projects):
+    """Вставить проекты одним запросом; возвращает ct_project_id вставленных (занятые пропускаются)"""
+    cursor.execute(INSERT_PROJECTS_SQL, _project_arrays(projects))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def update_projects(cursor, projects):
+    """Перезаписать все настройки проектов одним запросом; возвращает ct_project_id измененных"""
+    cursor.execute(UPDATE_PROJECTS_SQL, _project_arrays(projects))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def delete_projects(cursor, project_ids):
+    """Удалить проекты одним запросом; возвращает ct_project_id удаленных"""
+    cursor.execute(
+        "DELETE FROM atk_ct.ct_projects WHERE ct_project_id = ANY(%s) RETURNING ct_project_id;",
+        (list(project_ids), )
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+def copy_project_tables(cursor, source_id, project_ids):
+    """Скопировать список таблиц проекта source_id (с флагами load) в проекты project_ids"""
+    cursor.execute(COPY_PROJECT_TABLES_SQL, {"source": source_id, "project_ids": list(project_ids)})
+    return cursor.rowcount
+
+
+def list_projects(cursor):
+    """Все проекты из atk_ct.ct_projects"""
+    cursor.execute(f"SELECT {', '.join(PROJECT_COLUMNS)} FROM atk_ct.ct_projects ORDER BY ct_project_id;")
+    return [dict(zip(PROJECT_COLUMNS, row)) for row in cursor.fetchall()]
+
+
+def list_load_tables(cursor, project_id):
+    """Имена таблиц проекта, отмеченных для загрузки (load = true)"""
+    cursor.execute(
+        "SELECT table_name FROM atk_ct.ct_tables WHERE project_id = %s AND load ORDER BY table_name;",
+        (project_id, )
+    )
+    return [row[0] for row in cursor.fetchall()]
+
+
+SAVE_TABLE_STATS_SQL = """
+    UPDATE atk_ct.ct_tables AS t
+    SET row_count = v.row_count,
+        reserved_kb = v.reserved_kb,
+        stats_updated_at = now()
+    FROM unnest(%(table_names)s::text[], %(row_counts)s::bigint[], %(reserved_kb)s::bigint[])
+        AS v(table_name, row_count, reserved_kb)
+    WHERE t.project_id = %(project_id)s
+      AND t.table_name = v.table_name;
+"""
+
+
+def save_table_stats(cursor, project_id, stats):
+    """Сохранить размеры таблиц {table_name: (row_count, reserved_kb)} одним запросом"""
+    cursor.execute(SAVE_TABLE_STATS_SQL, {
+        "project_id": project_id,
+        "table_names": list(stats),
+        "row_counts": [row_count for row_count, _ in stats.values()],
+        "reserved_kb": [reserved_kb for _, reserved_kb in stats.values()],
+    })
+    return cursor.rowcount
+
+
+CATALOG_ENTRY_COLUMNS = ("table_name", "columns", "key_columns", "ods_ddl", "hods_ddl", "modify_date")
+
+#  Записи каталога приходят одним jsonb-массивом; таблицы, которых нет в table_names, удаляются
+SAVE_CATALOG_SQL = """
+    WITH src AS (
+        SELECT *
+        FROM jsonb_to_recordset(%(entries)s::jsonb) AS v(
+            table_name text, columns jsonb, key_columns text[], ods_ddl text, hods_ddl text, modify_date timestamp
+        )
+    ),
+    upserted AS (
+        INSERT INTO atk_ct.ct_column_catalog
+            (connection_id, database_name, table_name, columns, key_columns, ods_ddl, hods_ddl, modify_date)
+        SELECT %(connection_id)s, %(database)s, src.table_name, src.columns, src.key_columns,
+               src.ods_ddl, src.hods_ddl, src.modify_date
+        FROM src
+        ON CONFLICT (connection_id, database_name, table_name) DO UPDATE
+        SET columns = EXCLUDED.columns,
+            key_columns = EXCLUDED.key_columns,
+            ods_ddl = EXCLUDED.ods_ddl,
+            hods_ddl = EXCLUDED.hods_ddl,
+            modify_date = EXCLUDED.modify_date,
+            updated_at = now()
+        RETURNING 1
+    ),
+    removed AS (
+        DELETE FROM atk_ct.ct_column_catalog c
+        WHERE c.connection_id = %(connection_id)s
+          AND c.database_name = %(database)s
+          AND c.table_name <> ALL(%(table_names)s::text[])
+        RETURNING 1
+    )
+    SELECT (SELECT count(*) FROM upserted), (SELECT count(*) FROM removed);
+"""
+
+
+def get_catalog_dates(cursor, connection_id, database):
+    """modify_date таблиц базы в каталоге колонок: {table_name: modify_date}"""
+    cursor.execute(
+        "SELECT table_name, modify_date FROM atk_ct.ct_column_catalog WHERE connection_id = %s AND database_name = %s;",
+        (connection_id, database)
+    )
+    return dict(cursor.fetchall())
+
+
+def save_catalog(cursor, connection_id, database, entries, table_names):
+    """Записать измененные записи каталога и удалить таблицы, которых нет в table_names.
+
+    Возвращает (upserted, removed). Транзакцию фиксирует вызывающий код.
+    """
+    cursor.execute(SAVE_CATALOG_SQL, {
+        "connection_id": connection_id,
+        "database": database,
+        "entries": json.dumps([
+            dict(entry, modify_date=entry["modify_date"].isoformat() if entry["modify_date"] else None)
+            for entry in entries
+        ]),
+        "table_names": list(table_names),
+    })
+    return cursor.fetchone()
+
+
+def load_catalog(cursor, connection_id, database, table_names=None):
+    """Записи каталога колонок одним запросом: {table_name: entry}"""
+    sql = (f"SELECT {', '.join(CATALOG_ENTRY_COLUMNS)} FROM atk_ct.ct_column_catalog "
+           f"WHERE connection_id = %s AND database_name = %s")
+    params = [connection_id, database]
+    if table_names is not None:
+        sql += " AND table_name = ANY(%s)"
+        params.append(list(table_names))
+    cursor.execute(sql + ";", params)
+    return {row[0]: dict(zip(CATALOG_ENTRY_COLUMNS, row)) for row in cursor.fetchall()}
+
+
+JOB_COLUMNS = ("job_id", "kind", "state", "progress", "message", "result", "error", "created_at", "finished_at")
+
+SAVE_JOB_SQL = """
+    INSERT INTO atk_ct.ct_jobs (job_id, kind, job_key, state, progress, message, result, error,
+                                created_at, finished_at, updated_at)
+    VALUES (%(job_id)s, %(kind)s, %(job_key)s, %(state)s, %(progress)s, %(message)s, %(result)s::jsonb, %(error)s,
+            to_timestamp(%(created_at)s), to_timestamp(%(finished_at)s), now())
+    ON CONFLICT (job_id) DO UPDATE SET
+        state = EXCLUDED.state,
+        progress = EXCLUDED.progress,
+        message = EXCLUDED.message,
+        result = EXCLUDED.result,
+        error = EXCLUDED.error,
+        finished_at = EXCLUDED.finished_at,
+        updated_at = now();
+"""
+
+#  Время - в секундах epoch, как в Job.to_dict; idle - сколько секунд запись не обновлялась
+LOAD_JOB_SQL = """
+    SELECT job_id, kind, state, progress, message, result, error,
+           extract(epoch FROM created_at)::float8, extract(epoch FROM finished_at)::float8,
+           extract(epoch FROM now() - updated_at)::float8
+    FROM atk_ct.ct_jobs
+    WHERE job_id = %s;
+"""
+
+
+def save_job(cursor, job, job_key):
+    """Записать состояние задачи (словарь Job.to_dict)"""
+    cursor.execute(SAVE_JOB_SQL, {
+        **job,
+        "job_key": job_key,
+        "result": json.dumps(job["result"], ensure_ascii=False, default=str) if job["result"] is not None else None,
+    })
+
+
+def load_job(cursor, job_id):
+    """Состояние задачи в виде Job.to_dict и число секунд с последнего обновления; None, если задачи нет"""
+    cursor.execute(LOAD_JOB_SQL, (job_id, ))
+    row = cursor.fetchone()
+    if row is None:
+        return None, None
+    return dict(zip(JOB_COLUMNS, row[:-1])), row[-1]
+
+
+def prune_jobs(cursor, seconds):
+    """Удалить задачи, завершенные больше seconds секунд назад"""
+    cursor.execute(
+        "DELETE FROM atk_ct.ct_jobs WHERE finished_at < now() - make_interval(secs => %s);",
+        (seconds, )
+    )
+    return cursor.rowcount
@@ -0,0 +1,99 @@
+"""Потоковая отдача больших выборок Postgres в виде JSON"""
+import json
+import uuid
+import zlib
+
+from airflow.configuration import conf
+from flask import Response, request
+
+from ct_pool import pg_connection
+
+#  Размер пачки fetchmany для серверного курсора, [atk_ct] stream_chunk_size
+STREAM_CHUNK_SIZE = conf.getint("atk_ct", "stream_chunk_size", fallback=2000)
+
+
+def _json_default(value):
+    """Сериализация типов, которых нет в json (даты, Decimal и т.п.)"""
+    if hasattr(value, "isoformat"):
+        return value.isoformat()
+    return str(value)
+
+
+def _dumps(value):
+    return json.dumps(value, default=_json_default, ensure_ascii=False, separators=(",", ":"))
+
+
+def iter_query_json(sql, params=None, conn_id="airflow_postgres", chunk_size=None, extra=None):
+    """Генератор кусков JSON {"status", "columns", "results", ...extra} по серверному курсору.
+
+    В памяти одновременно держится только одна пачка из chunk_size строк.
+    """
+    chunk_size = chunk_size or STREAM_CHUNK_SIZE
+    with pg_connection(conn_id) as conn:
+        #  Именованный курсор держит результат на стороне Postgres
+        cursor = conn.cursor(name=f"ct_stream_{uuid.uuid4().hex}")
+        cursor.itersize = chunk_size
+        try:
+            cursor.execute(sql, params)
+            rows = cursor.fetchmany(chunk_size)
+            columns = [desc[0] for desc in cursor.description]
+            yield '{"status":"success","columns":' + _dumps(columns)
+            for key, value in (extra or {}).items():
+                yield "," + _dumps(key) + ":" + _dumps(value)
+            yield ',"results":['
+            first = True
+            while rows:
+                parts = [_dumps(dict(zip(columns, row))) for row in rows]
+                yield ("" if first else ",") + ",".join(parts)
+                first = False
+                rows = cursor.fetchmany(chunk_size)
+            yield "]}"
+        finally:
+            cursor.close()
+            conn.rollback()
+
+
+def _prepend(first, chunks):
+    """Вернуть уже прочитанный кусок и закрыть исходный генератор при обрыве клиента"""
+    try:
+        yield first
+        yield from chunks
+    finally:
+        chunks.close()
+
+
+def _gzip_chunks(chunks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode("utf-8"))
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def _encode_chunks(chunks):
+    for chunk in chunks:
+        yield chunk.encode("utf-8")
+
+
+def stream_json_response(chunks, compress=True):
+    """Flask-ответ из генератора JSON; gzip, если клиент его принимает"""
+    use_gzip = compress and "gzip" in request.headers.get("Accept-Encoding", "")
+    body = _gzip_chunks(chunks) if use_gzip else _encode_chunks(chunks)
+    response = Response(body, mimetype="application/json")
+    if use_gzip:
+        response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+def stream_query(sql, params=None, conn_id="airflow_postgres", chunk_size=None, extra=None, compress=True):
+    """Потоковый JSON-ответ для запроса Postgres.
+
+    Запрос выполняется до возврата ответа, поэтому ошибка SQL или соединения
+    поднимается здесь, а не обрывает уже начатый 200-й ответ.
+    """
+    chunks = iter_query_json(sql, params, conn_id=conn_id, chunk_size=chunk_size, extra=extra)
+    first = next(chunks)
+    return stream_json_response(_prepend(first, chunks), compress=compress)
@@ -0,0 +1,156 @@
+"""Ограничение частоты и объединение одинаковых запросов к тяжелым эндпоинтам.
+
+SingleFlight: одновременные запросы с одним ключом ждут одно вычисление
+и получают его результат (или его исключение). RateLimiter: token bucket
+на ключ - пользователя или подключение-источник MSSQL; при исчерпании
+эндпоинт отвечает 429 с заголовком Retry-After.
+
+Состояние живет в памяти воркера вебсервера, поэтому при нескольких
+воркерах лимит действует на каждый из них отдельно.
+"""
+import logging
+import math
+import threading
+import time
+
+from airflow.configuration import conf
+from flask import jsonify, request
+from flask_login import current_user
+
+log = logging.getLogger(__name__)
+
+THROTTLE_ENABLED = conf.getboolean("atk_ct", "throttle_enabled", fallback=True)
+#  Запросов в минуту и размер «пачки» подряд на одного пользователя
+THROTTLE_USER_PER_MINUTE = conf.getfloat("atk_ct", "throttle_user_per_minute", fallback=30.0)
+THROTTLE_USER_BURST = conf.getint("atk_ct", "throttle_user_burst", fallback=5)
+#  То же на одно подключение-источник; учитываются только запросы, которые действительно идут в MSSQL
+THROTTLE_SOURCE_PER_MINUTE = conf.getfloat("atk_ct", "throttle_source_per_minute", fallback=12.0)
+THROTTLE_SOURCE_BURST = conf.getint("atk_ct", "throttle_source_burst", fallback=3)
+#  Через сколько секунд простоя полный bucket удаляется
+BUCKET_IDLE_SECONDS = 600
+
+
+class RateLimited(Exception):
+    """Лимит исчерпан; retry_after - через сколько секунд появится токен"""
+
+    def __init__(self, scope, retry_after):
+        super().__init__(f"Too many requests for this {scope}, retry in {math.ceil(retry_after)}s")
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше burst в запасе"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """Взять токен; возвращает 0 или число секунд до появления следующего"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float(BUCKET_IDLE_SECONDS)
+
+
+class RateLimiter:
+    """Token bucket на каждый ключ"""
+
+    def __init__(self, scope, per_minute, burst):
+        self.scope = scope
+        self.rate = per_minute / 60.0
+        self.burst = max(1, burst)
+        self._buckets = {}
+        self._lock = threading.Lock()
+        self._purged = time.monotonic()
+
+    def _purge(self, now):
+        if now - self._purged < BUCKET_IDLE_SECONDS:
+            return
+        self._purged = now
+        idle = [key for key, bucket in self._buckets.items() if now - bucket.updated > BUCKET_IDLE_SECONDS]
+        for key in idle:
+            del self._buckets[key]
+
+    def acquire(self, key):
+        """Списать запрос с ключа key или выбросить RateLimited"""
+        if not THROTTLE_ENABLED:
+            return
+        now = time.monotonic()
+        with self._lock:
+            self._purge(now)
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+            retry_after = bucket.take(now)
+        if retry_after:
+            log.warning("Rate limit of %s %s exceeded, retry in %.1fs", self.scope, key, retry_after)
+            raise RateLimited(self.scope, retry_after)
+
+
+class _Call:
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """Одно вычисление на ключ: остальные вызовы с тем же ключом ждут его результат"""
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        """Результат func(*args, **kwargs); возвращает (result, shared)"""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func(*args, **kwargs)
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result, False
+
+
+user_limiter = RateLimiter("user", THROTTLE_USER_PER_MINUTE, THROTTLE_USER_BURST)
+source_limiter = RateLimiter("source connection", THROTTLE_SOURCE_PER_MINUTE, THROTTLE_SOURCE_BURST)
+single_flight = SingleFlight()
+
+
+def current_user_key():
+    """Ключ пользователя для лимита: id в FAB или, без входа, адрес клиента"""
+    try:
+        if current_user and current_user.is_authenticated:
+            return f"user:{current_user.get_id()}"
+    except Exception:
+        log.debug("Current user is not available", exc_info=True)
+    return f"addr:{request.remote_addr}"
+
+
+def too_many_requests(error):
+    """Ответ 429 с Retry-After для RateLimited"""
+    retry_after = max(1, math.ceil(error.retry_after))
+    response = jsonify({"status": "error", "message": str(error), "retry_after": retry_after})
+    response.status_code = 429
+    response.headers["Retry-After"] = str(retry_after)
+    return response
@@ -0,0 +1,281 @@
+"""Замеры времени эндпоинтов и запросов плагинов atk_ct.
+
+Эндпоинты @expose оборачиваются декоратором класса timed_view, курсоры
+соединений из ct_pool - TimedCursor. Для каждого запроса к вебсерверу
+считается общее время, время в MSSQL и Postgres, число запросов, строк
+и отданных байт; метрики уходят в airflow.stats.Stats (StatsD или
+OpenTelemetry, как настроено в [metrics]), медленные запросы и
+эндпоинты пишутся в лог.
+"""
+import functools
+import logging
+import re
+import threading
+import time
+
+from airflow.configuration import conf
+from airflow.stats import Stats
+from flask import make_response
+
+log = logging.getLogger(__name__)
+
+TIMING_ENABLED = conf.getboolean("atk_ct", "timing_enabled", fallback=True)
+#  Порог (мс) для записи запроса к базе в лог медленных запросов
+SLOW_QUERY_MS = conf.getfloat("atk_ct", "slow_query_ms", fallback=1000.0)
+SLOW_REQUEST_MS = conf.getfloat("atk_ct", "slow_request_ms", fallback=3000.0)
+#  Сколько символов SQL показывать в логе
+SLOW_QUERY_SQL_LENGTH = 500
+
+_local = threading.local()
+#  Функции, получающие каждый завершенный RequestTimer (например, бенчмарки)
+_listeners = []
+
+
+def _metric_name(*parts):
+    return "atk_ct." + ".".join(re.sub(r"[^A-Za-z0-9_]", "_", str(part)) for part in parts)
+
+
+def _short_sql(sql):
+    if isinstance(sql, bytes):
+        sql = sql.decode("utf-8", "replace")
+    sql = " ".join(str(sql).split())
+    return sql if len(sql) <= SLOW_QUERY_SQL_LENGTH else sql[:SLOW_QUERY_SQL_LENGTH] + "..."
+
+
+class RequestTimer:
+    """Счетчики одного запроса к эндпоинту"""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.monotonic()
+        self.queries = 0
+        self.rows = 0
+        self.bytes = 0
+        self.db_ms = {}
+        self.failed = False
+        self.total_ms = None
+
+    def add_query(self, kind, ms, rows):
+        self.queries += 1
+        self.rows += rows
+        self.db_ms[kind] = self.db_ms.get(kind, 0.0) + ms
+
+    def finish(self):
+        total_ms = self.total_ms = (time.monotonic() - self.started) * 1000
+        db_ms = sum(self.db_ms.values())
+        Stats.timing(_metric_name("endpoint", self.name, "duration"), total_ms)
+        for kind, ms in self.db_ms.items():
+            Stats.timing(_metric_name("endpoint", self.name, kind), ms)
+        Stats.incr(_metric_name("endpoint", self.name, "queries"), count=self.queries)
+        Stats.incr(_metric_name("endpoint", self.name, "rows"), count=self.rows)
+        Stats.incr(_metric_name("endpoint", self.name, "bytes"), count=self.bytes)
+        if self.failed:
+            Stats.incr(_metric_name("endpoint", self.name, "errors"))
+
+        level = logging.WARNING if total_ms >= SLOW_REQUEST_MS else logging.DEBUG
+        log.log(level, "%s%s: %.0f ms (%s, other %.0f ms), %d queries, %d rows, %d bytes",
+                self.name, " failed" if self.failed else "", total_ms,
+                ", ".join(f"{kind} {ms:.0f} ms" for kind, ms in sorted(self.db_ms.items())) or "no db",
+                total_ms - db_ms, self.queries, self.rows, self.bytes)
+        for listener in _listeners:
+            listener(self)
+
+
+def add_listener(listener):
+    """Подписать listener(timer) на завершение замеров эндпоинтов"""
+    _listeners.append(listener)
+
+
+def remove_listener(listener):
+    _listeners.remove(listener)
+
+
+def current_timer():
+    """RequestTimer текущего запроса или None (задачи DAG, фоновые потоки)"""
+    return getattr(_local, "timer", None)
+
+
+class TimedCursor:
+    """Прокси курсора DB-API: время execute и выборки, число строк.
+
+    Запрос считается от execute до следующего execute или close, поэтому
+    для серверных курсоров в его время входит и чтение пачек fetchmany.
+    """
+
+    def __init__(self, cursor, kind, conn_id):
+        self._cursor = cursor
+        self._kind = kind
+        self._conn_id = conn_id
+        self._sql = None
+        self._ms = 0.0
+        self._rows = 0
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        if name.startswith("_"):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._cursor, name, value)
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._rows += 1
+            yield row
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _timed(self, method, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self._ms += (time.monotonic() - started) * 1000
+
+    def _finish(self):
+        if self._sql is None:
+            return
+        ms, rows, sql = self._ms, self._rows, self._sql
+        self._sql, self._ms, self._rows = None, 0.0, 0
+        Stats.timing(_metric_name("query", self._kind, self._conn_id), ms)
+        timer = current_timer()
+        if timer is not None:
+            timer.add_query(self._kind, ms, rows)
+        if ms >= SLOW_QUERY_MS:
+            log.warning("Slow %s query on %s: %.0f ms, %d rows: %s",
+                        self._kind, self._conn_id, ms, rows, _short_sql(sql))
+
+    def _start(self, sql):
+        self._finish()
+        self._sql = sql
+
+    def execute(self, sql, *args, **kwargs):
+        self._start(sql)
+        return self._timed(self._cursor.execute, sql, *args, **kwargs)
+
+    def executemany(self, sql, *args, **kwargs):
+        self._start(sql)
+        return self._timed(self._cursor.executemany, sql, *args, **kwargs)
+
+    def copy_expert(self, sql, *args, **kwargs):
+        self._start(sql)
+        return self._timed(self._cursor.copy_expert, sql, *args, **kwargs)
+
+    def fetchone(self):
+        row = self._timed(self._cursor.fetchone)
+        if row is not None:
+            self._rows += 1
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._timed(self._cursor.fetchmany, *args, **kwargs)
+        self._rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(self._cursor.fetchall)
+        self._rows += len(rows)
+        return rows
+
+    def close(self):
+        try:
+            self._cursor.close()
+        finally:
+            self._finish()
+
+
+class TimedConnection:
+    """Прокси соединения, выдающий TimedCursor"""
+
+    def __init__(self, conn, kind, conn_id):
+        self._conn = conn
+        self._kind = kind
+        self._conn_id = conn_id
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        return TimedCursor(self._conn.cursor(*args, **kwargs), self._kind, self._conn_id)
+
+
+def timed_connection(conn, kind, conn_id):
+    return TimedConnection(conn, kind, conn_id) if TIMING_ENABLED else conn
+
+
+class _CountedStream:
+    """Тело потокового ответа: байты считаются, замер завершается при close().
+
+    close() вызывает WSGI-сервер и тогда, когда тело не читалось (HEAD,
+    обрыв клиента), поэтому исходное тело закрывается здесь же.
+    """
+
+    def __init__(self, body, timer):
+        self._body = body
+        self._timer = timer
+        self._closed = False
+
+    def __iter__(self):
+        _local.timer = self._timer
+        try:
+            for chunk in self._body:
+                self._timer.bytes += len(chunk)
+                yield chunk
+        except BaseException:
+            self._timer.failed = True
+            raise
+        finally:
+            _local.timer = None
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        _local.timer = self._timer
+        try:
+            close = getattr(self._body, "close", None)
+            if close is not None:
+                close()
+        finally:
+            _local.timer = None
+            self._timer.finish()
+
+
+def _timed_endpoint(func, name):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        timer = RequestTimer(name)
+        previous, _local.timer = current_timer(), timer
+        try:
+            response = make_response(func(*args, **kwargs))
+        except BaseException:
+            timer.failed = True
+            _local.timer = previous
+            timer.finish()
+            raise
+        _local.timer = previous
+        if response.is_streamed:
+            #  Чтение серверного курсора и сериализация идут во время отдачи ответа
+            response.response = _CountedStream(response.response, timer)
+        else:
+            timer.bytes = response.calculate_content_length() or 0
+            timer.failed = response.status_code >= 500
+            timer.finish()
+        return response
+
+    return wrapper
+
+
+def timed_view(cls):
+    """Декоратор класса: замер всех методов-эндпоинтов @expose"""
+    if not TIMING_ENABLED:
+        return cls
+    for attr_name, attr in list(vars(cls).items()):
+        if callable(attr) and hasattr(attr, "_urls"):
+            setattr(cls, attr_name, _timed_endpoint(attr, f"{cls.__name__}.{attr_name}"))
+    return cls
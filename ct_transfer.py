@@ -0,0 +1,247 @@
+"""Потоковая перекачка данных MSSQL -> Postgres через COPY FROM STDIN.
+
+Строки читаются из MSSQL пачками fetchmany и сразу кодируются в CSV для
+COPY, поэтому в памяти одновременно находится не больше одной пачки
+независимо от размера таблицы.
+"""
+import datetime
+import decimal
+import logging
+import time
+import uuid
+
+from airflow.configuration import conf
+
+from ct_extract import FULL, INCREMENTAL, run_project_extraction
+from ct_metadata import quote_mssql_name
+from ct_pool import mssql_connection, pg_connection
+
+log = logging.getLogger(__name__)
+
+TRANSFER_CHUNK_SIZE = conf.getint("atk_ct", "transfer_chunk_size", fallback=10000)
+
+ODS = "ODS"
+HODS = "HODS"
+
+#  Служебные колонки таблиц HODS (история изменений)
+HODS_COLUMNS = ("_ct_version", "_ct_operation")
+
+
+def quote_pg_name(name):
+    """Экранирование идентификатора Postgres: "name" """
+    return '"' + str(name).replace('"', '""') + '"'
+
+
+def _csv_field(value):
+    """Значение в формате COPY ... (FORMAT csv): NULL - пустое поле без кавычек"""
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return str(value)
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\x" + bytes(value).hex()
+    if isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    return '"' + str(value).replace('"', '""') + '"'
+
+
+class CopyStream:
+    """Файлоподобный объект для copy_expert: отдает CSV по мере чтения пачек строк"""
+
+    def __init__(self, chunks, prefix=()):
+        self._chunks = iter(chunks)
+        self._prefix = tuple(prefix)
+        self._buffer = bytearray()
+        self._exhausted = False
+        self.rows = 0
+        self.bytes = 0
+
+    def _encode(self, rows):
+        prefix = self._prefix
+        lines = [",".join(_csv_field(v) for v in prefix + tuple(row)) for row in rows]
+        self.rows += len(rows)
+        return ("\n".join(lines) + "\n").encode("utf-8")
+
+    def read(self, size=-1):
+        while not self._exhausted and (size < 0 or len(self._buffer) < size):
+            try:
+                rows = next(self._chunks)
+            except StopIteration:
+                self._exhausted = True
+                break
+            if rows:
+                self._buffer += self._encode(rows)
+        if size < 0 or size >= len(self._buffer):
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        else:
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+        self.bytes += len(data)
+        return data
+
+
+class TransferStats:
+    """Объем и скорость перекачки одной таблицы"""
+
+    def __init__(self, table_name):
+        self.table_name = table_name
+        self.rows = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self.seconds = 0.0
+
+    def finish(self, stream):
+        self.rows += stream.rows
+        self.bytes += stream.bytes
+        self.seconds = time.monotonic() - self.started
+        return self
+
+    def to_dict(self):
+        seconds = self.seconds or 1e-9
+        return {
+            "table": self.table_name,
+            "rows": self.rows,
+            "mb": round(self.bytes / 1048576, 3),
+            "seconds": round(self.seconds, 3),
+            "rows_per_sec": round(self.rows / seconds, 1),
+            "mb_per_sec": round(self.bytes / 1048576 / seconds, 3),
+        }
+
+
+def copy_chunks(pg_cursor, target_table, columns, chunks, prefix=()):
+    """COPY пачек строк в таблицу Postgres; возвращает CopyStream со счетчиками"""
+    stream = CopyStream(chunks, prefix=prefix)
+    column_list = ", ".join(quote_pg_name(c) for c in columns)
+    pg_cursor.copy_expert(f"COPY {target_table} ({column_list}) FROM STDIN WITH (FORMAT csv)", stream)
+    return stream
+
+
+def iter_mssql_chunks(cursor, chunk_size):
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield rows
+
+
+def target_table_name(project, table_name):
+    """Таблица приемника: схема по target_type (ods/hods), имя как в источнике"""
+    schema = (project.get("target_type") or ODS).strip().lower() or ODS.lower()
+    return f"{quote_pg_name(schema)}.{quote_pg_name(table_name)}"
+
+
+def copy_query(source_conn_id, source_database, sql, params, target_conn_id, target_database, target_table,
+               columns, truncate=False, prefix=(), prefix_columns=(), chunk_size=None):
+    """Перекачать результат запроса MSSQL в таблицу Postgres одной транзакцией"""
+    chunk_size = chunk_size or TRANSFER_CHUNK_SIZE
+    stats = TransferStats(target_table)
+    with mssql_connection(source_conn_id, database=source_database) as source:
+        source_cursor = source.cursor()
+        try:
+            if params:
+                source_cursor.execute(sql, params)
+            else:
+                source_cursor.execute(sql)
+            with pg_connection(target_conn_id, database=target_database) as target:
+                with target.cursor() as target_cursor:
+                    if truncate:
+                        target_cursor.execute(f"TRUNCATE {target_table};")
+                    stream = copy_chunks(target_cursor, target_table, list(prefix_columns) + list(columns),
+                                         iter_mssql_chunks(source_cursor, chunk_size), prefix=prefix)
+                target.commit()
+        finally:
+            source_cursor.close()
+    stats.finish(stream)
+    log.info("Copied %s: %s", target_table, stats.to_dict())
+    return stats
+
+
+def copy_table(project, table_name, columns, where=None, params=None, truncate=True, chunk_size=None):
+    """Полная перекачка таблицы (или диапазона по where) из ct_database проекта в приемник"""
+    select_list = ", ".join(quote_mssql_name(c) for c in columns)
+    sql = f"SELECT {select_list} FROM dbo.{quote_mssql_name(table_name)}"
+    if where:
+        sql += f" WHERE {where}"
+    return copy_query(
+        project["source_connection_id"], project["ct_database"], sql, params,
+        project["target_connection_id"], project["target_database"],
+        target_table_name(project, table_name), columns, truncate=truncate, chunk_size=chunk_size,
+    )
+
+
+class PostgresTransferSink:
+    """Приемник для ct_extract: записывает выгрузку в Postgres через COPY.
+
+    ODS - таблица-копия источника: полная выгрузка заменяет данные,
+    инкрементальная применяет последнюю версию каждой строки (delete + insert).
+    HODS - история: строки дописываются вместе с версией и операцией.
+    """
+
+    def __init__(self):
+        self.stats = []
+
+    def __call__(self, spec, chunks):
+        project = spec.project
+        target_type = (project.get("target_type") or ODS).strip().upper() or ODS
+        target_table = target_table_name(project, spec.table_name)
+        stats = TransferStats(target_table)
+
+        with pg_connection(project["target_connection_id"], database=project["target_database"]) as conn:
+            with conn.cursor() as cursor:
+                if target_type == HODS:
+                    stream = self._append_history(cursor, spec, target_table, chunks)
+                elif spec.mode == FULL:
+                    cursor.execute(f"TRUNCATE {target_table};")
+                    stream = copy_chunks(cursor, target_table, spec.columns, chunks)
+                elif spec.mode == INCREMENTAL:
+                    stream = self._merge_changes(cursor, spec, target_table, chunks)
+                else:
+                    raise ValueError(f"Unknown extract mode '{spec.mode}'")
+            conn.commit()
+
+        stats.finish(stream)
+        self.stats.append(stats.to_dict())
+        log.info("Loaded %s (%s): %s", target_table, spec.mode, stats.to_dict())
+        return stats.rows
+
+    def _append_history(self, cursor, spec, target_table, chunks):
+        columns = list(HODS_COLUMNS) + spec.columns
+        if spec.mode == FULL:
+            #  Полная выгрузка в историю: снимок с версией, на которой он снят
+            return copy_chunks(cursor, target_table, columns, chunks, prefix=(spec.to_version, "L"))
+        return copy_chunks(cursor, target_table, columns, chunks)
+
+    def _merge_changes(self, cursor, spec, target_table, chunks):
+        columns = spec.columns
+        keys = spec.key_columns
+        stage = quote_pg_name(f"_ct_stage_{uuid.uuid4().hex[:12]}")
+        cursor.execute(
+            f"CREATE TEMP TABLE {stage} ON COMMIT DROP AS "
+            f"SELECT NULL::bigint AS _ct_version, NULL::text AS _ct_operation, * FROM {target_table} WITH NO DATA;"
+        )
+        stream = copy_chunks(cursor, stage, spec.row_columns, chunks)
+
+        key_list = ", ".join(quote_pg_name(k) for k in keys)
+        key_match = " AND ".join(f"t.{quote_pg_name(k)} = s.{quote_pg_name(k)}" for k in keys)
+        column_list = ", ".join(quote_pg_name(c) for c in columns)
+        latest = (f"SELECT DISTINCT ON ({key_list}) * FROM {stage} "
+                  f"ORDER BY {key_list}, _ct_version DESC")
+        cursor.execute(f"DELETE FROM {target_table} t USING ({latest}) s WHERE {key_match};")
+        cursor.execute(
+            f"INSERT INTO {target_table} ({column_list}) "
+            f"SELECT {column_list} FROM ({latest}) s WHERE s._ct_operation <> 'D';"
+        )
+        return stream
+
+
+def run_project_transfer(project_id, tables=None, chunk_size=None):
+    """Выгрузить изменения таблиц проекта по Change Tracking и загрузить их в приемник"""
+    sink = PostgresTransferSink()
+    result = run_project_extraction(project_id, sink, tables=tables, chunk_size=chunk_size)
+    result["throughput"] = sink.stats
+    return result
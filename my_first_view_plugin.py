@@ -1,14 +1,41 @@
 from airflow.hooks.base import BaseHook
-from flask import Blueprint, jsonify, request
+from flask import Blueprint, jsonify, request, url_for
 from flask_appbuilder import expose, BaseView as AppBuilderBaseView
-from airflow.models import Connection
-from airflow.utils.session import provide_session
 from airflow.plugins_manager import AirflowPlugin
 from airflow.hooks.mssql_hook import MsSqlHook
 from airflow.hooks.postgres_hook import PostgresHook
 from airflow.www.app import csrf
+from airflow.configuration import conf
+import logging
 import os
 
+from ct_connections import connection_index
+from ct_http import StaticAssets, etag_value, not_modified, with_etag
+from ct_pool import mssql_connection, pg_connection, pool_stats
+from ct_store import (
+    PROJECT_TABLES_SQL, apply_table_changes, fetch_project_tables, fetch_table_changes, fetch_tables_page,
+    get_change_versions, sync_tables, tables_watermark
+)
+from ct_stream import stream_query
+from ct_discovery import (
+    DISCOVERY_JOB, REFRESH_ALL_JOB, discover_tables, refresh_all_projects, resolve_database, run_table_discovery
+)
+from ct_jobs import job_manager
+from ct_reconcile import COUNT, HASH, RECONCILE_JOB, load_results, run_reconciliation
+from ct_throttle import (
+    RateLimited, current_user_key, single_flight, source_limiter, too_many_requests, user_limiter
+)
+from ct_timing import timed_view
+
+log = logging.getLogger(__name__)
+
+
+# Stream large results from a server-side cursor unless ?stream=0 is passed
+STREAM_RESPONSES = conf.getboolean("atk_ct", "stream_responses", fallback=True)
+
+# Page size limits for the server-side grid mode
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
 
 my_blueprint = Blueprint(
     "mssql_plugin",
@@ -18,6 +45,93 @@ my_blueprint = Blueprint(
     static_url_path="/static/mssql_plugin"
 )
 
+
+def _stream_requested():
+    stream = request.args.get('stream')
+    if stream is None:
+        return STREAM_RESPONSES
+    return stream not in ('0', 'false')
+
+
+def _gzip_requested():
+    return request.args.get('gzip', '1') not in ('0', 'false')
+
+
+# Plugin static files under content-hashed URLs, see ct_http
+static_assets = StaticAssets(os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
+
+
+@my_blueprint.route("/mssql_plugin/assets/<digest>/<path:filename>")
+def hashed_static(digest, filename):
+    return static_assets.serve(digest, filename, "mssql_plugin.hashed_static")
+
+
+@my_blueprint.app_template_global("atk_ct_static")
+def atk_ct_static(filename):
+    """Template helper: URL of a plugin static file with its content hash"""
+    digest = static_assets.digest(filename)
+    if digest is None:
+        return url_for("mssql_plugin.static", filename=filename)
+    return url_for("mssql_plugin.hashed_static", digest=digest, filename=filename)
+
+
+def _tables_etag(project_id):
+    """ETag of the project's ct_tables rows, None if the change counter can not be read"""
+    try:
+        with pg_connection() as pg_conn:
+            pg_cursor = pg_conn.cursor()
+            try:
+                version = get_change_versions(pg_cursor, [project_id])[project_id]
+            finally:
+                pg_cursor.close()
+    except Exception:
+        log.warning("Change counter of %s is not available, response is not cacheable", project_id,
+                    exc_info=True)
+        return None
+    # The representation depends on streaming and compression, so they are part of the tag
+    return etag_value("tables", project_id, version, _stream_requested(), _gzip_requested())
+
+
+def _tables_watermark():
+    """Row version up to which every ct_tables change is committed, None if it can not be read.
+
+    Read in its own short transaction before the data, so rows newer than the
+    watermark may also be in the response; /changes_since just sends them again.
+    """
+    try:
+        with pg_connection() as pg_conn:
+            pg_cursor = pg_conn.cursor()
+            try:
+                return tables_watermark(pg_cursor)
+            finally:
+                pg_cursor.close()
+                pg_conn.rollback()
+    except Exception:
+        log.warning("ct_tables version is not available, clients will reload the full list", exc_info=True)
+        return None
+
+
+def _discover_and_sync(user_key, project_id, connection_id, database):
+    """MSSQL discovery plus the ct_tables sync behind update_and_fetch_data.
+
+    Runs once per group of identical concurrent requests, so only the user
+    who leads the group and the source connection are charged.
+    """
+    user_limiter.acquire(user_key)
+    source_limiter.acquire(connection_id)
+    table_names = discover_tables(connection_id, database)
+    log.debug("Discovered %d tables for project %s", len(table_names), project_id)
+    with pg_connection() as pg_conn:
+        pg_cursor = pg_conn.cursor()
+        try:
+            sync_result = sync_tables(pg_cursor, project_id, table_names)
+        finally:
+            pg_cursor.close()
+        pg_conn.commit()
+    return sync_result
+
+
+@timed_view
 class MyBaseView(AppBuilderBaseView):
     default_view = "test"
   
@@ -26,32 +140,44 @@ class MyBaseView(AppBuilderBaseView):
         return self.render_template("test.html")
     
     @expose("/fetch_airflow_connections")
-    @provide_session
-    def fetch_airflow_connections(self, session=None):
+    def fetch_airflow_connections(self):
+        """Connection ids for dropdowns: ?prefix= (case-insensitive), ?conn_type=, ?limit="""
         try:
-            connections = session.query(Connection).all()
-            connection_ids = [conn.conn_id for conn in connections]
-            return jsonify({"status": "success", "connections": connection_ids})
+            connections = connection_index.search(
+                prefix=request.args.get('prefix', ''),
+                conn_type=request.args.get('conn_type') or None,
+                limit=request.args.get('limit', type=int),
+            )
+            return jsonify({
+                "status": "success",
+                "connections": [conn_id for conn_id, _ in connections],
+                "types": {conn_id: conn_type for conn_id, conn_type in connections},
+            })
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)})
         
     @expose("/fetch_data")
     def fetch_data(self):
         project_id = request.args.get('project_id')
-        
-        print("*" * 20)
-        print("project_id: ", project_id)
-        print("*" * 20)
-        
-        pg_hook = PostgresHook(postgres_conn_id='airflow_postgres')
-        pg_connection = pg_hook.get_conn()
-        pg_cursor = pg_connection.cursor()
-        pg_cursor.execute("SELECT * FROM atk_ct.ct_tables WHERE project_id=%s;", (project_id, ))
-        pg_results = pg_cursor.fetchall()
-        pg_columns = [desc[0] for desc in pg_cursor.description]
+        log.debug("fetch_data project_id=%s", project_id)
+
+        # The version is read before the data: a change in between only costs one more full fetch
+        etag = _tables_etag(project_id)
+        if etag is not None:
+            cached = not_modified(etag)
+            if cached is not None:
+                return cached
 
-        pg_cursor.close()
-        pg_connection.close()
+        version = _tables_watermark()
+        if _stream_requested():
+            response = stream_query(PROJECT_TABLES_SQL, (project_id, ), extra={"version": version},
+                                    compress=_gzip_requested())
+            return with_etag(response, etag) if etag else response
+
+        with pg_connection() as pg_conn:
+            pg_cursor = pg_conn.cursor()
+            pg_columns, pg_results = fetch_project_tables(pg_cursor, project_id)
+            pg_cursor.close()
 
         # Prepare data for the template
         projects = [dict(zip(pg_columns, row)) for row in pg_results]
@@ -59,67 +185,116 @@ class MyBaseView(AppBuilderBaseView):
         response_data = {
             "status": "success",
             "columns": pg_columns,
-            "results": projects
+            "results": projects,
+            "version": version
         }
 
-        return jsonify(response_data)
+        response = jsonify(response_data)
+        return with_etag(response, etag) if etag else response
+
+    @expose("/changes_since")
+    def changes_since(self):
+        """Rows of the project inserted, updated or deleted after the ?since= version"""
+        project_id = request.args.get('project_id')
+        if not project_id:
+            return jsonify({'status': 'error', 'message': 'No project_id provided'}), 400
+        try:
+            since = int(request.args.get('since', ''))
+        except ValueError:
+            return jsonify({'status': 'error', 'message': 'since must be an integer'}), 400
+
+        version = _tables_watermark()
+        if version is None:
+            return jsonify({'status': 'success', 'reset': True, 'version': None})
+        if since >= version:
+            return jsonify({'status': 'success', 'reset': False, 'version': since,
+                            'columns': [], 'results': [], 'deleted': []})
+
+        with pg_connection() as pg_conn:
+            pg_cursor = pg_conn.cursor()
+            try:
+                pg_columns, pg_results, deleted, reset = fetch_table_changes(pg_cursor, project_id, since)
+            finally:
+                pg_cursor.close()
+
+        return jsonify({
+            "status": "success",
+            "reset": reset,
+            "version": version,
+            "columns": pg_columns or [],
+            "results": [dict(zip(pg_columns, row)) for row in pg_results],
+            "deleted": deleted,
+        })
+
+    @expose("/fetch_data_page", methods=['POST'])
+    @csrf.exempt
+    def fetch_data_page(self):
+        """One block of ct_tables rows for the ag-Grid infinite row model"""
+        params = request.get_json(silent=True) or {}
+        project_id = params.get('project_id')
+        if not project_id:
+            return jsonify({'status': 'error', 'message': 'No project_id provided'}), 400
+
+        try:
+            offset = max(int(params.get('startRow', 0)), 0)
+            end_row = int(params.get('endRow', offset + DEFAULT_PAGE_SIZE))
+        except (TypeError, ValueError):
+            return jsonify({'status': 'error', 'message': 'startRow/endRow must be integers'}), 400
+        limit = min(max(end_row - offset, 1), MAX_PAGE_SIZE)
+
+        try:
+            with pg_connection() as pg_conn:
+                pg_cursor = pg_conn.cursor()
+                try:
+                    pg_columns, pg_results, total = fetch_tables_page(
+                        pg_cursor, project_id, offset, limit,
+                        sort_model=params.get('sortModel'),
+                        filter_model=params.get('filterModel'),
+                    )
+                finally:
+                    pg_cursor.close()
+        except ValueError as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 400
+        except Exception as e:
+            return jsonify({'status': 'error', 'message': str(e)}), 500
+
+        return jsonify({
+            "status": "success",
+            "columns": pg_columns,
+            "results": [dict(zip(pg_columns, row)) for row in pg_results],
+            "total": total,
+            "startRow": offset,
+        })
 
     @expose("/update_and_fetch_data")
     def update_and_fetch_data(self):
         connection_id = request.args.get('connection')
         project_id = request.args.get('project_id')
-        print(" * " * 20)
-        print("PROJECT_NAME:", project_id)
+        log.debug("update_and_fetch_data project_id=%s connection=%s", project_id, connection_id)
         if not connection_id:
             return jsonify({"status": "error", "message": "No connection selected"})
 
         try:
-            # MSSQL Hook to fetch table names
-            mssql_hook = MsSqlHook(mssql_conn_id=connection_id)
-            mssql_query = """
-                SELECT
-                    TABLE_NAME
-                FROM 
-                    BU83_BIVIEW1__ct.INFORMATION_SCHEMA.TABLES
-                WHERE 
-                    TABLE_TYPE = 'BASE TABLE' AND 
-                    TABLE_SCHEMA = 'dbo';
-            """
-            mssql_connection = mssql_hook.get_conn()
-            mssql_cursor = mssql_connection.cursor()
-            mssql_cursor.execute(mssql_query)
-            mssql_results = mssql_cursor.fetchall()
-            mssql_cursor.close()
-            mssql_connection.close()
-
-            table_names = [row[0] for row in mssql_results]
-            print(" * " * 20)
-            print("table_names:", table_names)
-            
-            # PostgreSQL Hook to insert data
-            pg_hook = PostgresHook(postgres_conn_id='airflow_postgres')
-            pg_connection = pg_hook.get_conn()
-            pg_cursor = pg_connection.cursor()
-
-            for table_name in table_names:
-                try:
-                    pg_cursor.execute(
-                        "INSERT INTO atk_ct.ct_tables (project_id, table_name, load) VALUES (%s, %s, %s);",
-                        (project_id, table_name, True)
-                    )
-                except Exception as e:
-                    print("Exception: ", e)
-                    return jsonify(e)
+            # Database comes from ?database= or the project's ct_database
+            database = resolve_database(project_id, request.args.get('database'))
+            # Double clicks and other users on the same project share one discovery and its result;
+            # requests that only wait for it do not use up their rate limit
+            sync_result, coalesced = single_flight.do(
+                ("update_and_fetch_data", project_id, connection_id, database),
+                _discover_and_sync, current_user_key(), project_id, connection_id, database
+            )
 
-            pg_connection.commit()
+            if _stream_requested():
+                return stream_query(PROJECT_TABLES_SQL, (project_id, ),
+                                    extra={"sync": sync_result, "coalesced": coalesced},
+                                    compress=_gzip_requested())
 
-            # Fetch data from atk_ct table
-            pg_cursor.execute("SELECT * FROM atk_ct.ct_tables WHERE project_id=%s;", (project_id, ))
-            pg_results = pg_cursor.fetchall()
-            pg_columns = [desc[0] for desc in pg_cursor.description]
+            with pg_connection() as pg_conn:
+                pg_cursor = pg_conn.cursor()
+                # Fetch data from atk_ct table
+                pg_columns, pg_results = fetch_project_tables(pg_cursor, project_id)
 
-            pg_cursor.close()
-            pg_connection.close()
+                pg_cursor.close()
 
             # Prepare data for the template
             projects = [dict(zip(pg_columns, row)) for row in pg_results]
@@ -127,14 +302,91 @@ class MyBaseView(AppBuilderBaseView):
             response_data = {
             "status": "success",
             "columns": pg_columns,
-            "results": projects
+            "results": projects,
+            "sync": sync_result,
+            "coalesced": coalesced
             }
 
             return jsonify(response_data)
-            
+
+        except RateLimited as e:
+            return too_many_requests(e)
         except Exception as e:
             return jsonify({"status": "error", "message": str(e)})
 
+    @expose("/start_table_discovery")
+    def start_table_discovery(self):
+        """Start MSSQL table discovery in the background and return the job id"""
+        connection_id = request.args.get('connection')
+        project_id = request.args.get('project_id')
+        if not connection_id or not project_id:
+            return jsonify({"status": "error", "message": "No connection or project selected"}), 400
+
+        try:
+            user_limiter.acquire(current_user_key())
+            # Joining a running discovery does not reach MSSQL, so only new jobs count against the source
+            if job_manager.find_active(DISCOVERY_JOB, (project_id, connection_id)) is None:
+                source_limiter.acquire(connection_id)
+        except RateLimited as e:
+            return too_many_requests(e)
+
+        try:
+            database = resolve_database(project_id, request.args.get('database'))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+
+        # Concurrent clicks for the same project and connection share one job
+        job, created = job_manager.submit(
+            DISCOVERY_JOB, (project_id, connection_id), run_table_discovery, project_id, connection_id, database
+        )
+        return jsonify({"status": "success", "created": created, **job.to_dict()}), 202
+
+    @expose("/refresh_all_projects")
+    def start_refresh_all_projects(self):
+        """Re-discover tables of every project in the background"""
+        try:
+            user_limiter.acquire(current_user_key())
+        except RateLimited as e:
+            return too_many_requests(e)
+        job, created = job_manager.submit(REFRESH_ALL_JOB, "*", refresh_all_projects)
+        return jsonify({"status": "success", "created": created, **job.to_dict()}), 202
+
+    @expose("/start_reconciliation")
+    def start_reconciliation(self):
+        """Start source/target reconciliation of the project's load tables in the background"""
+        project_id = request.args.get('project_id')
+        mode = request.args.get('mode', HASH)
+        if not project_id:
+            return jsonify({"status": "error", "message": "No project selected"}), 400
+        if mode not in (HASH, COUNT):
+            return jsonify({"status": "error", "message": f"Unknown mode '{mode}'"}), 400
+        try:
+            user_limiter.acquire(current_user_key())
+        except RateLimited as e:
+            return too_many_requests(e)
+
+        job, created = job_manager.submit(RECONCILE_JOB, project_id, run_reconciliation, project_id, mode=mode)
+        return jsonify({"status": "success", "created": created, **job.to_dict()}), 202
+
+    @expose("/reconcile_results")
+    def reconcile_results(self):
+        """Latest reconciliation result of every table of the project"""
+        project_id = request.args.get('project_id')
+        if not project_id:
+            return jsonify({"status": "error", "message": "No project selected"}), 400
+        return jsonify({"status": "success", "results": load_results(project_id)})
+
+    @expose("/job_status")
+    def job_status(self):
+        job = job_manager.get(request.args.get('job_id'))
+        if job is None:
+            return jsonify({"status": "error", "message": "Unknown job"}), 404
+        return jsonify({"status": "success", **job.to_dict()})
+
+    @expose("/pool_stats")
+    def connection_pool_stats(self):
+        return jsonify({"status": "success", "pools": pool_stats()})
+
     @expose("/update_data_is_load", methods=['POST'])
     @csrf.exempt
     def update_data_is_load(self):
@@ -142,51 +394,41 @@ class MyBaseView(AppBuilderBaseView):
             data = request.get_json()
             if not data:
                 return jsonify({'status': 'error', 'message': 'No data provided'}), 400
-            
-            # PostgreSQL Hook to connect to the database
-            pg_hook = PostgresHook(postgres_conn_id='airflow_postgres')
-            pg_connection = pg_hook.get_conn()
-            pg_cursor = pg_connection.cursor()
 
-            try:
-                update_queries = []
-                for entry in data:
-                    print("entry")
-                    print(entry)
-                    table_name = entry['table_name']
-                    for change in entry['changes']:
-                        print("change")
-                        print(change)
-                        field = change['field']
-                        new_value = change['newValue']
-                        
-                        # SQL Injection Mitigation: Use placeholders for values
-                        query = f"""
-                        UPDATE atk_ct.ct_tables
-                        SET {field} = %s
-                        WHERE table_name = %s;
-                        """
-                        update_queries.append((query, (new_value, table_name)))
-                print("update_queries")
-                print(update_queries)
-                # Execute the queries
-                for query, params in update_queries:
-                    pg_cursor.execute(query, params)
-                pg_connection.commit()
-                
-            except Exception as e:
-                pg_connection.rollback()  # Rollback in case of error
-                print(f"Error occurred while updating data: {e}")
-                return jsonify({'status': 'error', 'message': str(e)}), 500
-            
-            finally:
-                pg_cursor.close()
-                pg_connection.close()
-            
-            return jsonify({'status': 'success'}), 200
+            # Either {"project_id": ..., "rows": [...]} or a bare list of rows with ?project_id=
+            if isinstance(data, dict):
+                project_id = data.get('project_id')
+                entries = data.get('rows') or []
+            else:
+                project_id = request.args.get('project_id')
+                entries = data
+            if not project_id:
+                return jsonify({'status': 'error', 'message': 'No project_id provided'}), 400
+
+            # PostgreSQL connection from the pool
+            with pg_connection() as pg_conn:
+                pg_cursor = pg_conn.cursor()
+
+                try:
+                    batches = apply_table_changes(pg_cursor, project_id, entries)
+                    pg_conn.commit()
+
+                except ValueError as e:
+                    pg_conn.rollback()
+                    return jsonify({'status': 'error', 'message': str(e)}), 400
+
+                except Exception as e:
+                    pg_conn.rollback()  # Rollback in case of error
+                    log.exception("Error occurred while updating data")
+                    return jsonify({'status': 'error', 'message': str(e)}), 500
+
+                finally:
+                    pg_cursor.close()
+
+            return jsonify({'status': 'success', 'batches': batches}), 200
         
         except Exception as e:
-            print(f"Error processing request: {e}")
+            log.exception("Error processing request")
             return jsonify({'status': 'error', 'message': str(e)}), 500
     
 my_view = MyBaseView()
@@ -1,21 +1,41 @@
+import hashlib
 import json
+import logging
+import os
+import time
 
 import flask
+import flask_login
 import pandas as pd
 from airflow.plugins_manager import AirflowPlugin
 from flask import Blueprint, request, jsonify, url_for, redirect, flash
 from flask_appbuilder import expose, BaseView as AppBuilderBaseView
 
+from werkzeug.datastructures import MultiDict
 from wtforms import Form, SelectField, RadioField, StringField, BooleanField, DateTimeLocalField
 from airflow.www.app import csrf
-from wtforms.validators import InputRequired
+from wtforms.validators import InputRequired, Optional
 from croniter import croniter, CroniterBadCronError, CroniterBadDateError
 
-from airflow import settings
-from airflow.models import Connection
+from airflow import __version__ as airflow_version
 from airflow.providers.microsoft.mssql.hooks.mssql import MsSqlHook
 from airflow.providers.postgres.hooks.postgres import PostgresHook as PH
 
+from ct_choices import ChoiceProvider, invalidate_choices
+from ct_connections import connection_index
+from ct_http import etag_value, not_modified, with_etag
+from ct_pool import mssql_connection, pg_connection
+from ct_schedule_planner import plan_all_projects
+from ct_schema import start_schema_upgrade
+from ct_snapshot import refresh_snapshot, start_snapshot_refresh
+from ct_store import (
+    PROJECT_COLUMNS, PROJECT_LIST_COLUMNS, PROJECTS_CHANGE_KEY, copy_project_tables, delete_projects,
+    fetch_projects_page, get_change_versions, get_projects, insert_projects, update_projects
+)
+from ct_timing import timed_view
+
+log = logging.getLogger(__name__)
+
 #  Инициализация фронт-части плагина
 bp = Blueprint(
     "project_data_saving",
@@ -24,26 +44,52 @@ bp = Blueprint(
 )
 
 
+def _file_digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+#  Версия разметки списка проектов: ETag меняется при обновлении шаблона или Airflow
+PROJECT_LIST_TEMPLATE_DIGEST = _file_digest(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates", "project_change_tracking.html")
+)
+#  Страница содержит CSRF-токен с ограниченным сроком жизни, поэтому ETag обновляется не реже раза в час
+PROJECT_LIST_ETAG_PERIOD = 3600
+#  Размер страницы JSON-списка проектов по умолчанию и максимальный
+PROJECT_PAGE_SIZE = 100
+MAX_PROJECT_PAGE_SIZE = 1000
+#  Не больше стольких проектов в одном запросе /bulk
+BULK_MAX_PROJECTS = 500
+
+
 def get_connection_postgres():
-    """Получение хука Postgres"""
-    pg_hook = PH.get_hook("airflow_postgres")
-    return pg_hook
+    """Получение соединения Postgres из пула (контекстный менеджер)"""
+    return pg_connection("airflow_postgres")
 
 
 def get_all_database_mssql():
     """Получение connections из базы данных mssql"""
-    mssql_hook = MsSqlHook(mssql_conn_id='mssql_af_net')
     sql = "SELECT name, database_id FROM sys.databases;"
-    databases = [" "] + [i[0] for i in mssql_hook.get_records(sql)]
+    with mssql_connection('mssql_af_net') as conn:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(sql)
+            rows = cursor.fetchall()
+        finally:
+            cursor.close()
+    databases = [" "] + [i[0] for i in rows]
     return databases
 
 
 def get_all_connections():
-    """Получаем все Connections из Apache Airflow"""
-    session = settings.Session()
-    connections = session.query(Connection).all()
-    connections_list = [" "] + [i.conn_id for i in connections]
-    return connections_list
+    """Получаем conn_id всех Connections из Apache Airflow (индекс ct_connections)"""
+    return [" "] + connection_index.conn_ids()
+
+
+#  Один провайдер на все поля с базами данных: один запрос к MSSQL на TTL, а не пять при импорте
+mssql_database_choices = ChoiceProvider("mssql_databases", get_all_database_mssql)
+#  Индекс подключений кэшируется и сбрасывается сам, поэтому у провайдера TTL нулевой
+connection_choices = ChoiceProvider("airflow_connections", get_all_connections, ttl=0)
 
 
 def validate_cron(form, field) -> bool:
@@ -56,13 +102,6 @@ def validate_cron(form, field) -> bool:
         return False
 
 
-def validate_date(raw_date: str) -> str:
-    if raw_date is None:
-        return 'NULL'
-    else:
-        return raw_date
-
-
 class ProjectForm(Form):
     """Form administration of ct project"""
 
@@ -78,7 +117,7 @@ class ProjectForm(Form):
 
     source_connection_id = SelectField(
         'Source Connection ID',
-        choices=get_all_connections(),
+        choices=connection_choices,
         id="conn_type",
         render_kw={"class": "form-control",
                    "data-placeholder": "Select Value",
@@ -87,7 +126,7 @@ class ProjectForm(Form):
 
     one_c_database = SelectField(
         '1C Database',
-        choices=get_all_database_mssql(),
+        choices=mssql_database_choices,
         id="conn_type1",
         name="conn_type1",
         render_kw={"class": "form-control",
@@ -97,7 +136,7 @@ class ProjectForm(Form):
 
     biview_database = SelectField(
         'BIView Database',
-        choices=get_all_database_mssql(),
+        choices=mssql_database_choices,
         id="conn_type2",
         name="conn_type2",
         render_kw={"class": "form-control",
@@ -119,7 +158,7 @@ class ProjectForm(Form):
 
     ct_database = SelectField(
         'CT Database',
-        choices=get_all_database_mssql(),
+        choices=mssql_database_choices,
         id="conn_type3",
         name="conn_type3",
         render_kw={"class": "form-control",
@@ -133,7 +172,7 @@ class ProjectForm(Form):
 
     target_connection_id = SelectField(
         'Target Connection ID',
-        choices=get_all_connections(),
+        choices=connection_choices,
         id="conn_type",
         render_kw={"class": "form-control",
                    "data-placeholder": "Select Value",
@@ -142,7 +181,7 @@ class ProjectForm(Form):
 
     target_database = SelectField(
         'Target Database',
-        choices=get_all_database_mssql(),
+        choices=mssql_database_choices,
         id="conn_type4",
         name="conn_type4",
         render_kw={"class": "form-control",
@@ -161,7 +200,9 @@ class ProjectForm(Form):
                    },
     )
 
+    #  Пустая дата начала сохраняется как NULL (DAG стартует с даты по умолчанию)
     update_dags_start_date = DateTimeLocalField('Start Date',
+                                                validators=[Optional()],
                                                 render_kw={"class": "form-control-short"}
                                                 )
 
@@ -174,6 +215,7 @@ class ProjectForm(Form):
                                        )
 
     transfer_dags_start_date = DateTimeLocalField('Start Date',
+                                                  validators=[Optional()],
                                                   render_kw={"class": "form-control-short"}
                                                   )
 
@@ -186,50 +228,244 @@ class ProjectForm(Form):
                                          )
 
 
+def _project_list_column_defs():
+    """Колонки грида списка проектов по несвязанным полям ProjectForm.
+
+    Форма не создается, поэтому списки choices (запросы к MSSQL) не читаются.
+    """
+    columns = []
+    for name in PROJECT_LIST_COLUMNS:
+        unbound = getattr(ProjectForm, name)
+        column = {"field": name, "headerName": unbound.kwargs.get("label") or unbound.args[0]}
+        if issubclass(unbound.field_class, BooleanField):
+            column["cellDataType"] = "boolean"
+        columns.append(column)
+    return columns
+
+
+PROJECT_LIST_COLUMN_DEFS = _project_list_column_defs()
+
+
+#  Имена полей ProjectForm в данных формы (у части полей name отличается от атрибута)
+PROJECT_FIELD_NAMES = {attr: getattr(ProjectForm, attr).kwargs.get("name") or attr for attr in PROJECT_COLUMNS}
+
+
+def _project_formdata(values):
+    """Данные формы из словаря настроек проекта, как их отправила бы страница добавления"""
+    formdata = MultiDict()
+    for attr in PROJECT_COLUMNS:
+        field_class = getattr(ProjectForm, attr).field_class
+        value = values.get(attr)
+        if value is None and issubclass(field_class, SelectField) and not issubclass(field_class, RadioField):
+            value = " "
+        if value is None or value is False:
+            continue
+        if value is True:
+            value = "y"
+        elif hasattr(value, "strftime"):
+            value = value.strftime("%Y-%m-%dT%H:%M:%S")
+        formdata.add(PROJECT_FIELD_NAMES[attr], str(value))
+    return formdata
+
+
+def validate_project(values):
+    """Проверить настройки проекта валидаторами ProjectForm: (project, errors)"""
+    return validate_project_form(ProjectForm(_project_formdata(values)))
+
+
+def validate_project_form(form):
+    """Проверить заполненную ProjectForm: (project, errors), project - значения для insert/update_projects"""
+    form.validate()
+    errors = {name: list(messages) for name, messages in form.errors.items()}
+    for attr in ("update_dags_schedule", "transfer_dags_schedule"):
+        schedule = (form[attr].data or "").strip()
+        if schedule and not croniter.is_valid(schedule):
+            errors[attr] = ["Invalid cron expression"]
+    project = {attr: form[attr].data for attr in PROJECT_COLUMNS}
+    project_type = project["biview_project_type"]
+    project["biview_project_type"] = int(project_type) if project_type not in (None, "") else None
+    return project, errors
+
+
+def _flash_errors(errors):
+    for name, messages in errors.items():
+        flash(f"{name}: {'; '.join(messages)}", category='warning')
+
+
+def run_bulk_operation(payload):
+    """Пакетные create/update/delete/clone проектов в одной транзакции.
+
+    Все элементы проверяются до записи; при atomic (по умолчанию) одна
+    ошибка отменяет весь пакет. Возвращает (тело ответа, HTTP-код).
+    """
+    action = payload.get("action")
+    atomic = payload.get("atomic", True)
+    dry_run = payload.get("dry_run", False)
+    source_id = payload.get("source")
+    if action == "delete":
+        items = [{"ct_project_id": project_id} for project_id in payload.get("project_ids") or []]
+    elif action in ("create", "update"):
+        items = payload.get("projects") or []
+    elif action == "clone":
+        items = payload.get("clones") or []
+        if not source_id:
+            return {"status": "error", "message": "No source project provided"}, 400
+    else:
+        return {"status": "error", "message": f"Unknown action '{action}'"}, 400
+    if not isinstance(items, list) or not items:
+        return {"status": "error", "message": "No projects provided"}, 400
+    if len(items) > BULK_MAX_PROJECTS:
+        return {"status": "error", "message": f"At most {BULK_MAX_PROJECTS} projects per request"}, 400
+
+    results = [{"index": i, "ct_project_id": item.get("ct_project_id") if isinstance(item, dict) else None}
+               for i, item in enumerate(items)]
+    with get_connection_postgres() as conn:
+        with conn.cursor() as cursor:
+            existing = get_projects(cursor, [r["ct_project_id"] for r in results if r["ct_project_id"]]
+                                    + ([source_id] if source_id else []))
+            if action == "clone" and source_id not in existing:
+                return {"status": "error", "message": f"Project '{source_id}' not found"}, 404
+
+            valid, seen = [], set()
+            for result, item in zip(results, items):
+                project_id = result["ct_project_id"]
+                if not isinstance(item, dict) or not project_id:
+                    result.update(status="invalid", errors={"ct_project_id": ["This field is required."]})
+                    continue
+                unknown = sorted(set(item) - set(PROJECT_COLUMNS))
+                if unknown:
+                    result.update(status="invalid", errors={key: ["Unknown field"] for key in unknown})
+                elif project_id in seen:
+                    result.update(status="invalid", errors={"ct_project_id": ["Duplicate in this request"]})
+                elif action in ("create", "clone") and project_id in existing:
+                    result.update(status="exists", errors={"ct_project_id": ["Project already exists"]})
+                elif action in ("update", "delete") and project_id not in existing:
+                    result.update(status="not_found")
+                elif action == "delete":
+                    valid.append((result, item))
+                else:
+                    base = existing[project_id] if action == "update" else existing.get(source_id, {})
+                    project, errors = validate_project({**base, **item})
+                    if errors:
+                        result.update(status="invalid", errors=errors)
+                    else:
+                        valid.append((result, project))
+                seen.add(project_id)
+
+            failed = len(valid) < len(results)
+            if not valid or (failed and atomic) or dry_run:
+                ok = dry_run and bool(valid) and not (failed and atomic)
+                for result, _ in valid:
+                    result["status"] = "valid" if ok else "skipped"
+                body = {"status": "success" if ok else "error", "action": action, "results": results}
+                return body, 200 if ok else 400
+
+            projects = [project for _, project in valid]
+            if action == "create" or action == "clone":
+                written = set(insert_projects(cursor, projects))
+                done_status, lost_status = "created", "exists"
+            elif action == "update":
+                written = set(update_projects(cursor, projects))
+                done_status, lost_status = "updated", "not_found"
+            else:
+                written = set(delete_projects(cursor, [project["ct_project_id"] for project in projects]))
+                done_status, lost_status = "deleted", "not_found"
+            #  Между проверкой и записью проект могли создать или удалить параллельно
+            for result, _ in valid:
+                result["status"] = done_status if result["ct_project_id"] in written else lost_status
+            if atomic and len(written) < len(valid):
+                conn.rollback()
+                for result, _ in valid:
+                    if result["status"] == done_status:
+                        result["status"] = "skipped"
+                return {"status": "error", "action": action, "results": results}, 409
+            if action == "clone" and payload.get("copy_tables", True) and written:
+                copy_project_tables(cursor, source_id, sorted(written))
+        conn.commit()
+    refresh_snapshot()
+
+    status = "success" if all(result["status"] == done_status for result in results) else "partial"
+    return {"status": status, "action": action, "results": results}, 200
+
+
+def _json_arg(name, default):
+    """Параметр query string в JSON (sortModel/filterModel грида)"""
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        return json.loads(value)
+    except ValueError:
+        raise ValueError(f"Parameter '{name}' is not valid JSON")
+
+
+@timed_view
 class ProjectsView(AppBuilderBaseView):
     """View of projects"""
     default_view = "project_list"
 
+    @staticmethod
+    def _project_list_etag():
+        """ETag страницы списка проектов; None, если ответ кэшировать нельзя.
+
+        Строки проектов грузятся через /projects, поэтому страница от данных не зависит.
+        """
+        if flask.session.get("_flashes"):
+            return None
+        user = flask_login.current_user
+        return etag_value("projects", user.get_id() if user else None, airflow_version,
+                          PROJECT_LIST_TEMPLATE_DIGEST, int(time.time() // PROJECT_LIST_ETAG_PERIOD))
+
     @expose('/', methods=['GET'])
     def project_list(self):
         """View list of projects"""
-        sql_query = """
-                        SELECT
-                            ct_project_id,
-                            source_connection_id,
-                            one_c_database,
-                            biview_database,
-                            biview_project_type,
-                            ct_database,
-                            transfer_source_data,
-                            target_connection_id,
-                            target_database,
-                            target_type 
-                        FROM airflow.atk_ct.ct_projects
-                    """
-        with get_connection_postgres().get_conn() as conn:
+        etag = self._project_list_etag()
+        cached = not_modified(etag) if etag else None
+        if cached is not None:
+            return cached
+        response = flask.make_response(self.render_template("project_change_tracking.html",
+                                                            columns=PROJECT_LIST_COLUMN_DEFS,
+                                                            page_size=PROJECT_PAGE_SIZE))
+        return with_etag(response, etag) if etag else response
+
+    @expose('/projects', methods=['GET'])
+    def projects_page(self):
+        """Страница проектов в JSON: startRow, endRow, sortModel и filterModel грида"""
+        try:
+            offset = max(request.args.get('startRow', default=0, type=int), 0)
+            end_row = request.args.get('endRow', default=offset + PROJECT_PAGE_SIZE, type=int)
+            sort_model = _json_arg('sortModel', [])
+            filter_model = _json_arg('filterModel', {})
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
+        limit = min(max(end_row - offset, 1), MAX_PROJECT_PAGE_SIZE)
+
+        with get_connection_postgres() as conn:
             with conn.cursor() as cursor:
-                cursor.execute(sql_query)
-
                 try:
-                    columns = [field.label.text for field in ProjectForm()]
-                    rows = cursor.fetchall()
-                    raw_projects = [dict(zip(columns, row)) for row in rows]
-
-                    projects = []
-                    for dictionary in raw_projects:
-                        if dictionary['Transfer Source Data'] is False:
-                            dictionary['Transfer Source Data'] = 'No'
-                            projects.append(dictionary)
-                        else:
-                            dictionary['Transfer Source Data'] = 'Yes'
-                            projects.append(dictionary)
-                except Exception as e:
-                    flash(str(e), category="error")
-
-        return self.render_template("project_change_tracking.html",
-                                    projects=raw_projects,
-                                    count_projects=len(raw_projects))
+                    version = get_change_versions(cursor, [PROJECTS_CHANGE_KEY])[PROJECTS_CHANGE_KEY]
+                except Exception:
+                    log.warning("Project list change counter is not available", exc_info=True)
+                    conn.rollback()
+                    etag = None
+                else:
+                    etag = etag_value("projects_page", version, request.query_string)
+                    cached = not_modified(etag)
+                    if cached is not None:
+                        return cached
+                try:
+                    columns, rows, total = fetch_projects_page(cursor, offset, limit, sort_model, filter_model)
+                except ValueError as e:
+                    return jsonify({"status": "error", "message": str(e)}), 400
+
+        response = jsonify({
+            "status": "success",
+            "columns": columns,
+            "results": [dict(zip(columns, row)) for row in rows],
+            "total": total,
+            "startRow": offset,
+        })
+        return with_etag(response, etag) if etag else response
 
     @expose("/add", methods=['GET', 'POST'])
     @csrf.exempt
@@ -241,55 +477,24 @@ class ProjectsView(AppBuilderBaseView):
         if request.method == 'POST':
 
             form = ProjectForm(request.form)
-
-            sql_insert_query = f"""
-                                INSERT INTO airflow.atk_ct.ct_projects (
-                                    ct_project_id,
-                                    source_connection_id,
-                                    one_c_database,
-                                    biview_database,
-                                    biview_project_type,
-                                    ct_database,
-                                    transfer_source_data,
-                                    target_connection_id,
-                                    target_database,
-                                    target_type,
-                                    update_dags_start_date,
-                                    update_dags_schedule,
-                                    transfer_dags_start_date,
-                                    transfer_dags_schedule
-                                    )
-                                VALUES (
-                                    '{form.ct_project_id.data}',
-                                    '{form.source_connection_id.data}',
-                                    '{form.one_c_database.data}',
-                                    '{form.biview_database.data}',
-                                    {form.biview_project_type.data},
-                                    '{form.ct_database.data}',
-                                    {form.transfer_source_data.data},
-                                    '{form.target_connection_id.data}',
-                                    '{form.target_database.data}',
-                                    '{form.target_type.data}',
-                                    {validate_date(form.update_dags_start_date.data)},
-                                    '{form.update_dags_schedule.data}',
-                                    {validate_date(form.update_dags_start_date.data)},
-                                    '{form.transfer_dags_schedule.data}'
-                                    );"""
-            print(sql_insert_query)
+            project, errors = validate_project_form(form)
+            if errors:
+                _flash_errors(errors)
+                return self.render_template("add_projects.html", form=form)
             try:
-                with get_connection_postgres().get_conn() as conn:
+                with get_connection_postgres() as conn:
                     with conn.cursor() as cursor:
-                        cursor.execute(sql_insert_query)
+                        created = insert_projects(cursor, [project])
                     conn.commit()
+                if not created:
+                    flash("Данное имя проекта уже существует! Выберите другое.", category='warning')
+                    return self.render_template("add_projects.html", form=form)
+                refresh_snapshot()
 
                 flash("Проект успешно сохранен", category="info")
-                return self.render_template("add_projects.html", form=form)
             except Exception as e:
-                if 'duplicate key' in str(e):
-                    flash("Данное имя проекта уже существует! Выберите другое.", category='warning')
-                else:
-                    flash(str(e), category='warning')
-                return self.render_template("add_projects.html", form=form)
+                flash(str(e), category='warning')
+            return self.render_template("add_projects.html", form=form)
 
         return self.render_template("add_projects.html", form=form)
 
@@ -298,69 +503,100 @@ class ProjectsView(AppBuilderBaseView):
     def edit_project_data(self, ct_project_id):
         """Edit of project data"""
 
-        print("Im in edit_project_data")
-
-        sql_select_query = f"""SELECT * FROM airflow.atk_ct.ct_projects WHERE ct_project_id = '{ct_project_id}';"""
-
-        with get_connection_postgres().get_conn() as conn:
+        with get_connection_postgres() as conn:
             with conn.cursor() as cursor:
-                cursor.execute(sql_select_query)
-                columns = [col[0] for col in cursor.description]
-                rows = cursor.fetchall()
-                projects_data = [dict(zip(columns, row)) for row in rows][0]
+                projects_data = get_projects(cursor, [ct_project_id]).get(ct_project_id)
+        if projects_data is None:
+            flash(f"Проект {ct_project_id} не найден", category='warning')
+            return flask.redirect(url_for('ProjectsView.project_list'))
 
-        # projects_data['start_date'] = projects_data['start_date'].strftime('%d.%m.%Y')
-        print(projects_data)
+        log.debug("Edit project %s: %s", ct_project_id, projects_data)
 
         form_existing = ProjectForm(data=projects_data)
 
         form_update = ProjectForm(request.form)
 
         if request.method == 'POST':
-
-            sql_update_query = f"""
-                                UPDATE airflow.atk_ct.ct_projects
-                                SET ct_project_id = '{form_update.ct_project_id.data}',
-                                    source_connection_id = '{form_update.source_connection_id.data}',
-                                    one_c_database = '{form_update.one_c_database.data}',
-                                    biview_database = '{form_update.biview_database.data}',
-                                    biview_project_type = {form_update.biview_project_type.data},
-                                    transfer_source_data = {form_update.transfer_source_data.data},
-                                    target_connection_id = '{form_update.target_connection_id.data}',
-                                    target_database = '{form_update.target_database.data}',
-                                    target_type = '{form_update.target_type.data}',
-                                    update_dags_start_date = {validate_date(form_update.update_dags_start_date.data)},
-                                    update_dags_schedule = '{form_update.update_dags_schedule.data}',
-                                    transfer_dags_start_date = {validate_date(form_update.transfer_dags_start_date.data)},
-                                    transfer_dags_schedule = '{form_update.transfer_dags_schedule.data}'
-                                WHERE ct_project_id = '{form_update.ct_project_id.data}'
-                                ;"""
-            print(sql_update_query)
-
+            project, errors = validate_project_form(form_update)
+            if errors:
+                _flash_errors(errors)
+                return self.render_template("edit_project.html", form=form_update)
+            #  Изменяется проект из адреса страницы, переименование формой не поддерживается
+            project["ct_project_id"] = ct_project_id
             try:
-                with get_connection_postgres().get_conn() as conn:
+                with get_connection_postgres() as conn:
                     with conn.cursor() as cursor:
-                        cursor.execute(sql_update_query)
+                        updated = update_projects(cursor, [project])
                     conn.commit()
+                if not updated:
+                    flash(f"Проект {ct_project_id} не найден", category='warning')
+                    return flask.redirect(url_for('ProjectsView.project_list'))
+                refresh_snapshot()
 
                 flash("Проект успешно изменен", category="info")
-                return self.render_template("edit_project.html", form=form_update)
-
             except Exception as e:
-                if 'duplicate key' in str(e):
-                    flash("Данное имя проекта уже существует! Выберите другое.", category='warning')
-                else:
-                    flash(str(e), category='warning')
-                return self.render_template("edit_project.html", form=form_update)
+                flash(str(e), category='warning')
+            return self.render_template("edit_project.html", form=form_update)
 
         return self.render_template("edit_project.html", form=form_existing)
 
+    @expose('/bulk', methods=['POST'])
+    @csrf.exempt
+    def bulk_projects(self):
+        """Пакетные операции с проектами (JSON): create, update, delete, clone"""
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict):
+            return jsonify({"status": "error", "message": "JSON object expected"}), 400
+        try:
+            body, status_code = run_bulk_operation(payload)
+        except Exception as e:
+            log.exception("Bulk %s of projects failed", payload.get("action"))
+            return jsonify({"status": "error", "message": str(e)}), 500
+        return jsonify(body), status_code
+
     @expose('/projects_to_load', methods=['GET'])
     def projects_to_load(self):
         """Render a new HTML page"""
         project_name = request.args.get('project_name')
         connection = request.args.get('connection')
-        return self.render_template("projects_to_load.html", project_name=project_name, connection=connection)
+        #  client - весь список в браузере, server - постраничная загрузка через fetch_data_page
+        grid_mode = request.args.get('grid_mode', 'client')
+        if grid_mode not in ('client', 'server'):
+            grid_mode = 'client'
+        return self.render_template("projects_to_load.html", project_name=project_name, connection=connection,
+                                    grid_mode=grid_mode)
+
+    @staticmethod
+    def _plan_args():
+        """Параметры планировщика из query string: hours, limit, next"""
+        return {
+            "horizon_hours": request.args.get('hours', type=int),
+            "limit": request.args.get('limit', type=int),
+            "next_count": request.args.get('next', default=5, type=int),
+        }
+
+    @expose('/schedule_planner', methods=['GET'])
+    def schedule_planner(self):
+        """Нагрузка расписаний на серверы источников и предложения по сдвигу"""
+        try:
+            plan = plan_all_projects(**self._plan_args())
+        except Exception as e:
+            flash(str(e), category="error")
+            plan = None
+        return self.render_template("schedule_planner.html", plan=plan)
+
+    @expose('/schedule_plan', methods=['GET'])
+    def schedule_plan(self):
+        """То же в JSON"""
+        return jsonify(plan_all_projects(**self._plan_args()))
+
+    @expose('/refresh_choices', methods=['GET'])
+    def refresh_choices(self):
+        """Сбросить кэш выпадающих списков формы проекта"""
+        invalidate_choices()
+        connection_index.invalidate()
+        flash("Списки подключений и баз данных будут перечитаны", category="info")
+        return flask.redirect(request.referrer or url_for('ProjectsView.project_list'))
 
     @expose('/delete/<string:ct_project_id>', methods=['GET'])
     @csrf.exempt
@@ -368,10 +604,11 @@ class ProjectsView(AppBuilderBaseView):
         """Delete project"""
         sql_delete_query = """DELETE FROM airflow.atk_ct.ct_projects WHERE ct_project_id = %s"""
         try:
-            with get_connection_postgres().get_conn() as conn:
+            with get_connection_postgres() as conn:
                 with conn.cursor() as cursor:
                     cursor.execute(sql_delete_query, (ct_project_id,))
                 conn.commit()
+            refresh_snapshot()
             flash("Проект успешно удален", category="info")
         except Exception as e:
             flash(str(e))
@@ -389,4 +626,10 @@ v_appbuilder_package = {
 class AirflowConnectionPlugin(AirflowPlugin):
     name = "project_list"
     flask_blueprints = [bp]
-    appbuilder_views = [v_appbuilder_package]
\ No newline at end of file
+    appbuilder_views = [v_appbuilder_package]
+
+    @classmethod
+    def on_load(cls, *args, **kwargs):
+        """Миграции схемы atk_ct и снимок настроек для DAG при загрузке плагина, не блокируя запуск процесса"""
+        start_schema_upgrade()
+        start_snapshot_refresh()
\ No newline at end of file
@@ -1,25 +1,21 @@
+import logging
 import os
 from datetime import datetime
 from airflow.operators.empty import EmptyOperator
 from airflow.operators.python import PythonOperator
 from airflow import DAG
-from airflow.providers.microsoft.mssql.hooks.mssql import MsSqlHook
+
+from ct_metadata import metadata_cache
+
+log = logging.getLogger(__name__)
 
 def get_sys_objects_list():
-    mssqlh = MsSqlHook(mssql_conn_id = 'mssql_af_net')
-    query = \
-        r"""
-        use BU83_BIVIEW1;
-        select
-            object_id,
-            name,
-            type,
-            1 ct__load
-            from sys.objects
-            where type in ('U', 'V')
-            order by 3,2
-        """
-    res = mssqlh.get_records(sql=query)
+    snapshot, diff = metadata_cache.refresh('mssql_af_net', 'BU83_BIVIEW1')
+    log.info("Metadata changes: %s", {name: len(objects) for name, objects in diff.items()})
+    res = sorted(
+        ((object_id, obj['name'], obj['type'], 1) for object_id, obj in snapshot.objects.items()),
+        key=lambda row: (row[2], row[1])
+    )
     return res
 
 with DAG(dag_id='test_mssql_conn', start_date=datetime(2024,8,19), schedule=None,
@@ -0,0 +1,5 @@
+import os
+import sys
+
+#  Модули плагина лежат в корне папки plugins
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,45 @@
+from datetime import datetime, timezone
+
+import pytest
+from croniter import croniter
+
+pytest.importorskip("airflow")
+
+from ct_schedule_planner import PlannedJob, plan_schedules  # noqa: E402
+
+
+def _projects(count, schedule, source="mssql_1"):
+    return [
+        {"ct_project_id": f"p{i}", "source_connection_id": source, "update_dags_schedule": schedule}
+        for i in range(count)
+    ]
+
+
+def test_early_fire_shifted_before_horizon_start():
+    #  Первый запуск через 2 минуты после начала горизонта, сдвиг назад до -5 уводит его за начало
+    start = datetime(2026, 1, 1, 12, 3, tzinfo=timezone.utc)
+    plan = plan_schedules(_projects(3, "5 * * * *"), start=start, horizon_hours=24, limit=2)
+
+    source = plan["sources"][0]
+    assert source["peak"] == 3
+    assert source["suggested_peak"] <= 2
+    assert plan["suggestions"]
+    for suggestion in plan["suggestions"]:
+        assert croniter.is_valid(suggestion["suggested_schedule"])
+
+
+def test_fire_at_horizon_start():
+    start = datetime(2026, 1, 1, 12, 0, tzinfo=timezone.utc)
+    plan = plan_schedules(_projects(4, "0 * * * *"), start=start, horizon_hours=2, limit=1)
+    assert plan["sources"][0]["suggested_peak"] <= plan["sources"][0]["peak"]
+
+
+def test_step_minutes_keep_their_form():
+    job = PlannedJob("p", "update", "s", "*/15 * * * *", 5, [0], [])
+    assert job.shift_range == (0, 14)
+    job.shift = 5
+    assert job.suggested_schedule == "5-50/15 * * * *"
+
+
+def test_every_minute_is_not_shifted():
+    assert PlannedJob("p", "update", "s", "* * * * *", 5, [0], []).shift_range is None
@@ -0,0 +1,43 @@
+import importlib.util
+import os
+
+import pytest
+
+pytest.importorskip("airflow")
+
+from werkzeug.datastructures import MultiDict  # noqa: E402
+
+START_DATE_FIELDS = ("update_dags_start_date", "transfer_dags_start_date")
+
+
+def _load_plugin():
+    #  В имени файла плагина пробел, обычным import его не загрузить
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "project change_tracking.py")
+    spec = importlib.util.spec_from_file_location("project_change_tracking", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+plugin = _load_plugin()
+
+
+@pytest.mark.parametrize("field", START_DATE_FIELDS)
+@pytest.mark.parametrize("formdata", [{}, {"update_dags_start_date": "", "transfer_dags_start_date": ""}])
+def test_empty_start_date_is_valid(field, formdata):
+    form = plugin.ProjectForm(MultiDict(formdata))
+    assert form[field].validate(form), form[field].errors
+    assert form[field].data is None
+
+
+@pytest.mark.parametrize("field", START_DATE_FIELDS)
+def test_start_date_is_parsed(field):
+    form = plugin.ProjectForm(MultiDict({field: "2026-01-02T03:04"}))
+    assert form[field].validate(form)
+    assert form[field].data.isoformat() == "2026-01-02T03:04:00"
+
+
+@pytest.mark.parametrize("field", START_DATE_FIELDS)
+def test_invalid_start_date_is_rejected(field):
+    form = plugin.ProjectForm(MultiDict({field: "not a date"}))
+    assert not form[field].validate(form)